@@ -1,8 +1,16 @@
+import os
 import sys
 import argparse
 import urllib.parse
 import urllib.request
 
+import satCache
+import satMeta
+import satLoad
+import satMetrics
+import satProducts
+import satWriters
+
 def makeRange(rangeValue):
     rangeValue = str(rangeValue)
     rr = '[(' + rangeValue + '):(' + rangeValue + ')]'
@@ -15,7 +23,8 @@ def makeDateRange(date_start, date_end):
     return rr
 
 
-def getCHL(sensor, frequency, latitude, longitude, date_start, date_end, fout):
+@satMetrics.instrument('CHL')
+def getCHL(sensor, frequency, latitude, longitude, date_start, date_end, fout, format='csv'):
     """
     function to harvest CHL from CRW ERDDAP server
     the results are stores in a csv file
@@ -27,56 +36,57 @@ def getCHL(sensor, frequency, latitude, longitude, date_start, date_end, fout):
     :param longitude: longitude in decimal degrees
     :param date_start: start date in yyyy-mm-dd
     :param date_end: end date in yyyy-mm-dd
-    :param fout: file name for the results
-    :return: print name of the output file
+    :param fout: file name for the results. If None, the results are not written but returned as a cube
+    :param format: output format: csv, parquet, arrow or nc. The extension of fout is changed to match it
+    :return: print name of the output file, or cube of arrays if fout is None (see satLoad)
     """
 
-    serverURL = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/'
-
-    if sensor == "MODIS":
-        varNames = ['chlorophyll']
-        if frequency.upper() == "DAY":
-            productName = 'erdMH1chla1day'
-        elif frequency.upper() == "WEEK":
-            productName = 'erdMH1chla8day'
-        elif frequency.upper() == "MONTH":
-            productName = 'erdMH1chlamday'
-        else:
-            print("{}: wrong frequency".format(frequncy))
-            sys.exit()
-    elif sensor == "VIIRS":
-        varNames = ['chlor_a']
-        if frequency.upper() == "DAY":
-            productName = 'nesdisVHNSQchlaDaily'
-        elif frequency.upper() == "WEEK":
-            productName = 'nesdisVHNSQchlaWeekly'
-        elif frequency.upper() == "MONTH":
-            productName = 'nesdisVHNSQchlaMonthly'
-        else:
-            print("{}: wrong frequency".format(frequncy))
-            sys.exit()
-    else:
+    ## product code name of the sensor and frequency, see satProducts
+    sensors = {'MODIS': 'mchl', 'VIIRS': 'chl'}
+    frequencies = {'DAY': '1d', 'WEEK': '8d', 'MONTH': '1m'}
+    if sensor not in sensors:
         print("{}: Wrong sensor name ".format(sensor))
         sys.exit()
-
-    serverURL = serverURL + productName + '.csv?'
+    if frequency.upper() not in frequencies:
+        print("{}: wrong frequency".format(frequency))
+        sys.exit()
+    par = sensors[sensor] + frequencies[frequency.upper()]
+    varNames = satProducts.product(par)['variables']
+    serverURL = satProducts.datasetURL(par) + '.csv?'
 
 
     varNames_DHW = ['time',  'latitude', 'longitude']
 
+    ## clip the dates to the coverage of the dataset
+    request, grid, size = satMeta.preflight(serverURL, latitude, latitude, longitude, longitude, date_start, date_end, 0,
+                                            len(varNames))
+    if request is None:
+        satMetrics.fail('outside the coverage of the dataset')
+        print("Failed")
+        return None
+    date_start, date_end = request['date_start'], request['date_end']
+
     dateRange = makeDateRange(date_start, date_end)
-    if sensor == 'MODIS':
-        constrains = urllib.parse.quote(dateRange + makeRange(latitude) + makeRange(longitude))
-    else:
-        constrains = urllib.parse.quote(dateRange + '[(0.0):1:(0.0)]' + makeRange(latitude) + makeRange(longitude))
+    constrains = urllib.parse.quote(dateRange + satProducts.product(par)['extra'] + makeRange(latitude) +
+                                    makeRange(longitude))
     varList = varNames[0] + constrains
     for var in varNames[1:]:
         varList = varList + "," + var + constrains
     url = serverURL + varList
     try:
-        urllib.request.urlretrieve(url, fout)
-    except:
+        if fout is None:
+            ## no output file: the response is decoded in memory, see satLoad
+            return satLoad.loadURLs(url)
+        if format == 'csv':
+            satCache.fetch(url, fout)
+        else:
+            fout = os.path.splitext(fout)[0] + satWriters.FORMATS[format]
+            satWriters.convertCSV(satCache.fetch(url), fout, format)
+    except Exception as e:
+        print(e)
+        satMetrics.fail(e)
         print("Failed")
+        return None
 
     return print('Results written to {}'.format(fout))
 
@@ -91,8 +101,10 @@ if __name__ == '__main__':
     parser.add_argument('-to', dest='date_end', help='end date in yyyy-mm-dd', required=True)
     parser.add_argument('-fout', dest='fout', help='name of the output CSV file. Default CHLoutput.csv',
                         default='CHLoutput.csv', required=False)
+    parser.add_argument('-format', dest='format', help='output format: csv, parquet, arrow or nc. Default csv',
+                        choices=list(satWriters.FORMATS), default='csv', required=False)
     args = parser.parse_args()
 
-    getCHL(args.sensor, args.frequency, args.latitude, args.longitude, args.date_start, args.date_end, args.fout)
+    getCHL(args.sensor, args.frequency, args.latitude, args.longitude, args.date_start, args.date_end, args.fout, args.format)
 
 
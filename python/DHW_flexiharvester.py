@@ -1,8 +1,16 @@
+import os
 import sys
 import argparse
+import tempfile
 import urllib.parse
 
-import pandas as pd
+import satCache
+import satChunker
+import satMeta
+import satMetrics
+import satProducts
+import satStore
+import satStream
 
 def makeRange(rangeValue):
     rangeValue = str(rangeValue)
@@ -15,7 +23,8 @@ def makeDateRange(date_start, date_end):
     return rr
 
 
-def getDHW(latitude, longitude, date_start, date_end, fout):
+@satMetrics.instrument('DHW')
+def getDHW(latitude, longitude, date_start, date_end, fout, append=False, stream=False):
     """
     function to harvest DHW and related variables from CRW ERDDAP server
     the results are stores in a csv file
@@ -26,26 +35,79 @@ def getDHW(latitude, longitude, date_start, date_end, fout):
     :param date_start: start date in yyyy-mm-dd
     :param date_end: end date in yyyy-mm-dd
     :param fout: file name for the results
+    :param append: if True, only the dates after the last one stored in fout are retrieved and appended to it
+    :param stream: if True, the response is parsed and written to fout in chunks, with bounded memory.
+                   Only the first rows are returned
     :return: info about number of records found and output file name
     """
+    import pandas as pd
 
-    serverURL = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/NOAA_DHW.csv?'
+    if append and fout:
+        last = satStore.lastTime(fout)
+        if last is not None:
+            date_start = max(date_start, satStore.nextDate(last))
+            if satChunker.toDate(date_start) > satChunker.toDate(date_end):
+                print('{} is up to date'.format(fout))
+                return pd.DataFrame()
 
-    varNames = ['CRW_DHW', 'CRW_HOTSPOT', 'CRW_SST', 'CRW_SSTANOMALY']
+    ## the dhw product of satProducts, also answered by its mirrors
+    serverURL = satProducts.datasetURL('dhw') + '.csv?'
+
+    varNames = satProducts.product('dhw')['variables']
     varNames_DHW = ['time',  'latitude', 'longitude']
 
+    ## clip the dates to the coverage of the dataset
+    request, grid, size = satMeta.preflight(serverURL, latitude, latitude, longitude, longitude, date_start, date_end, 0,
+                                            len(varNames))
+    if request is None:
+        satMetrics.fail('outside the coverage of the dataset')
+        print("Failed")
+        return pd.DataFrame()
+    date_start, date_end = request['date_start'], request['date_end']
+
     dateRange = makeDateRange(date_start, date_end)
     constrains = urllib.parse.quote(dateRange + makeRange(latitude) + makeRange(longitude))
     varList = varNames[0] + constrains
     for var in varNames[1:]:
         varList = varList + "," + var + constrains
     url = serverURL + varList
+    if stream and fout:
+        try:
+            if append:
+                ## the new rows are streamed to a temporary file next to the rolling file, then appended to it
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fout)), suffix='.csv')
+                os.close(fd)
+                try:
+                    rows, df = satStream.streamCSV(satCache.fetch(url), tmp)
+                    rows = satStore.appendCSV(fout, tmp)
+                finally:
+                    os.remove(tmp)
+                print('{} new records appended to {}'.format(rows, fout))
+            else:
+                rows, df = satStream.streamCSV(satCache.fetch(url), fout)
+                print('{} records written to {}'.format(rows, fout))
+        except Exception as e:
+            print(e)
+            satMetrics.fail(e)
+            print("Failed")
+            return pd.DataFrame()
+        return df
+
     try:
-        df = pd.read_csv(url)
-    except:
+        df = pd.read_csv(satCache.fetchFile(url))
+    except Exception as e:
+        print(e)
+        satMetrics.fail(e)
         print("Failed")
-
-    if fout:
+        return pd.DataFrame()
+
+    if fout and append:
+        tmp = fout + '.new'
+        df.to_csv(tmp, index=False)
+        rows = satStore.appendCSV(fout, tmp)
+        os.remove(tmp)
+        print('{} new records appended to {}'.format(rows, fout))
+    elif fout:
         df.to_csv(fout, index=False)
         print('results written to {}'.format(fout))
 
@@ -62,11 +124,15 @@ if __name__ == '__main__':
     parser.add_argument('-from', dest='date_start', help='start date in yyyy-mm-dd', required=True)
     parser.add_argument('-to', dest='date_end', help='end date in yyyy-mm-dd', required=False)
     parser.add_argument('-fout', dest='fout', help='name of hte output CSV file', default=False, required=False)
+    parser.add_argument('-append', dest='append', help='append only the new dates to the output file. If -to is missing '
+                        'retrieve up to the last available date', action='store_true', required=False)
+    parser.add_argument('-stream', dest='stream', help='write the results to the output file in chunks, with bounded memory',
+                        action='store_true', required=False)
     args = parser.parse_args()
 
     if args.date_end == None:
-        args.date_end = args.date_start
+        args.date_end = 'last' if args.append else args.date_start
 
-    getDHW(args.latitude, args.longitude, args.date_start, args.date_end, args.fout)
+    getDHW(args.latitude, args.longitude, args.date_start, args.date_end, args.fout, args.append, args.stream)
 
 
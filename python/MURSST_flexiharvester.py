@@ -1,8 +1,16 @@
+import os
 import sys
 import argparse
 
 import urllib
 
+import satCache
+import satMeta
+import satLoad
+import satMetrics
+import satProducts
+import satWriters
+
 
 def makeRange(rangeValue):
     rangeValue = str(rangeValue)
@@ -16,7 +24,8 @@ def makeDateRange(date_start, date_end):
     return rr
 
 
-def getDHW(latitude, longitude, date_start, date_end, fout):
+@satMetrics.instrument('MURSST')
+def getDHW(latitude, longitude, date_start, date_end, fout, format='csv'):
     """
     function to harvest DHW and related variables from CRW ERDDAP server
     the results are stores in a csv file
@@ -26,14 +35,25 @@ def getDHW(latitude, longitude, date_start, date_end, fout):
     :param longitude: longitude in decimal degrees
     :param date_start: start date in yyyy-mm-dd
     :param date_end: end date in yyyy-mm-dd
-    :param fout: file name for the results
-    :return: nothing
+    :param fout: file name for the results. If None, the results are not written but returned as a cube
+    :param format: output format: csv, parquet, arrow or nc. The extension of fout is changed to match it
+    :return: cube of arrays if fout is None, see satLoad. None if it failed
     """
 
-    serverURL = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/jplMURSST41.csv?'
-    varNames = ['analysed_sst', 'analysis_error', 'mask', 'sea_ice_fraction']
+    ## the sst product of satProducts, with the mask and sea ice fraction of the same dataset
+    serverURL = satProducts.datasetURL('sst') + '.csv?'
+    varNames = satProducts.product('sst')['variables'] + ['mask', 'sea_ice_fraction']
     varNames_DHW = ['time',  'latitude', 'longitude']
 
+    ## clip the dates to the coverage of the dataset
+    request, grid, size = satMeta.preflight(serverURL, latitude, latitude, longitude, longitude, date_start, date_end, 0,
+                                            len(varNames))
+    if request is None:
+        satMetrics.fail('outside the coverage of the dataset')
+        print("Failed")
+        return None
+    date_start, date_end = request['date_start'], request['date_end']
+
     dateRange = makeDateRange(date_start, date_end)
     constrains = urllib.parse.quote(dateRange + makeRange(latitude) + makeRange(longitude))
     varList = varNames[0] + constrains
@@ -41,9 +61,19 @@ def getDHW(latitude, longitude, date_start, date_end, fout):
         varList = varList + "," + var + constrains
     url = serverURL + varList
     try:
-        urllib.request.urlretrieve(url, fout)
-    except:
+        if fout is None:
+            ## no output file: the response is decoded in memory, see satLoad
+            return satLoad.loadURLs(url)
+        if format == 'csv':
+            satCache.fetch(url, fout)
+        else:
+            fout = os.path.splitext(fout)[0] + satWriters.FORMATS[format]
+            satWriters.convertCSV(satCache.fetch(url), fout, format)
+    except Exception as e:
+        print(e)
+        satMetrics.fail(e)
         print("Failed")
+        return None
 
     return print('Results written to {}'.format(fout))
 
@@ -56,8 +86,10 @@ if __name__ == '__main__':
     parser.add_argument('-to', dest='date_end', help='end date in yyyy-mm-dd', required=True)
     parser.add_argument('-fout', dest='fout', help='name of the output CSV file. Default SSToutput.csv',
                         default='SSToutput.csv', required=False)
+    parser.add_argument('-format', dest='format', help='output format: csv, parquet, arrow or nc. Default csv',
+                        choices=list(satWriters.FORMATS), default='csv', required=False)
     args = parser.parse_args()
 
-    getDHW(args.latitude, args.longitude, args.date_start, args.date_end, args.fout)
+    getDHW(args.latitude, args.longitude, args.date_start, args.date_end, args.fout, args.format)
 
 
@@ -1,16 +1,27 @@
+import os
 import sys
 import argparse
 
 import urllib.request
 import urllib.parse
 
+import satChunker
+import satCoalesce
+import satMeta
+import satLoad
+import satMetrics
+import satProducts
+import satWriters
 
-def makeRange(startValue, endValue):
-    rr = '[(' + startValue + '):1:(' + endValue + ')]'
+
+def makeRange(startValue, endValue, stride=1):
+    rr = '[(' + str(startValue) + '):' + str(stride) + ':(' + str(endValue) + ')]'
     return rr
 
 
-def getPAR(type, minlat, minlon, maxlat, maxlon, date_start, date_end, format, fout):
+@satMetrics.instrument('PAR_grid')
+def getPAR(type, minlat, minlon, maxlat, maxlon, date_start, date_end, format, fout, max_cells=satChunker.MAX_CELLS,
+           workers=4, target_cells=None, resolution=None):
     """
     function to harvest seascape classes and related variables from ERDDAP server
     the results are stores in a csv file
@@ -20,43 +31,80 @@ def getPAR(type, minlat, minlon, maxlat, maxlon, date_start, date_end, format, f
     :param longitude: longitude in decimal degrees
     :param date_start: start date in yyyy-mm-dd
     :param date_end: end date in yyyy-mm-dd
-    :param fout: file name for the results
-    :return: nothing
+    :param format: output format: nc, csv, parquet or arrow
+    :param fout: file name for the results, without extension. If None, the results are not written but returned as a cube
+    :param max_cells: larger requests are split in time and space tiles of at most max_cells values. 0 disables the splitting
+    :param workers: number of tiles retrieved at the same time
+    :param target_cells: if given, the grid is decimated on the server to at most this number of values per variable
+    :param resolution: if given, the grid is decimated on the server to this spacing in degrees
+    :return: cube of arrays if fout is None, see satLoad. None if it failed
     """
 
-    if type == 'm':
-        serverURL = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1par01day'
-    elif type == '8d':
-        serverURL = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1par08day'
-    elif type == '1d':
-        serverURL = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1par01day'
+    ## product code name of each type, see satProducts
+    products = {'m': 'par1m', '8d': 'par8d', '1d': 'par1d'}
+    if type in products:
+        serverURL = satProducts.datasetURL(products[type])
     else:
         print("ERROR: Wrong product type. Valid products are \'m\' for monthly or \'8d\' for 8 day or \'1d\' for 1 day")
         sys.exit()
 
     if format == "nc":
         formatPrefix = ".nc?"
-    elif format == "csv":
+    elif format in satWriters.FORMATS:
+        ## parquet and arrow are converted locally from the csv response
         formatPrefix = ".csv?"
     else:
-        print("ERROR: Wrong format type. Valid formats are nc or csv")
+        print("ERROR: Wrong format type. Valid formats are nc, csv, parquet or arrow")
         sys.exit()
         
     serverURL = serverURL + formatPrefix
-    fout = fout + formatPrefix.replace("?", "")
+    if fout is not None:
+        fout = fout + satWriters.FORMATS[format]
 
     
-    varNames = ['par']
-    constrains = urllib.parse.quote(makeRange(date_start, date_end) + makeRange(minlat, maxlat) + makeRange(minlon, maxlon))
-    varList = varNames[0] + constrains
-    for var in varNames[1:]:
-        varList = varList + "," + var + constrains
-    url = serverURL + varList
+    varNames = satProducts.product(products[type])['variables']
+    ## clip the request to the coverage of the dataset, and plan the tiles with its real grid
+    request, (time_step, spacing), size = satMeta.preflight(serverURL, minlat, maxlat, minlon, maxlon, date_start,
+                                                            date_end, max_cells, len(varNames), target_cells,
+                                                            resolution)
+    if request is None:
+        satMetrics.fail('outside the coverage of the dataset')
+        print("Failed")
+        return None
+    time_stride, stride = request['time_stride'], request['stride']
+    tiles = satChunker.planTiles(request['lat_min'], request['lat_max'], request['lon_min'], request['lon_max'],
+                                 request['date_start'], request['date_end'], time_step * time_stride,
+                                 spacing * stride, max_cells)
+    urls = []
+    for tile in tiles:
+        constrains = urllib.parse.quote(makeRange(tile['date_start'], tile['date_end'], time_stride) +
+                                        makeRange(tile['lat_min'], tile['lat_max'], stride) +
+                                        makeRange(tile['lon_min'], tile['lon_max'], stride))
+        varList = varNames[0] + constrains
+        for var in varNames[1:]:
+            varList = varList + "," + var + constrains
+        urls.append(serverURL + varList)
     #print(url)
     try:
-        urllib.request.urlretrieve(url, fout)
-    except:
+        if fout is None:
+            ## no output file: the response is decoded in memory, see satLoad
+            return satLoad.loadURLs(urls, workers)
+        if len(urls) == 1:
+            ## the requests of other threads to the same dataset may be answered by a single query, see satCoalesce
+            satCoalesce.fetchFile(urls[0], fout, format)
+        elif format in ("parquet", "arrow"):
+            satChunker.stitchCSV(satChunker.fetchTiles(urls, workers), fout + '.csv')
+            satWriters.convertCSV(fout + '.csv', fout, format)
+            os.remove(fout + '.csv')
+        elif format == "nc":
+            satChunker.stitchNC(satChunker.fetchTiles(urls, workers), fout)
+        else:
+            satChunker.stitchCSV(satChunker.fetchTiles(urls, workers), fout)
+    except Exception as e:
+        print(e)
+        satMetrics.fail(e)
         print("Failed")
+        return None
 
 
     return print('Results written to {}'.format(fout))
@@ -71,11 +119,21 @@ if __name__ == '__main__':
     parser.add_argument('-maxlon', dest='maxlon', help='longitude in decimal degrees. Western hemisphere negative', required=True)
     parser.add_argument('-from', dest='date_start', help='start date in yyyy-mm-dd', required=True)
     parser.add_argument('-to', dest='date_end', help='end date in yyyy-mm-dd', required=True)
-    parser.add_argument('-format', dest='format', help='output format: nc or csv', required=True)
+    parser.add_argument('-format', dest='format', help='output format: nc, csv, parquet or arrow', required=True)
     parser.add_argument('-fout', dest='fout', help='name of the output file without extension. Default PARgrid_output',
                         default='PARgrid_output', required=False)
+    parser.add_argument('-maxcells', dest='max_cells', help='maximum number of values of a single request. Larger requests '
+                        'are split in tiles. 0 to disable. Default {}'.format(satChunker.MAX_CELLS),
+                        type=int, default=satChunker.MAX_CELLS, required=False)
+    parser.add_argument('-workers', dest='workers', help='number of tiles retrieved at the same time. Default 4',
+                        type=int, default=4, required=False)
+    parser.add_argument('-targetcells', dest='target_cells', help='decimate the grid on the server to at most this '
+                        'number of values per variable, for quick looks of large regions', type=int, required=False)
+    parser.add_argument('-resolution', dest='resolution', help='decimate the grid on the server to this spacing in '
+                        'decimal degrees', type=float, required=False)
     args = parser.parse_args()
 
-    getPAR(args.type, args.minlat, args.minlon, args.maxlat, args.maxlon, args.date_start, args.date_end, args.format, args.fout)
+    getPAR(args.type, args.minlat, args.minlon, args.maxlat, args.maxlon, args.date_start, args.date_end, args.format, args.fout,
+           args.max_cells, args.workers, args.target_cells, args.resolution)
 
 
@@ -1,8 +1,16 @@
+import os
 import sys
 import argparse
 
 import urllib
 
+import satCache
+import satMeta
+import satLoad
+import satMetrics
+import satProducts
+import satWriters
+
 
 def makeRange(rangeValue):
     rangeValue = str(rangeValue)
@@ -16,7 +24,8 @@ def makeDateRange(date_start, date_end):
     return rr
 
 
-def getDHW(type, latitude, longitude, date_start, date_end, fout):
+@satMetrics.instrument('SEASCAPE_TS')
+def getDHW(type, latitude, longitude, date_start, date_end, fout, format='csv'):
     """
     function to harvest seascape classes and related variables from ERDDAP server
     the results are stores in a csv file
@@ -26,22 +35,32 @@ def getDHW(type, latitude, longitude, date_start, date_end, fout):
     :param longitude: longitude in decimal degrees
     :param date_start: start date in yyyy-mm-dd
     :param date_end: end date in yyyy-mm-dd
-    :param fout: file name for the results
-    :return: nothing
+    :param fout: file name for the results. If None, the results are not written but returned as a cube
+    :param format: output format: csv, parquet, arrow or nc. The extension of fout is changed to match it
+    :return: cube of arrays if fout is None, see satLoad. None if it failed
     """
 
 
-    if type=='m':
-        serverURL = 'https://cwcgom.aoml.noaa.gov/erddap/griddap/noaa_aoml_4729_9ee6_ab54.csv?'
-    elif type=='8d':
-        serverURL = 'https://cwcgom.aoml.noaa.gov/erddap/griddap/noaa_aoml_seascapes_8day.csv?'
+    ## product code name of each type, see satProducts
+    products = {'m': 'ssc1m', '8d': 'ssc8d'}
+    if type in products:
+        serverURL = satProducts.datasetURL(products[type]) + '.csv?'
     else:
         print("ERROR: Wrong product type. Valid products are \'m\' for monthly or \'8d\' for 8 day")
         sys.exit()
 
-    varNames = ['CLASS', 'P']
+    varNames = satProducts.product(products[type])['variables']
     varNames_DHW = ['time',  'latitude', 'longitude']
 
+    ## clip the dates to the coverage of the dataset
+    request, grid, size = satMeta.preflight(serverURL, latitude, latitude, longitude, longitude, date_start, date_end, 0,
+                                            len(varNames))
+    if request is None:
+        satMetrics.fail('outside the coverage of the dataset')
+        print("Failed")
+        return None
+    date_start, date_end = request['date_start'], request['date_end']
+
     dateRange = makeDateRange(date_start, date_end)
     constrains = urllib.parse.quote(dateRange + makeRange(latitude) + makeRange(longitude))
     varList = varNames[0] + constrains
@@ -50,11 +69,21 @@ def getDHW(type, latitude, longitude, date_start, date_end, fout):
     url = serverURL + varList
 
     try:
-        urllib.request.urlretrieve(url, fout)
-    except:
+        if fout is None:
+            ## no output file: the response is decoded in memory, see satLoad
+            return satLoad.loadURLs(url)
+        if format == 'csv':
+            satCache.fetch(url, fout)
+        else:
+            fout = os.path.splitext(fout)[0] + satWriters.FORMATS[format]
+            satWriters.convertCSV(satCache.fetch(url), fout, format)
+    except Exception as e:
+        print(e)
+        satMetrics.fail(e)
         print("Failed")
+        return None
 
-    return print('Write {} SEASCAPE values into {}'.format(len(DHW), fout))
+    return print('Results written to {}'.format(fout))
 
 
 if __name__ == '__main__':
@@ -66,8 +95,10 @@ if __name__ == '__main__':
     parser.add_argument('-to', dest='date_end', help='end date in yyyy-mm-dd', required=True)
     parser.add_argument('-fout', dest='fout', help='name of the output CSV file. Default SEASCAPEoutput.csv',
                         default='SEASCAPEoutput.csv', required=False)
+    parser.add_argument('-format', dest='format', help='output format: csv, parquet, arrow or nc. Default csv',
+                        choices=list(satWriters.FORMATS), default='csv', required=False)
     args = parser.parse_args()
 
-    getDHW(args.type, args.latitude, args.longitude, args.date_start, args.date_end, args.fout)
+    getDHW(args.type, args.latitude, args.longitude, args.date_start, args.date_end, args.fout, args.format)
 
 
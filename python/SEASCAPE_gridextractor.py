@@ -4,13 +4,22 @@ import argparse
 import urllib.request
 import urllib.parse
 
+import satChunker
+import satCoalesce
+import satMeta
+import satLoad
+import satMetrics
+import satProducts
 
-def makeRange(startValue, endValue):
-    rr = '[(' + startValue + '):1:(' + endValue + ')]'
+
+def makeRange(startValue, endValue, stride=1):
+    rr = '[(' + str(startValue) + '):' + str(stride) + ':(' + str(endValue) + ')]'
     return rr
 
 
-def getDHW(type, minlat, minlon, maxlat, maxlon, date_start, date_end, fout):
+@satMetrics.instrument('SEASCAPE_grid')
+def getDHW(type, minlat, minlon, maxlat, maxlon, date_start, date_end, fout, max_cells=satChunker.MAX_CELLS,
+           workers=4, target_cells=None, resolution=None):
     """
     function to harvest seascape classes and related variables from ERDDAP server
     the results are stores in a csv file
@@ -20,29 +29,59 @@ def getDHW(type, minlat, minlon, maxlat, maxlon, date_start, date_end, fout):
     :param longitude: longitude in decimal degrees
     :param date_start: start date in yyyy-mm-dd
     :param date_end: end date in yyyy-mm-dd
-    :param fout: file name for the results
-    :return: nothing
+    :param fout: file name for the results. If None, the results are not written but returned as a cube
+    :param max_cells: larger requests are split in time and space tiles of at most max_cells values. 0 disables the splitting
+    :param workers: number of tiles retrieved at the same time
+    :param target_cells: if given, the grid is decimated on the server to at most this number of values per variable
+    :param resolution: if given, the grid is decimated on the server to this spacing in degrees
+    :return: cube of arrays if fout is None, see satLoad. None if it failed
     """
 
-    if type == 'm':
-        serverURL = 'https://cwcgom.aoml.noaa.gov/erddap/griddap/noaa_aoml_4729_9ee6_ab54.nc?'
-    elif type == '8d':
-        serverURL = 'https://cwcgom.aoml.noaa.gov/erddap/griddap/noaa_aoml_seascapes_8day.nc?'
+    ## product code name of each type, see satProducts
+    products = {'m': 'ssc1m', '8d': 'ssc8d'}
+    if type in products:
+        serverURL = satProducts.datasetURL(products[type]) + '.nc?'
     else:
         print("ERROR: Wrong product type. Valid products are \'m\' for monthly or \'8d\' for 8 day")
         sys.exit()
 
-    varNames = ['CLASS', 'P']
-    constrains = urllib.parse.quote(makeRange(date_start, date_end) + makeRange(minlat, maxlat) + makeRange(minlon, maxlon))
-    varList = varNames[0] + constrains
-    for var in varNames[1:]:
-        varList = varList + "," + var + constrains
-    url = serverURL + varList
+    varNames = satProducts.product(products[type])['variables']
+    ## clip the request to the coverage of the dataset, and plan the tiles with its real grid
+    request, (time_step, spacing), size = satMeta.preflight(serverURL, minlat, maxlat, minlon, maxlon, date_start,
+                                                            date_end, max_cells, len(varNames), target_cells,
+                                                            resolution)
+    if request is None:
+        satMetrics.fail('outside the coverage of the dataset')
+        print("Failed")
+        return None
+    time_stride, stride = request['time_stride'], request['stride']
+    tiles = satChunker.planTiles(request['lat_min'], request['lat_max'], request['lon_min'], request['lon_max'],
+                                 request['date_start'], request['date_end'], time_step * time_stride,
+                                 spacing * stride, max_cells)
+    urls = []
+    for tile in tiles:
+        constrains = urllib.parse.quote(makeRange(tile['date_start'], tile['date_end'], time_stride) +
+                                        makeRange(tile['lat_min'], tile['lat_max'], stride) +
+                                        makeRange(tile['lon_min'], tile['lon_max'], stride))
+        varList = varNames[0] + constrains
+        for var in varNames[1:]:
+            varList = varList + "," + var + constrains
+        urls.append(serverURL + varList)
     ##print(url)
     try:
-        urllib.request.urlretrieve(url, fout)
-    except:
+        if fout is None:
+            ## no output file: the response is decoded in memory, see satLoad
+            return satLoad.loadURLs(urls, workers)
+        if len(urls) == 1:
+            ## the requests of other threads to the same dataset may be answered by a single query, see satCoalesce
+            satCoalesce.fetchFile(urls[0], fout, 'nc')
+        else:
+            satChunker.stitchNC(satChunker.fetchTiles(urls, workers), fout)
+    except Exception as e:
+        print(e)
+        satMetrics.fail(e)
         print("Failed")
+        return None
 
 
     return print('Results written to {}'.format(fout))
@@ -59,8 +98,18 @@ if __name__ == '__main__':
     parser.add_argument('-to', dest='date_end', help='end date in yyyy-mm-dd', required=True)
     parser.add_argument('-fout', dest='fout', help='name of the output netCDF file. Default SEASCAPEgrid_output.nc',
                         default='SEASCAPEgrid_output.nc', required=False)
+    parser.add_argument('-maxcells', dest='max_cells', help='maximum number of values of a single request. Larger requests '
+                        'are split in tiles. 0 to disable. Default {}'.format(satChunker.MAX_CELLS),
+                        type=int, default=satChunker.MAX_CELLS, required=False)
+    parser.add_argument('-workers', dest='workers', help='number of tiles retrieved at the same time. Default 4',
+                        type=int, default=4, required=False)
+    parser.add_argument('-targetcells', dest='target_cells', help='decimate the grid on the server to at most this '
+                        'number of values per variable, for quick looks of large regions', type=int, required=False)
+    parser.add_argument('-resolution', dest='resolution', help='decimate the grid on the server to this spacing in '
+                        'decimal degrees', type=float, required=False)
     args = parser.parse_args()
 
-    getDHW(args.type, args.minlat, args.minlon, args.maxlat, args.maxlon, args.date_start, args.date_end, args.fout)
+    getDHW(args.type, args.minlat, args.minlon, args.maxlat, args.maxlon, args.date_start, args.date_end, args.fout,
+           args.max_cells, args.workers, args.target_cells, args.resolution)
 
 
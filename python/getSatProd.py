@@ -2,14 +2,170 @@
 
 import sys
 import os
-import traceback
-import urllib.request
+import contextlib
+import urllib.parse
+import threading
+import concurrent.futures
 import argparse
 from argparse import RawDescriptionHelpFormatter
-import pandas as pd
 
+import satProducts
+from satLazy import lazyImport
 
-def getParams(params, lat_min, lat_max, lon_min, lon_max, date_start, date_end, locality, outpath, screen_print):
+## the modules that load urllib, http and pandas are imported when first used, so the argument checks, the list of
+## products and the dry runs return in a few milliseconds
+satCache = lazyImport('satCache')
+satChunker = lazyImport('satChunker')
+satCoalesce = lazyImport('satCoalesce')
+satManifest = lazyImport('satManifest')
+satMeta = lazyImport('satMeta')
+satMetrics = lazyImport('satMetrics')
+satStore = lazyImport('satStore')
+satStream = lazyImport('satStream')
+satTransfer = lazyImport('satTransfer')
+satWriters = lazyImport('satWriters')
+
+
+## url templates of the products, see satProducts
+SOURCES = satProducts.sources()
+
+
+def makeFileName(locality, par, date_start, date_end):
+    """
+    build the name of the output file of a parameter
+    :param locality: name of the locality
+    :param par: parameter code name
+    :param date_start: start date
+    :param date_end: end date
+    :return: file name
+    """
+    return locality + "_" + par + "_" + date_start.replace("-", "") + "-" + date_end.replace("-", "") + ".csv"
+
+
+def fetchParam(par, urls, outpath, fout, screen_print, lock=None, tile_workers=1, store=None, fmt='csv',
+               partition='none', locality=None, transfer='csv', manifest=None):
+    """
+    retrieve one parameter and write it to its file.
+    The messages are collected and printed in one block, so the report of each parameter
+    stays readable when several parameters are retrieved at the same time
+    :param par: parameter code name
+    :param urls: ERDDAP request url, or list of urls of the tiles of a large request
+    :param outpath: where to write the result file
+    :param fout: name of the result csv file
+    :param screen_print: if True, results are printed to the screen
+    :param lock: optional semaphore limiting the number of simultaneous requests to the host
+    :param tile_workers: number of tiles retrieved at the same time
+    :param store: if given, the new rows are appended to this rolling file and fout is removed
+    :param fmt: output format: csv, parquet, arrow or nc
+    :param partition: none, year or month. Partitioned output is written in outpath/product=par/period=.../locality.ext
+    :param locality: name of the locality, for the partitioned output
+    :param transfer: format of the ERDDAP responses: csv or nc. nc is smaller and faster to parse
+    :param manifest: optional satManifest.Manifest of the run, updated with the state of the units and the output
+    :return: output file name (or store name, or list of partition files) or None if failed
+    """
+    if isinstance(urls, str):
+        urls = [urls]
+    messages = [par.upper()] + urls
+    result = None
+    rows = None
+    csvout = os.path.join(outpath, fout)
+    converted = fmt != 'csv' or partition not in (None, 'none')
+    with satMetrics.request(par):
+        try:
+            if len(urls) == 1:
+                if manifest is not None:
+                    manifest.unitState(par, 'running')
+                ## the response is parsed and written in chunks, so memory does not grow with the grid size
+                with lock or contextlib.nullcontext():
+                    names, units, chunks = satCoalesce.fetchTable(urls[0], transfer)
+                    if converted:
+                        rows, files = satWriters.writeChunks(names, units, chunks,
+                                                             os.path.splitext(csvout)[0] + satWriters.FORMATS[fmt],
+                                                             fmt, partition, outpath, par, locality)
+                    else:
+                        rows, df = satStream.writeCSV(names, units, chunks, csvout)
+            else:
+                if manifest is not None:
+                    ## the tiles are kept as part files until the output is written, so a resumed run skips them
+                    files = manifest.fetchUnits(par, urls, tile_workers, lock, transfer)
+                else:
+                    files = satChunker.fetchTiles(urls, tile_workers, lock, transfer)
+                rows, df = satChunker.stitchCSV(files, csvout)
+                messages.append("{} tiles stitched".format(len(urls)))
+                if converted:
+                    rows, files = satWriters.convertCSV(csvout, os.path.splitext(csvout)[0] + satWriters.FORMATS[fmt],
+                                                        fmt, partition, outpath, par, locality)
+                    os.remove(csvout)
+            if store is not None:
+                rows = satStore.appendCSV(store, csvout)
+                os.remove(csvout)
+                messages.append("{} new rows appended to {}".format(rows, os.path.basename(store)))
+                result = os.path.basename(store)
+            elif converted:
+                result = [os.path.relpath(f, outpath) for f in files]
+                messages.extend(result)
+                if len(result) == 1:
+                    result = result[0]
+            else:
+                messages.append(fout)
+                result = fout
+            if screen_print and not converted:
+                messages.append(str(df))
+            if manifest is not None:
+                if len(urls) == 1:
+                    manifest.unitState(par, 'done')
+                manifest.finish(par, outpath, result, rows)
+        except Exception as e:
+            messages.append(str(e))
+            satMetrics.fail(e)
+            if manifest is not None:
+                if len(urls) == 1:
+                    manifest.unitState(par, 'failed', str(e))
+                manifest.fail(par, e)
+            messages.append("FAILED:" + fout)
+            result = None
+
+    print("\n".join(messages), flush=True)
+    return result
+
+
+def planParam(par, lat_min, lat_max, lon_min, lon_max, date_start, date_end, max_cells=None, target_cells=None,
+              resolution=None):
+    """
+    check the request of a parameter against the coverage of its dataset and split it in tiles
+    :param par: parameter code name
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date
+    :param date_end: end date
+    :param max_cells: larger requests are split in tiles of at most max_cells values. 0 disables the splitting.
+                      Default satChunker.MAX_CELLS
+    :param target_cells: if given, the grid is decimated on the server to at most this number of values per variable
+    :param resolution: if given, the grid is decimated on the server to this spacing in degrees
+    :return: (list of request urls, clipped request, (time step, grid spacing), estimated size) or None if the
+             request is outside the coverage of the dataset
+    """
+    if max_cells is None:
+        max_cells = satChunker.MAX_CELLS
+    request, (time_step, spacing), size = satMeta.preflight(SOURCES[par], lat_min, lat_max, lon_min, lon_max,
+                                                            date_start, date_end, max_cells, None, target_cells,
+                                                            resolution)
+    if request is None:
+        return None
+    ## the tiles of a decimated request are planned on the decimated grid, so they keep the strides aligned
+    time_stride, stride = request['time_stride'], request['stride']
+    tiles = satChunker.planTiles(request['lat_min'], request['lat_max'], request['lon_min'], request['lon_max'],
+                                 request['date_start'], request['date_end'], time_step * time_stride,
+                                 spacing * stride, max_cells)
+    urls = [SOURCES[par].format(time_stride=time_stride, stride=stride, **tile) for tile in tiles]
+    return urls, request, (time_step, spacing), size
+
+
+def getParams(params, lat_min, lat_max, lon_min, lon_max, date_start, date_end, locality, outpath, screen_print,
+              workers=1, host_limit=2, max_cells=None, append=False, fmt='csv', partition='none',
+              transfer='csv', target_cells=None, resolution=None, resume=False, dry_run=False):
     """
     get satellite products from NOAAs ERDDAP servers.
     E. Klein. ekleins@gmail.com
@@ -23,118 +179,164 @@ def getParams(params, lat_min, lat_max, lon_min, lon_max, date_start, date_end,
     :param locality: name of the locality for output file naming
     :param outpath: where to wrtie the result file
     :param screen_print: if True, results are printed to the screen
-    :return: nothing
+    :param workers: number of parameters retrieved at the same time. 1 retrieves them one after the other
+    :param host_limit: maximum number of simultaneous requests to the same ERDDAP server
+    :param max_cells: larger requests are split in time and space tiles of at most max_cells values. 0 disables the splitting.
+                      Default satChunker.MAX_CELLS
+    :param append: if True, only the dates after the last one stored in locality_param.csv are retrieved and appended to it
+    :param fmt: output format: csv, parquet, arrow or nc. Values are stored as float32 and classes as int8
+    :param partition: none, year or month. Partitioned output is written in outpath/product=par/period=.../locality.ext
+    :param transfer: format of the ERDDAP responses: csv or nc. The output is the same, nc responses are smaller
+    :param target_cells: if given, the grid is decimated on the server to at most this number of values per variable
+    :param resolution: if given, the grid is decimated on the server to this spacing in degrees
+    :param resume: if True, the products and the work units done by a previous run with the same requests, as
+                   recorded in the manifest outpath/locality.key.manifest.json, are not retrieved again
+    :param dry_run: if True, the requests are planned and printed but not sent. Only the dataset metadata is read
+    :return: dictionary with the output file name of each parameter, None if it failed. For a dry run, the list of
+             request urls of each parameter
     """
-    ## SOURCES
-    sources = {
-        'sst':      "https://coastwatch.pfeg.noaa.gov/erddap/griddap/jplMURSST41.csv?"
-                    "analysed_sst[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})],"
-                    "analysis_error[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'ssta':     "https://coastwatch.pfeg.noaa.gov/erddap/griddap/jplMURSST41anom1day.csv?"
-                    "sstAnom[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'poc1d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMPOC1day.csv?"
-                    "poc[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'poc8d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMPOC8day.csv?"
-                    "poc[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'poc1m':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMPOCmday.csv?"
-                    "poc[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'pic1d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMPIC1day.csv?"
-                    "pic[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'pic8d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMPIC8day.csv?"
-                    "pic[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'pic1m':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMPICmday.csv?"
-                    "pic[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'chl1m':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/nesdisVHNSQchlaMonthly.csv?"
-                    "chlor_a[({date_start}):1:({date_end})][(0.0):1:(0.0)][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'chl8d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/nesdisVHNSQchlaWeekly.csv?"
-                    "chlor_a[({date_start}):1:({date_end})][(0.0):1:(0.0)][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'chl1d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/nesdisVHNSQchlaDaily.csv?"
-                    "chlor_a[({date_start}):1:({date_end})][(0.0):1:(0.0)][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-                    #https://coastwatch.pfeg.noaa.gov/erddap/griddap/NOAA_DHW
-        'dhw':      "https://pae-paha.pacioos.hawaii.edu/erddap/griddap/dhw_5km.csv?"
-                    "CRW_DHW[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})],"
-                    "CRW_HOTSPOT[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})],"
-                    "CRW_SST[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})],"
-                    "CRW_SSTANOMALY[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'par1d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1par01day.csv?"
-                    "par[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'par8d':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1par08day.csv?"
-                    "par[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'par1m':    "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1par0mday.csv?"
-                    "par[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'pp1d':     "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1pp1day.csv?"
-                    "productivity[({date_start}):1:({date_end})][(0.0):1:(0.0)][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'pp3d':     "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1pp3day.csv?"
-                    "productivity[({date_start}):1:({date_end})][(0.0):1:(0.0)][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'pp8d':     "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1pp8day.csv?"
-                    "productivity[({date_start}):1:({date_end})][(0.0):1:(0.0)][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'pp1m':     "https://coastwatch.pfeg.noaa.gov/erddap/griddap/erdMH1ppmday.csv?"
-                    "productivity[({date_start}):1:({date_end})][(0.0):1:(0.0)][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'ssc8d':    "https://cwcgom.aoml.noaa.gov/erddap/griddap/noaa_aoml_seascapes_8day.csv?"
-                    "CLASS[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})],"
-                    "P[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'ssc1m':    "https://cwcgom.aoml.noaa.gov/erddap/griddap/noaa_aoml_4729_9ee6_ab54.csv?"
-                    "CLASS[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})],"
-                    "P[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'prec1d':   "https://coastwatch.pfeg.noaa.gov/erddap/griddap/chirps20GlobalDailyP05.csv?"
-                    "precip[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]",
-        'prec1m':   "https://coastwatch.pfeg.noaa.gov/erddap/griddap/chirps20GlobalMonthlyP05.csv?"
-                    "precip[({date_start}):1:({date_end})][({lat_min}):1:({lat_max})][({lon_min}):1:({lon_max})]"
-    }
 
+    if append and (fmt != 'csv' or partition not in (None, 'none')):
+        raise ValueError("append mode only works with csv output without partitions")
+    if append and (target_cells or resolution):
+        raise ValueError("append mode only works with the full resolution grid")
+
+    results = {}
+    urls = {}
+    fouts = {}
+    stores = {}
+    ## every run records its work units and outputs, with their state and checksums
+    run = {'params': list(params), 'region': [lat_min, lat_max, lon_min, lon_max], 'date_start': str(date_start),
+           'date_end': str(date_end), 'append': append, 'format': fmt, 'partition': partition, 'transfer': transfer,
+           'target_cells': target_cells, 'resolution': resolution}
+    manifest = None if dry_run else satManifest.Manifest(satManifest.manifestName(outpath, locality, run), run, resume)
     for par in params:
-        print(par.upper())
-        fout = os.path.join(locality + "_" + par + "_" + date_start.replace("-", "") + "-" + date_end.replace("-", "") + ".csv")
-        url = sources[par].format(lat_min=lat_min, lat_max = lat_max,  lon_min=lon_min, lon_max=lon_max,
-                                  date_start = date_start, date_end = date_end)
-        print(url)
-        try:
-            df = pd.read_csv(url)
-            df.to_csv(os.path.join(outpath, fout), index=False)
-            print(fout)
-            if screen_print:
-                print(df)
-        except Exception as e:
-            print(e)
-            print("FAILED:" + fout)
+        if resume and manifest is not None:
+            done = manifest.isDone(par, outpath)
+            if done is not None:
+                print("{}\ndone in a previous run: {}".format(par.upper(), done), flush=True)
+                results[par] = done
+                continue
+        start = date_start
+        if append:
+            ## only the time steps after the last one stored for this locality and parameter
+            stores[par] = satStore.storeName(outpath, locality, par)
+            last = satStore.lastTime(stores[par])
+            if last is not None:
+                start = max(str(date_start), satStore.nextDate(last))
+                if satChunker.toDate(start) > satChunker.toDate(date_end):
+                    print("{}\nup to date: {}".format(par.upper(), stores[par]), flush=True)
+                    results[par] = os.path.basename(stores[par])
+                    continue
+        ## check the request against the coverage of the dataset before sending anything
+        plan = planParam(par, lat_min, lat_max, lon_min, lon_max, start, date_end, max_cells, target_cells, resolution)
+        if plan is None:
+            print("{}\nFAILED: outside the coverage of the dataset".format(par.upper()), flush=True)
+            results[par] = None
+            continue
+        urls[par], request, (time_step, spacing), size = plan
+        fouts[par] = makeFileName(locality, par, start, date_end)
+        if manifest is not None:
+            manifest.plan(par, urls[par])
+        time_stride, stride = request['time_stride'], request['stride']
+        if time_stride > 1 or stride > 1:
+            print("{}: decimated to every {} time steps and every {} grid cells ({:.3f} degrees)".format(
+                par.upper(), time_stride, stride, spacing * stride), flush=True)
+        print("{}: about {} values, {:.1f} MB in {} requests".format(par.upper(), size['cells'], size[transfer] / 1048576,
+                                                                    len(urls[par])), flush=True)
+
+    if dry_run:
+        for par in urls:
+            print("\n".join(urls[par]), flush=True)
+        return urls
 
-    return
+    ## one semaphore per ERDDAP host, so the pool never hits a single server with more than host_limit requests
+    hostLocks = {}
+    for par in urls:
+        host = urllib.parse.urlsplit(urls[par][0]).netloc
+        if host not in hostLocks:
+            hostLocks[host] = threading.BoundedSemaphore(max(1, host_limit))
+
+    if workers <= 1:
+        for par in urls:
+            lock = hostLocks[urllib.parse.urlsplit(urls[par][0]).netloc]
+            results[par] = fetchParam(par, urls[par], outpath, fouts[par], screen_print, lock, 1, stores.get(par), fmt,
+                                      partition, locality, transfer, manifest)
+    else:
+        with satCoalesce.parallel(workers), concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for par in urls:
+                lock = hostLocks[urllib.parse.urlsplit(urls[par][0]).netloc]
+                futures[pool.submit(fetchParam, par, urls[par], outpath, fouts[par], screen_print, lock, workers,
+                                    stores.get(par), fmt, partition, locality, transfer, manifest)] = par
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+
+    counts = manifest.summary()
+    print("{}: {} requests done, {} failed".format(os.path.basename(manifest.fname), counts['done'], counts['failed']),
+          flush=True)
+    return results
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Get different satellite products from NOAAs ERDDAP servers. The valid parameters are: \n"
-                                                 "- sst, ssta: MURSST cloudless sea surface temperature, and  sst anomaly  \n"
-                                                 "- poc1d, poc8d, poc1m: MODIS particulate organic cabon, 1 day, 8 day, 1 month \n"
-                                                 "- pic1d, pic8d, pic1m: MODIS particulate inorganic cabon, 1 day, 8 day, 1 month \n"
-                                                 "- chl1d, chl8d, chl1m: VIRRS chlorophyll a concetration, 1 day, 8 days, 1 month \n"
-                                                 "- dhw: coral reef watch degree heating week products \n"
-                                                 "- par1d, par8d, par1m: Total Photosynthetic Available Radiation, 1 day, 8 day, 1 month \n"
-                                                 "- pp1d, pp8d, pp1m: Primary Productivity, 1 day, 8 day, 1 month \n"
-                                                 "- ssc8d, ssc1m: Seascapes classes, 8 day, 1 month \n"
-                                                 "- prec1d: CHIRPS Total daily rainfall \n"
-                                                 "- prec1m: CHIRPS Total monthly rainfall \n"
-                                                 "NOTE: THINK before request. Do not ask for large grid over a long period of time",
+    parser = argparse.ArgumentParser(description="Get different satellite products from NOAAs ERDDAP servers. The valid parameters are: \n" +
+                                                 "".join("- {}\n".format(satProducts.describe(par)) for par in satProducts.PRODUCTS) +
+                                                 "NOTE: large grids over long periods are split in tiles of at most -maxcells values",
                                      formatter_class=RawDescriptionHelpFormatter)
-    parser.add_argument('-param', dest='param', help='code name of the parameter, like sst', nargs='+', required=True)
-    parser.add_argument('-latmin', dest='lat_min', help='start latitude in decimal degrees', required=True)
+    parser.add_argument('-param', dest='param', help='code name of the parameter, like sst', nargs='+', required=False)
+    parser.add_argument('-latmin', dest='lat_min', help='start latitude in decimal degrees', required=False)
     parser.add_argument('-latmax', dest='lat_max', help='end latitude in decimal degrees. If missing extract for start latitude only',
                         required=False)
-    parser.add_argument('-lonmin', dest='lon_min', help='start longitude in decimal degrees', required=True)
+    parser.add_argument('-lonmin', dest='lon_min', help='start longitude in decimal degrees', required=False)
     parser.add_argument('-lonmax', dest='lon_max', help='end longitude in decimal degrees. If missing extract for start longitude only',
                         required=False)
-    parser.add_argument('-ds', dest='date_start', help='start date in yyyy-mm-dd', required=True)
+    parser.add_argument('-ds', dest='date_start', help='start date in yyyy-mm-dd', required=False)
     parser.add_argument('-de', dest='date_end', help='end date in yyyy-mm-dd. If missing retrieve for start date only', required=False)
     parser.add_argument('-loc', dest='locality', help='name of the locality', default="satprod", required=False)
     parser.add_argument('-out', dest='outpath', help='path where to write the result file', default='./', required=False)
     parser.add_argument('-print', dest='screen_print', help='print the results to the screen', action='store_true',
                         required=False)
+    parser.add_argument('-workers', dest='workers', help='number of parameters retrieved at the same time. Default 1',
+                        type=int, default=1, required=False)
+    parser.add_argument('-hostlimit', dest='host_limit', help='maximum simultaneous requests to the same ERDDAP server. Default 2',
+                        type=int, default=2, required=False)
+    parser.add_argument('-maxcells', dest='max_cells', help='maximum number of values of a single request. Larger requests '
+                        'are split in tiles. 0 to disable. Default 1000000', type=int, required=False)
+    parser.add_argument('-append', dest='append', help='append only the new dates to the rolling file locality_param.csv. '
+                        'If -de is missing retrieve up to the last available date', action='store_true', required=False)
+    ## the choices are written here, the writers and transfer modules are loaded only when the products are retrieved
+    parser.add_argument('-format', dest='fmt', help='output format: csv, parquet, arrow, nc. Default csv',
+                        choices=['csv', 'parquet', 'arrow', 'nc'], default='csv', required=False)
+    parser.add_argument('-partition', dest='partition', help='split the output by product and time: none, year, month. '
+                        'Default none', choices=['none', 'year', 'month'], default='none', required=False)
+    parser.add_argument('-transfer', dest='transfer', help='format of the ERDDAP responses: csv, nc. nc is smaller and '
+                        'faster to parse, the output is the same. Default csv', choices=['csv', 'nc'], default='csv',
+                        required=False)
+    parser.add_argument('-targetcells', dest='target_cells', help='decimate the grid on the server to at most this '
+                        'number of values per variable, for quick looks of large regions', type=int, required=False)
+    parser.add_argument('-resolution', dest='resolution', help='decimate the grid on the server to this spacing in '
+                        'decimal degrees', type=float, required=False)
+    parser.add_argument('-resume', dest='resume', help='resume the previous run of the locality: only the products and '
+                        'requests missing or failed in its manifest (locality.key.manifest.json) are retrieved',
+                        action='store_true', required=False)
+    parser.add_argument('-dryrun', dest='dry_run', help='check the request against the coverage of the datasets and '
+                        'print the planned requests and their size, without retrieving them', action='store_true',
+                        required=False)
+    parser.add_argument('-list', dest='list', help='list the products and exit', action='store_true', required=False)
     args = parser.parse_args()
 
-    parameter_list = ['sst', 'ssta', 'sstclim', 'poc1d', 'poc8d', 'poc1m', 'pic1d', 'pic8d', 'pic1m', 'chl1d', 'chl8d',
-                      'chl1m', 'dhw', 'par1d', 'par8d', 'par1m', 'pp1d', 'pp8d', 'pp1m', 'ssc8d', 'ssc1m', 'prec1d', 'prec1m']
+    if args.list:
+        for par in satProducts.PRODUCTS:
+            print(satProducts.describe(par))
+        sys.exit()
+
+    missing = [option for option, value in [('-param', args.param), ('-latmin', args.lat_min),
+                                            ('-lonmin', args.lon_min), ('-ds', args.date_start)] if value is None]
+    if missing:
+        parser.error('the following arguments are required: ' + ', '.join(missing))
 
     if args.date_end == None:
-        args.date_end = args.date_start
+        args.date_end = 'last' if args.append else args.date_start
 
     if args.lat_max == None:
         args.lat_max = args.lat_min
@@ -142,13 +344,25 @@ if __name__ == '__main__':
     if args.lon_max == None:
         args.lon_max = args.lon_min
 
-    if not set(args.param).issubset(parameter_list):
-        print("Invalid parameter. See function help")
+    if args.append and (args.fmt != 'csv' or args.partition != 'none'):
+        print("-append only works with csv output without partitions")
+        sys.exit()
+
+    if args.append and (args.target_cells or args.resolution):
+        print("-append only works with the full resolution grid")
+        sys.exit()
+
+    if not set(args.param).issubset(satProducts.PRODUCTS):
+        print("Invalid parameter. Valid parameters are {}".format(', '.join(satProducts.PRODUCTS)))
         sys.exit()
 
 
     getParams(args.param, args.lat_min, args.lat_max, args.lon_min, args.lon_max, args.date_start, args.date_end,
-              args.locality, args.outpath, args.screen_print)
+              args.locality, args.outpath, args.screen_print, args.workers, args.host_limit,
+              args.max_cells, args.append, args.fmt, args.partition, args.transfer, args.target_cells, args.resolution,
+              args.resume, args.dry_run)
+    if not args.dry_run:
+        print("downloaded: " + (satTransfer.transferReport() or "nothing, all from cache"))
 
 
 
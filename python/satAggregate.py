@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import warnings
+
+import satCube
+
+## aggregation periods. doy is a day of year climatology over all the years of the cube
+PERIODS = ['week', '8day', 'month', 'season', 'year', 'doy']
+
+## statistics, all of them ignore the missing values
+STATS = ['mean', 'median', 'max', 'min', 'count']
+
+
+def periodKeys(times, period):
+    """
+    period of each time step, computed with vectorized datetime64 operations.
+    8day periods start on January 1st every year, like the 8 day composites of ERDDAP.
+    Seasons are DJF, MAM, JJA and SON, December counts in the season of the next year.
+    Weeks start on Monday
+    :param times: numpy datetime64 array
+    :param period: week, 8day, month, season, year or doy
+    :return: numpy array with the start date of the period of each time (datetime64[D]),
+             or the day of year (1 to 366) for doy
+    """
+    import numpy as np
+
+    days = times.astype('datetime64[D]')
+    if period == 'month':
+        return times.astype('datetime64[M]').astype('datetime64[D]')
+    if period == 'year':
+        return times.astype('datetime64[Y]').astype('datetime64[D]')
+    if period == 'week':
+        ## 1970-01-01 was a Thursday
+        return days - (days.astype('int64') + 3) % 7
+    if period in ('8day', 'doy'):
+        years = times.astype('datetime64[Y]').astype('datetime64[D]')
+        doy = (days - years).astype('int64')
+        if period == 'doy':
+            return doy + 1
+        return years + (doy // 8) * 8
+    if period == 'season':
+        months = times.astype('datetime64[M]').astype('int64')
+        return ((months + 1) // 3 * 3 - 1).astype('datetime64[M]').astype('datetime64[D]')
+    raise ValueError("{}: wrong period. Valid periods are {}".format(period, ', '.join(PERIODS)))
+
+
+def groupReduce(values, starts, stat):
+    """
+    reduce consecutive groups of time steps of an array, ignoring the NaN values
+    :param values: array (time, ...) sorted by group
+    :param starts: index of the first time step of each group
+    :param stat: mean, median, max, min or count
+    :return: array (group, ...)
+    """
+    import numpy as np
+
+    if stat == 'max':
+        return np.fmax.reduceat(values, starts, axis=0)
+    if stat == 'min':
+        return np.fmin.reduceat(values, starts, axis=0)
+    valid = ~np.isnan(values)
+    counts = np.add.reduceat(valid, starts, axis=0, dtype='int32')
+    if stat == 'count':
+        return counts.astype('float32')
+    if stat == 'mean':
+        sums = np.add.reduceat(np.where(valid, values, 0), starts, axis=0, dtype='float64')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts).astype('float32')
+    if stat == 'median':
+        ends = list(starts[1:]) + [len(values)]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.stack([np.nanmedian(values[a:b], axis=0) for a, b in zip(starts, ends)]).astype('float32')
+    raise ValueError("{}: wrong statistic. Valid statistics are {}".format(stat, ', '.join(STATS)))
+
+
+def aggregate(cube, period='month', stats=('mean',)):
+    """
+    aggregate a daily cube to a coarser time resolution or to a day of year climatology
+    :param cube: cube, as returned by satCube.readCube
+    :param period: week, 8day, month, season, year or doy
+    :param stats: list of statistics: mean, median, max, min or count. With more than one statistic the
+                  variables are named like variable_statistic
+    :return: aggregated cube. The time is the start of each period, or dayofyear for a climatology
+    """
+    import numpy as np
+
+    if isinstance(stats, str):
+        stats = [stats]
+    keys = periodKeys(cube['time'], period)
+    labels, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], np.arange(len(labels)))
+
+    variables = {}
+    units = {}
+    for name, values in cube['variables'].items():
+        ordered = values[order]
+        for stat in stats:
+            result = name if len(stats) == 1 else name + '_' + stat
+            variables[result] = groupReduce(ordered, starts, stat)
+            units[result] = '' if stat == 'count' else cube['units'].get(name, '')
+    result = {'latitude': cube['latitude'], 'longitude': cube['longitude'], 'variables': variables, 'units': units}
+    if period == 'doy':
+        result['dayofyear'] = labels
+    else:
+        result['time'] = labels.astype('datetime64[ns]')
+    return result
+
+
+def aggregateFile(fin, fout, period='month', stats=('mean',)):
+    """
+    aggregate a file with a daily product, as written by getSatProd or the harvesters
+    :param fin: input file: csv, parquet, arrow or nc
+    :param fout: output file. Its extension gives the format
+    :param period: week, 8day, month, season, year or doy
+    :param stats: list of statistics: mean, median, max, min or count
+    :return: (number of rows written, list of files written)
+    """
+    result = aggregate(satCube.readCube(fin), period, stats)
+    return satCube.writeCube(result, fout, time_name='dayofyear' if period == 'doy' else 'time')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Aggregate a daily product already downloaded to weekly, 8 day, '
+                                                 'monthly, seasonal or yearly values, or to a day of year climatology. '
+                                                 'The missing values are ignored')
+    parser.add_argument('-fin', dest='fin', help='input file: csv, parquet, arrow or nc, as written by getSatProd',
+                        required=True)
+    parser.add_argument('-period', dest='period', help='aggregation period: {}'.format(', '.join(PERIODS)),
+                        choices=PERIODS, required=True)
+    parser.add_argument('-stat', dest='stats', help='statistics: {}. Default mean'.format(', '.join(STATS)),
+                        choices=STATS, nargs='+', default=['mean'], required=False)
+    parser.add_argument('-fout', dest='fout', help='output file. The extension gives the format: csv, parquet, arrow '
+                        'or nc. Default input file name with the period', required=False)
+    args = parser.parse_args()
+
+    if args.fout is None:
+        name, ext = os.path.splitext(args.fin)
+        args.fout = name + '_' + args.period + ext
+
+    rows, files = aggregateFile(args.fin, args.fout, args.period, args.stats)
+    print('{} records written to {}'.format(rows, ', '.join(files)))
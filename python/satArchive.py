@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import shutil
+import datetime
+import argparse
+import tempfile
+import threading
+import concurrent.futures
+
+import satCache
+import satCube
+import satLoad
+import satLock
+import satMeta
+import satMetrics
+import satTransfer
+
+## archive location. Can be changed with the environment variable SSTTOOLS_ARCHIVE
+ARCHIVE_DIR = os.environ.get('SSTTOOLS_ARCHIVE', os.path.join(os.path.expanduser('~'), '.local', 'share', 'SSTtools',
+                                                              'archive'))
+
+## side of the spatial chunks, in grid cells of the dataset. Every chunk holds a calendar year of time steps.
+## The chunk grid of a product is fixed when its archive is created
+CHUNK_CELLS = 32
+
+_lock = threading.Lock()
+
+
+def _source(par):
+    import getSatProd
+
+    return getSatProd.SOURCES[par]
+
+
+def _indexFile(par):
+    return os.path.join(ARCHIVE_DIR, par, 'index.json')
+
+
+def readIndex(par):
+    """
+    read the index of the chunks of a product stored in the archive
+    :param par: getSatProd parameter code name
+    :return: dictionary with the chunk grid and {chunk key: {fetched, final, last, variables, units}}
+    """
+    try:
+        with open(_indexFile(par)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'grid': None, 'chunks': {}}
+
+
+def _writeIndex(par, index):
+    fname = _indexFile(par)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp, fname)
+
+
+def productGrid(par):
+    """
+    grid of the chunks of a product: origin, spacing and number of cells of the latitude and longitude of the
+    dataset, and the side of the chunks
+    :param par: getSatProd parameter code name
+    :return: dictionary, or None if the dataset metadata is not available
+    """
+    index = readIndex(par)
+    if index.get('grid'):
+        return index['grid']
+    dims = satMeta.getMeta(_source(par))
+    if not dims or any('min' not in dims.get(axis, {}) for axis in ('latitude', 'longitude')):
+        return None
+    grid = {axis: [dims[axis]['min'], dims[axis]['spacing'], dims[axis]['n']] for axis in ('latitude', 'longitude')}
+    grid['cells'] = CHUNK_CELLS
+    return grid
+
+
+def _cells(grid, axis, low, high):
+    ## range of grid cell indexes of an axis, snapped to the closest cells like ERDDAP, see satMeta.closestIndex
+    origin, spacing, n = grid[axis]
+    a, b = sorted((float(low), float(high)))
+    if spacing == 0:
+        return 0, 0
+    return (min(max(satMeta.closestIndex(a, origin, spacing), 0), n - 1),
+            min(max(satMeta.closestIndex(b, origin, spacing), 0), n - 1))
+
+
+def chunkKeys(grid, lat_min, lat_max, lon_min, lon_max, date_start, date_end):
+    """
+    keys of the chunks covering a request, like 2020/12_40 (year/latitude chunk_longitude chunk)
+    :param grid: chunk grid, as returned by productGrid
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd
+    :return: list of keys
+    """
+    size = grid['cells']
+    ya, yb = _cells(grid, 'latitude', lat_min, lat_max)
+    xa, xb = _cells(grid, 'longitude', lon_min, lon_max)
+    return ['{}/{}_{}'.format(year, i, j) for year in range(int(str(date_start)[:4]), int(str(date_end)[:4]) + 1)
+            for i in range(ya // size, yb // size + 1) for j in range(xa // size, xb // size + 1)]
+
+
+def _chunkRequest(par, grid, key):
+    ## request of a whole chunk, clipped to the coverage of the dataset
+    year, cell = key.split('/')
+    i, j = [int(v) for v in cell.split('_')]
+    size = grid['cells']
+    request = {}
+    for axis, k, low, high in (('latitude', i, 'lat_min', 'lat_max'), ('longitude', j, 'lon_min', 'lon_max')):
+        origin, spacing, n = grid[axis]
+        request[low] = round(origin + k * size * spacing, 6)
+        request[high] = round(origin + (min((k + 1) * size, n) - 1) * spacing, 6)
+    request.update(date_start='{}-01-01'.format(year), date_end='{}-12-31'.format(year))
+    dims = satMeta.getMeta(_source(par))
+    return satMeta.clipRequest(dims, **request) if dims else request
+
+
+def _isFinal(key):
+    year = int(key.split('/')[0])
+    return datetime.date(year, 12, 31) < datetime.date.today() - datetime.timedelta(days=satCache.RECENT_DAYS)
+
+
+def _chunkDir(par, key):
+    return os.path.join(ARCHIVE_DIR, par, key)
+
+
+def fetchChunk(par, grid, key):
+    """
+    download a chunk from the ERDDAP server and store it in the archive, replacing the previous copy.
+    Every coordinate and variable is a .npy file, so it can be memory-mapped
+    :param par: getSatProd parameter code name
+    :param grid: chunk grid, as returned by productGrid
+    :param key: chunk key
+    :return: index entry of the chunk
+    """
+    import numpy as np
+
+    entry = {'fetched': time.time(), 'final': _isFinal(key), 'last': None, 'variables': [], 'units': {}}
+    request = _chunkRequest(par, grid, key)
+    if request is None:
+        ## outside the coverage of the dataset: nothing to store
+        return entry
+    url = satTransfer.toFormat(_source(par).format(time_stride=1, stride=1, **request), 'nc')
+    ## the archive keeps the chunks, so the response is not kept in the cache too
+    cube = satLoad.ncCube(satLoad.response(url, cache=False))
+
+    folder = _chunkDir(par, key)
+    os.makedirs(os.path.dirname(folder), exist_ok=True)
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(folder), prefix='.tmp')
+    with satMetrics.stage('write'):
+        for axis in satCube.AXES:
+            np.save(os.path.join(tmp, axis + '.npy'), np.ascontiguousarray(cube[axis]))
+        for name, values in cube['variables'].items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(values))
+    if os.path.exists(folder):
+        old = tempfile.mkdtemp(dir=os.path.dirname(folder), prefix='.old')
+        os.replace(folder, os.path.join(old, 'chunk'))
+        os.replace(tmp, folder)
+        shutil.rmtree(old)
+    else:
+        os.replace(tmp, folder)
+    if len(cube['time']):
+        entry['last'] = str(cube['time'][-1].astype('datetime64[D]'))
+    entry['variables'] = list(cube['variables'])
+    entry['units'] = cube['units']
+    return entry
+
+
+def _isMissing(entry, date_end):
+    ## a chunk is fetched again when it is not final, the request goes beyond its last time step
+    ## and it was fetched more than REVALIDATE seconds ago
+    if entry is None:
+        return True
+    if entry['final'] or time.time() - entry['fetched'] < satCache.REVALIDATE:
+        return False
+    return entry['last'] is None or str(date_end)[:10] > entry['last']
+
+
+def update(par, grid, keys, date_end, workers=4):
+    """
+    download the chunks of a request that are missing in the archive, or that can have new time steps
+    :param par: getSatProd parameter code name
+    :param grid: chunk grid, as returned by productGrid
+    :param keys: chunk keys of the request
+    :param date_end: last date of the request
+    :param workers: number of chunks downloaded at the same time
+    :return: index of the product
+    """
+    index = readIndex(par)
+    missing = [key for key in keys if _isMissing(index['chunks'].get(key), date_end)]
+    satMetrics.add('cache_hits', len(keys) - len(missing))
+    satMetrics.add('cache_misses', len(missing))
+    if not missing:
+        return index
+    record = satMetrics.current()
+
+    def fetchOne(key):
+        with satMetrics.attach(record):
+            return key, fetchChunk(par, grid, key)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as pool:
+        for key, entry in pool.map(fetchOne, missing):
+            ## the index is written after every chunk, so an interrupted update keeps what was downloaded. It is locked
+            ## for the other threads and processes updating the archive, like the workers of satSchedule
+            with _lock, satLock.fileLock(_indexFile(par)):
+                index = readIndex(par)
+                index['grid'] = grid
+                index['chunks'][key] = entry
+                _writeIndex(par, index)
+    return index
+
+
+def readChunk(par, key, entry):
+    """
+    open a chunk of the archive. The variables are memory-mapped, only the parts used are read from disk
+    :param par: getSatProd parameter code name
+    :param key: chunk key
+    :param entry: index entry of the chunk
+    :return: cube, like satLoad.ncCube
+    """
+    import numpy as np
+
+    folder = _chunkDir(par, key)
+    cube = {axis: np.load(os.path.join(folder, axis + '.npy')) for axis in satCube.AXES}
+    cube['variables'] = {name: np.load(os.path.join(folder, name + '.npy'), mmap_mode='r')
+                         for name in entry['variables']}
+    cube['units'] = dict(entry['units'])
+    return cube
+
+
+def query(par, lat_min, lat_max, lon_min, lon_max, date_start, date_end=None, fout=None, workers=4):
+    """
+    get a getSatProd parameter from the local archive. Only the chunks that are missing (or recent enough to have
+    new time steps) are downloaded from the server, the rest is read from the memory-mapped chunks.
+    The positions are snapped to the nearest grid cells, so a single position gives the series of its cell
+    :param par: getSatProd parameter code name, like sst or dhw
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd. Default: start date
+    :param fout: optional output file, also written. The extension gives the format: csv, parquet, arrow or nc
+    :param workers: number of chunks downloaded at the same time
+    :return: cube, like satLoad.loadCube, or None if there are no data
+    """
+    import numpy as np
+
+    date_end = date_end or date_start
+    with satMetrics.request(par):
+        grid = productGrid(par)
+        if grid is None:
+            satMetrics.fail('no metadata')
+            print('WARNING: no metadata for {}, it cannot be archived'.format(par))
+            return None
+        keys = chunkKeys(grid, lat_min, lat_max, lon_min, lon_max, date_start, date_end)
+        index = update(par, grid, keys, date_end, workers)
+
+        bounds = {'time': (np.datetime64(str(date_start)[:10], 'ns'),
+                           np.datetime64(str(date_end)[:10], 'D') + np.timedelta64(1, 'D') - np.timedelta64(1, 'ns'))}
+        for axis, low, high in (('latitude', lat_min, lat_max), ('longitude', lon_min, lon_max)):
+            origin, spacing, n = grid[axis]
+            a, b = _cells(grid, axis, low, high)
+            bounds[axis] = (origin + a * spacing - spacing / 4, origin + b * spacing + spacing / 4)
+        pieces = []
+        with satMetrics.stage('parse'):
+            for key in keys:
+                entry = index['chunks'].get(key)
+                if entry is None or not entry['variables']:
+                    continue
+                piece = satCube.sliceCube(readChunk(par, key, entry), bounds)
+                if all(len(piece[axis]) for axis in satCube.AXES):
+                    pieces.append(piece)
+        if not pieces:
+            satMetrics.fail('no data')
+            print('WARNING: no data of {} in the archive for this request'.format(par))
+            return None
+        cube = satLoad.mergeCubes(pieces)
+        if fout:
+            satCube.writeCube(cube, fout)
+    return cube
+
+
+def series(par, latitude, longitude, date_start, date_end=None, workers=4):
+    """
+    time series of a getSatProd parameter at a position, from the local archive
+    :param par: getSatProd parameter code name
+    :param latitude: latitude in decimal degrees
+    :param longitude: longitude in decimal degrees
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd. Default: start date
+    :param workers: number of chunks downloaded at the same time
+    :return: pandas data frame with time, latitude, longitude and the variables of the nearest grid cell, or None
+    """
+    cube = query(par, latitude, latitude, longitude, longitude, date_start, date_end, None, workers)
+    return None if cube is None else satLoad.cubeFrame(cube)
+
+
+def status():
+    """
+    products stored in the archive
+    :return: list of (product, number of chunks, first year, last date, size in bytes)
+    """
+    result = []
+    if not os.path.isdir(ARCHIVE_DIR):
+        return result
+    for par in sorted(os.listdir(ARCHIVE_DIR)):
+        chunks = readIndex(par)['chunks']
+        if not chunks:
+            continue
+        size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(os.path.join(ARCHIVE_DIR, par))
+                   for f in files)
+        last = max((entry['last'] for entry in chunks.values() if entry['last']), default=None)
+        result.append((par, len(chunks), min(key.split('/')[0] for key in chunks), last, size))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the local archive of the getSatProd products. Only the '
+                                                 'chunks missing in the archive are downloaded')
+    parser.add_argument('-param', dest='param', help='code name of the parameter, like sst. See getSatProd.py',
+                        required=False)
+    parser.add_argument('-lat', dest='lat', help='latitude, or latitude min and max', type=float, nargs='+',
+                        required=False)
+    parser.add_argument('-lon', dest='lon', help='longitude, or longitude min and max', type=float, nargs='+',
+                        required=False)
+    parser.add_argument('-ds', dest='date_start', help='start date in yyyy-mm-dd', required=False)
+    parser.add_argument('-de', dest='date_end', help='end date in yyyy-mm-dd. If missing retrieve for start date only',
+                        required=False)
+    parser.add_argument('-fout', dest='fout', help='output file. The extension gives the format: csv, parquet, arrow '
+                        'or nc. If missing the first rows are printed', required=False)
+    parser.add_argument('-workers', dest='workers', help='number of chunks downloaded at the same time. Default 4',
+                        type=int, default=4, required=False)
+    parser.add_argument('-status', dest='status', help='list the products stored in the archive', action='store_true',
+                        required=False)
+    args = parser.parse_args()
+
+    if args.status:
+        print('archive: {}'.format(ARCHIVE_DIR))
+        for par, chunks, first, last, size in status():
+            print('{:<8} {:>6} chunks  {} to {}  {:.1f} MB'.format(par, chunks, first, last, size / 1048576))
+    elif args.param and args.lat and args.lon and args.date_start:
+        lat, lon = args.lat * (3 - len(args.lat)), args.lon * (3 - len(args.lon))
+        cube = query(args.param, lat[0], lat[1], lon[0], lon[1], args.date_start, args.date_end, args.fout,
+                     args.workers)
+        if cube is not None and args.fout:
+            print('results written to {}'.format(args.fout))
+        elif cube is not None:
+            print(satLoad.cubeFrame(cube))
+    else:
+        parser.error('give -param, -lat, -lon and -ds, or -status')
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import json
+import argparse
+import concurrent.futures
+
+import satCache
+import satChunker
+import satMeta
+import satMetrics
+from getSatProd import SOURCES, makeFileName
+
+## default side of the block of grid cells grouped in a single request
+BOX_CELLS = 10
+
+
+def readSites(fname):
+    """
+    read a list of sites from a CSV or GeoJSON file.
+    The CSV needs the columns site (or name), lat (or latitude) and lon (or longitude).
+    The GeoJSON needs Point features, the name of the site is taken from the site or name property
+    :param fname: CSV or GeoJSON file
+    :return: list of (site, latitude, longitude)
+    """
+    sites = []
+    if fname.lower().endswith(('.geojson', '.json')):
+        with open(fname) as f:
+            features = json.load(f).get('features', [])
+        for i, feature in enumerate(features):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') != 'Point':
+                continue
+            props = feature.get('properties') or {}
+            name = props.get('site', props.get('name', 'site{}'.format(i + 1)))
+            lon, lat = geometry['coordinates'][:2]
+            sites.append((str(name), float(lat), float(lon)))
+    else:
+        with open(fname, newline='') as f:
+            for i, row in enumerate(csv.DictReader(f)):
+                row = {k.strip().lower(): v for k, v in row.items()}
+                name = row.get('site', row.get('name', 'site{}'.format(i + 1)))
+                lat = row.get('lat', row.get('latitude'))
+                lon = row.get('lon', row.get('longitude'))
+                sites.append((str(name).strip(), float(lat), float(lon)))
+    return sites
+
+
+def siteGrid(dims, spacing):
+    """
+    grid of the latitude and longitude of a product, to snap the sites
+    :param dims: dataset dimensions, as returned by satMeta.getMeta
+    :param spacing: grid spacing in degrees, used with the origin 0 when the metadata is not available
+    :return: dictionary {axis: (origin, spacing)}
+    """
+    return {axis: satMeta.gridAxis(dims, axis) or (0.0, spacing) for axis in ('latitude', 'longitude')}
+
+
+def snapSites(sites, grid):
+    """
+    snap the sites to the native grid of a product: every site goes to the grid cell ERDDAP gives for its position,
+    see satMeta.closestIndex
+    :param sites: list of (site, latitude, longitude)
+    :param grid: dictionary {axis: (origin, spacing)} of the latitude and longitude, see siteGrid
+    :return: dictionary {(lat index, lon index): [sites in the cell]}
+    """
+    cells = {}
+    for site in sites:
+        cell = (satMeta.closestIndex(site[1], *grid['latitude']), satMeta.closestIndex(site[2], *grid['longitude']))
+        cells.setdefault(cell, []).append(site)
+    return cells
+
+
+def groupCells(cells, box_cells=BOX_CELLS):
+    """
+    group the occupied grid cells in blocks of box_cells x box_cells cells. Every block becomes a single request
+    covering only the bounding box of its sites
+    :param cells: dictionary {(lat index, lon index): [sites]} as returned by snapSites
+    :param box_cells: side of the blocks in grid cells. 1 requests every cell separately
+    :return: list of boxes, dictionaries with lat_min, lat_max, lon_min, lon_max and sites
+    """
+    box_cells = max(1, int(box_cells))
+    blocks = {}
+    for cell, sites in cells.items():
+        block = (cell[0] // box_cells, cell[1] // box_cells)
+        blocks.setdefault(block, []).extend(sites)
+    boxes = []
+    for block in sorted(blocks):
+        sites = blocks[block]
+        lats = [site[1] for site in sites]
+        lons = [site[2] for site in sites]
+        boxes.append(dict(lat_min=min(lats), lat_max=max(lats), lon_min=min(lons), lon_max=max(lons), sites=sites))
+    return boxes
+
+
+def splitSites(fname, sites, date_start, date_end, par, outpath, grid=None):
+    """
+    split the response of a box in the time series of each site. Each site takes the values of its nearest grid cell
+    :param fname: ERDDAP csv response of the box
+    :param sites: list of (site, latitude, longitude) inside the box
+    :param date_start: start date, for the file names
+    :param date_end: end date, for the file names
+    :param par: parameter code name, for the file names
+    :param outpath: where to write the result files
+    :param grid: optional grid of the product, see siteGrid. The cell of a site is then the one of snapSites
+    :return: list of output file names
+    """
+    import numpy as np
+    import pandas as pd
+
+    units = pd.read_csv(fname, nrows=1, dtype=str)
+    df = pd.read_csv(fname, skiprows=[1], dtype=str)
+    lat = pd.to_numeric(df['latitude']).to_numpy()
+    lon = pd.to_numeric(df['longitude']).to_numpy()
+    lats = np.unique(lat)
+    lons = np.unique(lon)
+
+    fouts = []
+    def nearest(values, target, axis):
+        if grid is not None:
+            index = [satMeta.closestIndex(value, *grid[axis]) for value in values]
+            cell = satMeta.closestIndex(target, *grid[axis])
+            if cell in index:
+                return values[index.index(cell)]
+        return values[np.argmin(np.abs(values - target))]
+
+    for name, site_lat, site_lon in sites:
+        cell_lat = nearest(lats, site_lat, 'latitude')
+        cell_lon = nearest(lons, site_lon, 'longitude')
+        rows = df[(lat == cell_lat) & (lon == cell_lon)]
+        fout = makeFileName(name, par, date_start, date_end)
+        pd.concat([units, rows], ignore_index=True).to_csv(os.path.join(outpath, fout), index=False)
+        fouts.append(fout)
+    return fouts
+
+
+def getSites(par, sites, date_start, date_end, outpath, box_cells=BOX_CELLS, workers=2):
+    """
+    extract the time series of a product for many sites with as few requests as possible.
+    Sites in the same grid cell are retrieved once and nearby sites are grouped in small bounding boxes.
+    The results are written in a separate file per site, named like the getSatProd files
+    :param par: getSatProd parameter code name, like sst or dhw
+    :param sites: list of (site, latitude, longitude), or name of a CSV or GeoJSON file with the sites
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd
+    :param outpath: where to write the result files
+    :param box_cells: side of the blocks of grid cells grouped in a request
+    :param workers: number of requests sent at the same time
+    :return: dictionary with the output file name of each site, None if it failed
+    """
+    if isinstance(sites, str):
+        sites = readSites(sites)
+    template = SOURCES[par]
+    dims = satMeta.getMeta(template)
+    time_step, spacing = satMeta.datasetSpacing(dims, satChunker.gridSpacing(template))
+    request_start, request_end = date_start, date_end
+    if dims:
+        ## clip the dates to the coverage of the dataset
+        request = satMeta.clipRequest(dims, None, None, None, None, date_start, date_end)
+        if request is None:
+            print("{}: outside the time coverage of the dataset".format(par.upper()))
+            return {site[0]: None for site in sites}
+        request_start, request_end = request['date_start'], request['date_end']
+    grid = siteGrid(dims, spacing)
+    cells = snapSites(sites, grid)
+    boxes = groupCells(cells, box_cells)
+    print("{}: {} sites, {} grid cells, {} requests".format(par.upper(), len(sites), len(cells), len(boxes)))
+
+    urls = [template.format(lat_min=box['lat_min'], lat_max=box['lat_max'], lon_min=box['lon_min'],
+                            lon_max=box['lon_max'], date_start=request_start, date_end=request_end,
+                            time_stride=1, stride=1) for box in boxes]
+    results = {}
+
+    def fetch(url):
+        ## the downloads of the worker threads add to the record of the parameter
+        with satMetrics.attach(record):
+            return satCache.fetchFile(url)
+
+    with satMetrics.request(par) as record, concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(fetch, url) for url in urls]
+        for box, url, future in zip(boxes, urls, futures):
+            try:
+                fouts = splitSites(future.result(), box['sites'], date_start, date_end, par, outpath, grid)
+                for site, fout in zip(box['sites'], fouts):
+                    results[site[0]] = fout
+                    print(fout)
+            except Exception as e:
+                print(url)
+                print(e)
+                satMetrics.fail(e)
+                for site in box['sites']:
+                    results[site[0]] = None
+                    print("FAILED:" + site[0])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the time series of satellite products for a list of sites. '
+                                                 'Sites in the same grid cell are retrieved once and nearby sites are '
+                                                 'grouped in a single request. One file is written per site and product')
+    parser.add_argument('-param', dest='param', help='code name of the parameters, like sst or dhw. See getSatProd.py',
+                        nargs='+', required=True)
+    parser.add_argument('-sites', dest='sites', help='CSV (site, lat, lon columns) or GeoJSON (Point features) file',
+                        required=True)
+    parser.add_argument('-from', dest='date_start', help='start date in yyyy-mm-dd', required=True)
+    parser.add_argument('-to', dest='date_end', help='end date in yyyy-mm-dd. If missing retrieve for start date only',
+                        required=False)
+    parser.add_argument('-out', dest='outpath', help='path where to write the result files', default='./', required=False)
+    parser.add_argument('-boxcells', dest='box_cells', help='side, in grid cells, of the blocks grouped in a single '
+                        'request. Default {}'.format(BOX_CELLS), type=int, default=BOX_CELLS, required=False)
+    parser.add_argument('-workers', dest='workers', help='number of requests sent at the same time. Default 2',
+                        type=int, default=2, required=False)
+    args = parser.parse_args()
+
+    if args.date_end == None:
+        args.date_end = args.date_start
+
+    sites = readSites(args.sites)
+    for par in args.param:
+        getSites(par, sites, args.date_start, args.date_end, args.outpath, args.box_cells, args.workers)
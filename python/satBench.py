@@ -0,0 +1,688 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import io
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import http.server
+import urllib.parse
+import multiprocessing
+from queue import Empty
+
+## ERDDAP servers replaced by the mock server during the benchmarks
+HOSTS = ['https://coastwatch.pfeg.noaa.gov', 'https://upwell.pfeg.noaa.gov', 'https://pae-paha.pacioos.hawaii.edu',
+         'https://cwcgom.aoml.noaa.gov']
+
+## grid of the datasets served by the mock server: (spacing in degrees, time step in days, extra dimension).
+## The other datasets are served on a 0.05 degrees daily grid
+DATASETS = {
+    'jplMURSST41': (0.01, 1, None),
+    'jplMURSST41anom1day': (0.01, 1, None),
+    'NOAA_DHW': (0.05, 1, None),
+    'dhw_5km': (0.05, 1, None),
+    'nesdisVHNSQchlaDaily': (0.0375, 1, 'altitude'),
+    'nesdisVHNSQchlaWeekly': (0.0375, 8, 'altitude'),
+    'nesdisVHNSQchlaMonthly': (0.0375, 30, 'altitude'),
+    'erdMH1par01day': (1 / 24, 1, None),
+    'erdMH1par08day': (1 / 24, 8, None),
+    'noaa_aoml_seascapes_8day': (0.05, 8, None),
+    'noaa_aoml_4729_9ee6_ab54': (0.05, 30, None),
+}
+COVERAGE = ('2003-01-01', '2020-12-31')
+
+## benchmark scenarios: lists of (name, module, function, arguments, outputs). The output files are written in a
+## temporary directory. outputs are the rows every job must give, by file name (None for the returned cube): the
+## tools print their errors and return, so a job that does not write them has failed
+POINT = (-18.5, 147.5)
+SCENARIOS = {
+    'point': [
+        ('getSatProd', 'getSatProd', 'getParams',
+         (['sst', 'chl1d', 'dhw', 'ssc8d'], POINT[0], POINT[0], POINT[1], POINT[1], '2019-01-01', '2019-12-31',
+          'bench', '.', False),
+         {'bench_sst_20190101-20191231.csv': 365, 'bench_chl1d_20190101-20191231.csv': 365,
+          'bench_dhw_20190101-20191231.csv': 365, 'bench_ssc8d_20190101-20191231.csv': 47}),
+        ('MURSST', 'MURSST_flexiharvester', 'getDHW', (POINT[0], POINT[1], '2019-01-01', '2019-12-31', 'mursst.csv'),
+         {'mursst.csv': 365}),
+        ('CHL', 'CHL_flexiharvester', 'getCHL', ('VIIRS', 'DAY', POINT[0], POINT[1], '2019-01-01', '2019-12-31',
+                                                 'chl.csv'), {'chl.csv': 365}),
+        ('DHW', 'DHW_flexiharvester', 'getDHW', (POINT[0], POINT[1], '2019-01-01', '2019-12-31', 'dhw.csv'),
+         {'dhw.csv': 365}),
+        ('SEASCAPE_TS', 'SEASCAPE_TSextractor', 'getDHW', ('8d', POINT[0], POINT[1], '2019-01-01', '2019-12-31',
+                                                          'seascape.csv'), {'seascape.csv': 47}),
+    ],
+    'small-grid': [
+        ('getSatProd', 'getSatProd', 'getParams',
+         (['sst'], -19.0, -18.0, 147.0, 148.0, '2019-01-01', '2019-01-10', 'bench', '.', False),
+         {'bench_sst_20190101-20190110.csv': 102010}),
+        ('getSatProd-nc', 'getSatProd', 'getParams',
+         (['sst'], -19.0, -18.0, 147.0, 148.0, '2019-01-01', '2019-01-10', 'bench', '.', False, 1, 2, 0, False,
+          'csv', 'none', 'nc'), {'bench_sst_20190101-20190110.csv': 102010}),
+        ('PAR_grid', 'PAR_gridextractor', 'getPAR', ('1d', -19.0, 147.0, -18.0, 148.0, '2019-01-01', '2019-01-31',
+                                                     'csv', 'par'), {'par.csv': 19375}),
+        ('satLoad', 'satLoad', 'loadCube', ('sst', -19.0, -18.0, 147.0, 148.0, '2019-01-01', '2019-01-10'),
+         {None: 102010}),
+        ('SEASCAPE_grid', 'SEASCAPE_gridextractor', 'getDHW', ('8d', -19.0, 147.0, -18.0, 148.0, '2019-01-01',
+                                                               '2019-12-31', 'seascape'), {'seascape': 20727}),
+    ],
+    'large-grid': [
+        ('getSatProd', 'getSatProd', 'getParams',
+         (['sst'], -20.0, -17.0, 146.0, 149.0, '2019-01-01', '2019-01-20', 'bench', '.', False, 2, 2, 1000000),
+         {'bench_sst_20190101-20190120.csv': 1812020}),
+        ('getSatProd-nc', 'getSatProd', 'getParams',
+         (['sst'], -20.0, -17.0, 146.0, 149.0, '2019-01-01', '2019-01-20', 'bench', '.', False, 2, 2, 1000000,
+          False, 'parquet', 'none', 'nc'), {'bench_sst_20190101-20190120.parquet': 1812020}),
+        ('PAR_grid', 'PAR_gridextractor', 'getPAR', ('1d', -22.0, 145.0, -16.0, 151.0, '2019-01-01', '2019-03-31',
+                                                     'nc', 'par', 1000000), {'par.nc': 1892250}),
+    ],
+}
+
+## consistency checks: the optimized paths must give the same cells as the plain requests. Every case of the
+## coalescing check is a list of satLoad.loadCube arguments (par, lat_min, lat_max, lon_min, lon_max, date_start,
+## date_end, resolution) loaded at the same time by different threads, so that their requests are merged, and then
+## one by one. The ends half way between two grid values and the strides on different grid values are included
+COALESCE_CASES = [
+    [('sst', -19.0, -18.5, 147.0, 147.5, '2019-01-01', '2019-01-03', 0.03),
+     ('sst', -18.99, -18.49, 147.01, 147.51, '2019-01-01', '2019-01-03', 0.03)],
+    [('sst', -19.0, -18.5, 147.0, 147.5, '2019-01-01', '2019-01-03', 0.03),
+     ('sst', -18.97, -18.47, 147.03, 147.53, '2019-01-01', '2019-01-03', 0.03)],
+    [('dhw', -19.0, -18.5, 147.0, 147.5, '2019-01-01', '2019-01-03', None),
+     ('dhw', -18.6, -18.6, 147.3, 147.3, '2019-01-01', '2019-01-03', None)],
+    [('dhw', -19.01, -18.51, 147.01, 147.51, '2019-01-01', '2019-01-03', None),
+     ('dhw', -18.61, -18.61, 147.31, 147.31, '2019-01-01', '2019-01-03', None),
+     ('dhw', -18.74, -18.26, 147.22, 147.68, '2019-01-01', '2019-01-03', None)],
+]
+
+## cases of the archive check: satArchive.query arguments (par, lat_min, lat_max, lon_min, lon_max, date_start,
+## date_end), compared with satLoad.loadCube
+ARCHIVE_CASES = [
+    ('dhw', -18.52, -18.3, 147.3, 147.56, '2019-12-20', '2020-01-10'),
+    ('dhw', -19.0, -18.5, 147.0, 147.5, '2019-06-01', '2019-06-03'),
+    ('dhw', -18.6, -18.6, 147.3, 147.3, '2019-06-01', '2019-06-03'),
+    ('dhw', -18.85, -18.35, 147.15, 147.25, '2019-06-01', '2019-06-03'),
+    ('sst', -18.505, -18.3, 147.295, 147.5, '2019-06-01', '2019-06-02'),
+]
+
+## seconds a job or a check may run before it is stopped and reported as failed
+JOB_TIMEOUT = 3600
+
+## last lines of the output of a failed job or check added to its error, as the tools print their errors
+LOG_LINES = 10
+
+## a job is a regression if it is slower, uses more memory or downloads more than the baseline by this fraction
+TOLERANCE = 0.25
+
+_ncLock = threading.Lock()
+
+_CONSTRAINT = re.compile(r'\[\(([^)]*)\)(?::(\d+))?:\(([^)]*)\)\]|\[\(([^)]*)\)\]')
+
+
+def _axis(start, stop, stride, origin, spacing):
+    ## values of a grid axis between two constraints, on the grid origin + i * spacing. Like ERDDAP, the
+    ## constraints are taken to the closest grid value
+    import numpy as np
+    import satMeta
+
+    first = satMeta.closestIndex(min(start, stop), origin, spacing)
+    last = satMeta.closestIndex(max(start, stop), origin, spacing)
+    values = np.round(origin + np.arange(first, last + 1) * spacing, 6)
+    if start > stop:
+        values = values[::-1]
+    return values[::stride]
+
+
+def _days(value):
+    import numpy as np
+
+    return (np.datetime64(value[:10], 'D') - np.datetime64('1970-01-01', 'D')).astype(int)
+
+
+def synthResponse(dataset, query, fmt):
+    """
+    synthetic ERDDAP griddap response of a query, with a smooth field that changes with the time and position
+    :param dataset: dataset ID
+    :param query: griddap query, like analysed_sst[(2020-01-01):1:(2020-01-02)][(-18.0):1:(-17.0)][(147.0):1:(148.0)]
+    :param fmt: csv or nc
+    :return: (body as bytes, number of rows)
+    """
+    import numpy as np
+    import pandas as pd
+
+    spacing, step, extra = DATASETS.get(dataset, (0.05, 1, None))
+    query = urllib.parse.unquote(query)
+    variables = re.findall(r'(\w+)((?:\[[^\]]*\])+)', query)
+    constraints = []
+    for match in _CONSTRAINT.finditer(variables[0][1]):
+        start, stride, stop, single = match.groups()
+        constraints.append((single, 1, single) if single is not None else (start, int(stride or 1), stop))
+
+    t0, tstride, t1 = constraints[0]
+    origin = _days(COVERAGE[0])
+    days = _axis(_days(t0), _days(t1), tstride, origin, step).astype(int)
+    time = days.astype('datetime64[D]')
+    axes = [('time', time)]
+    if extra:
+        axes.append((extra, np.array([float(constraints[1][0])])))
+    lat0, stride, lat1 = constraints[-2]
+    axes.append(('latitude', _axis(float(lat0), float(lat1), stride, -89.99 if spacing == 0.01 else -90 + spacing / 2,
+                                   spacing)))
+    lon0, stride, lon1 = constraints[-1]
+    axes.append(('longitude', _axis(float(lon0), float(lon1), stride, -179.99 if spacing == 0.01 else
+                                    -180 + spacing / 2, spacing)))
+
+    grids = np.meshgrid(*[values for name, values in axes], indexing='ij')
+    coords = dict(zip([name for name, values in axes], grids))
+    season = np.cos(2 * np.pi * (coords['time'] - np.datetime64('2000-01-01')).astype(int) / 365.25)
+    data = {}
+    for i, (name, constraint) in enumerate(variables):
+        if name in ('CLASS', 'mask'):
+            data[name] = (np.abs(coords['latitude'] * 7 + coords['longitude'] * 3).astype(int) % 30 + 1).astype('int8')
+        else:
+            data[name] = (26 + 2 * season - 0.1 * np.abs(coords['latitude'] + 18) + 0.01 * i).astype('float32')
+
+    if fmt == 'nc':
+        import xarray as xr
+
+        ds = xr.Dataset({name: ([n for n, v in axes], values) for name, values in data.items()},
+                        coords={name: values.astype('datetime64[ns]') if name == 'time' else values
+                                for name, values in axes})
+        ## the HDF5 library is not thread safe
+        with _ncLock, tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, 'response.nc')
+            ds.to_netcdf(fname)
+            with open(fname, 'rb') as f:
+                return f.read(), grids[0].size
+
+    table = {name: values.ravel() for name, values in coords.items()}
+    table['time'] = np.char.add(np.datetime_as_string(table['time'], unit='D'), 'T00:00:00Z')
+    table.update({name: values.ravel() for name, values in data.items()})
+    out = io.StringIO()
+    names = list(table)
+    out.write(','.join(names) + '\n')
+    out.write(','.join({'time': 'UTC', 'latitude': 'degrees_north', 'longitude': 'degrees_east'}.get(name, '')
+                       for name in names) + '\n')
+    pd.DataFrame(table).to_csv(out, header=False, index=False)
+    return out.getvalue().encode(), grids[0].size
+
+
+def infoPage(dataset):
+    """
+    ERDDAP info page (json) of a dataset served by the mock server
+    :param dataset: dataset ID
+    :return: body as bytes
+    """
+    spacing, step, extra = DATASETS.get(dataset, (0.05, 1, None))
+    start, end = [_days(d) * 86400 for d in COVERAGE]
+    lat = 89.99 if spacing == 0.01 else 90 - spacing / 2
+    lon = 179.99 if spacing == 0.01 else 180 - spacing / 2
+    rows = [['dimension', 'time', '', 'double', 'nValues={}'.format((end - start) // (step * 86400) + 1)],
+            ['attribute', 'time', 'actual_range', 'double', '{}, {}'.format(start, end)]]
+    if extra:
+        rows += [['dimension', extra, '', 'double', 'nValues=1'],
+                 ['attribute', extra, 'actual_range', 'double', '0.0, 0.0']]
+    rows += [['dimension', 'latitude', '', 'double', 'nValues={}'.format(int(round(2 * lat / spacing)) + 1)],
+             ['attribute', 'latitude', 'actual_range', 'double', '{}, {}'.format(-lat, lat)],
+             ['dimension', 'longitude', '', 'double', 'nValues={}'.format(int(round(2 * lon / spacing)) + 1)],
+             ['attribute', 'longitude', 'actual_range', 'double', '{}, {}'.format(-lon, lon)]]
+    return json.dumps({'table': {'columnNames': ['Row Type', 'Variable Name', 'Attribute Name', 'Data Type', 'Value'],
+                                 'rows': rows}}).encode()
+
+
+class MockERDDAP:
+    """
+    local stand-in of an ERDDAP server, serving synthetic griddap responses (csv or nc) and info pages, or the
+    recorded responses of a directory (files named like the dataset ID and the format: jplMURSST41.csv).
+    Every response waits latency seconds before starting and is sent at most at bandwidth bytes per second
+    """
+    def __init__(self, latency=0.0, bandwidth=None, responses=None, port=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.responses = responses
+        self.requests = 0
+        self.bytes = 0
+        self.rows = 0
+        self._lock = threading.Lock()
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                mock._serve(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def _body(self, path, query):
+        match = re.match(r'^/erddap/info/([^/]+)/index\.json$', path)
+        if match:
+            return infoPage(match.group(1)), 0
+        match = re.match(r'^/erddap/griddap/([^/.]+)\.(csv|nc)$', path)
+        if match is None:
+            return None, 0
+        dataset, fmt = match.groups()
+        if self.responses:
+            fname = os.path.join(self.responses, dataset + '.' + fmt)
+            if os.path.exists(fname):
+                with open(fname, 'rb') as f:
+                    return f.read(), 0
+        return synthResponse(dataset, query, fmt)
+
+    def _serve(self, handler):
+        parts = urllib.parse.urlsplit(handler.path)
+        time.sleep(self.latency)
+        try:
+            body, rows = self._body(parts.path, parts.query)
+        except Exception as e:
+            print('mock ERDDAP: {}: {!r}'.format(handler.path, e), file=sys.stderr)
+            handler.send_error(400, str(e))
+            return
+        if body is None:
+            handler.send_error(404)
+            return
+        handler.send_response(200)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        block = 65536
+        for start in range(0, len(body), block):
+            handler.wfile.write(body[start:start + block])
+            if self.bandwidth:
+                time.sleep(min(block, len(body) - start) / self.bandwidth)
+        with self._lock:
+            self.requests += 1
+            self.bytes += len(body)
+            self.rows += rows
+
+    def counters(self):
+        """
+        :return: (requests, bytes and rows served so far)
+        """
+        with self._lock:
+            return self.requests, self.bytes, self.rows
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _timeParsers(totals):
+    ## add the time spent decoding the responses (pandas csv reader and the netCDF decoder) to totals['parse']
+    import pandas as pd
+    import satTransfer
+
+    def timed(iterator):
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                totals['parse'] += time.perf_counter() - started
+                return
+            totals['parse'] += time.perf_counter() - started
+            yield item
+
+    readCSV = pd.read_csv
+
+    def read_csv(*args, **kwargs):
+        started = time.perf_counter()
+        result = readCSV(*args, **kwargs)
+        totals['parse'] += time.perf_counter() - started
+        if kwargs.get('chunksize') or kwargs.get('iterator'):
+            return timed(iter(result))
+        return result
+
+    readNC = satTransfer.readNC
+
+    def readNCTimed(*args, **kwargs):
+        names, units, chunks = readNC(*args, **kwargs)
+        return names, units, timed(chunks)
+
+    pd.read_csv = read_csv
+    satTransfer.readNC = readNCTimed
+
+
+def _peakMemory():
+    ## peak resident memory of this process in MB. ru_maxrss is kept across exec on Linux, so it would include the
+    ## memory of the parent process
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1048576 if sys.platform == 'darwin' else 1024)
+
+
+def _rows(fname):
+    ## rows of an output file: the lines of a csv file without the names and units, the cells of a netCDF file
+    if fname.endswith('.csv'):
+        with open(fname, 'rb') as f:
+            return sum(1 for line in f) - 2
+    if fname.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        return pq.ParquetFile(fname).metadata.num_rows
+    import netCDF4
+
+    with netCDF4.Dataset(fname) as nc:
+        return next(var.size for name, var in nc.variables.items()
+                    if name not in nc.dimensions and var.dimensions[:1] == ('time',))
+
+
+def checkOutputs(outputs, directory, value=None):
+    """
+    check the results of a job
+    :param outputs: rows expected by file name, None for the returned cube, see SCENARIOS
+    :param directory: directory of the output files
+    :param value: value returned by the job
+    :return: None if all the outputs have the rows expected, or the problems as text
+    """
+    problems = []
+    for fname, expected in outputs.items():
+        name = fname or 'result'
+        try:
+            if fname is None:
+                rows = next(iter(value['variables'].values())).size if isinstance(value, dict) else None
+            else:
+                rows = _rows(os.path.join(directory, fname)) if os.path.exists(os.path.join(directory, fname)) \
+                    else None
+        except Exception as e:
+            problems.append('{}: {!r}'.format(name, e))
+            continue
+        if rows is None:
+            problems.append('{}: missing'.format(name))
+        elif rows != expected:
+            problems.append('{}: {} rows, expected {}'.format(name, rows, expected))
+    return '; '.join(problems) or None
+
+
+def _redirect(log):
+    ## send the output of a job or check process to its log file, line by line so it is kept if the process dies
+    sys.stdout = sys.stderr = open(log, 'w', buffering=1)
+
+
+def _withLog(error, log, lines=LOG_LINES):
+    ## error of a failed job or check with the last lines of its output
+    try:
+        with open(log, errors='replace') as f:
+            tail = [line.rstrip() for line in f if line.strip()][-lines:]
+    except OSError:
+        tail = []
+    return error + ('. Output: ' + ' | '.join(tail) if tail else '')
+
+
+def _newLog(name):
+    fd, log = tempfile.mkstemp(prefix='satBench.{}.'.format(name), suffix='.log')
+    os.close(fd)
+    return log
+
+
+def _runJob(job, server, queue, log):
+    ## run a benchmark job in a new process, with a cold cache, and report its times and peak memory
+    import importlib
+
+    name, module, function, args, outputs = job
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['SSTTOOLS_CACHE'] = os.path.join(tmp, 'cache')
+        os.environ['SSTTOOLS_MIRRORS'] = 'off'
+        os.chdir(tmp)
+        _redirect(log)
+        import satHTTP
+
+        satHTTP.STAND_INS.update({host: server for host in HOSTS})
+        totals = {'parse': 0.0}
+        _timeParsers(totals)
+        started = time.perf_counter()
+        error = None
+        try:
+            value = getattr(importlib.import_module(module), function)(*args)
+        except Exception as e:
+            error = repr(e)
+        seconds = time.perf_counter() - started
+        if error is None:
+            error = checkOutputs(outputs, tmp, value)
+        output = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(tmp)
+                     if not root.startswith(os.path.join(tmp, 'cache')) for f in files)
+    peak = _peakMemory()
+    queue.put({'seconds': seconds, 'parse': totals['parse'], 'peak_mb': peak, 'output_bytes': output,
+               'error': error})
+
+
+def _sameCube(a, b):
+    ## check if two cubes have the same coordinates and values, the missing values included
+    import numpy as np
+
+    if a is None or b is None:
+        return a is b
+    return all(np.array_equal(a[axis], b[axis]) for axis in ('time', 'latitude', 'longitude')) and \
+        sorted(a['variables']) == sorted(b['variables']) and \
+        all(np.array_equal(a['variables'][name], b['variables'][name], equal_nan=True) for name in a['variables'])
+
+
+def checkCoalesce(cases=COALESCE_CASES):
+    """
+    compare the parts of the coalesced queries with the separate requests, cell for cell
+    :param cases: lists of satLoad.loadCube arguments loaded at the same time, see COALESCE_CASES
+    :return: list of mismatches, as text
+    """
+    import concurrent.futures
+    import satCoalesce
+    import satLoad
+
+    def load(args):
+        par, lat_min, lat_max, lon_min, lon_max, date_start, date_end, resolution = args
+        return satLoad.loadCube(par, lat_min, lat_max, lon_min, lon_max, date_start, date_end, workers=1,
+                                resolution=resolution)
+
+    mismatches = []
+    for case in cases:
+        satCoalesce.ENABLED = True
+        with satCoalesce.parallel(len(case)), concurrent.futures.ThreadPoolExecutor(max_workers=len(case)) as pool:
+            merged = list(pool.map(load, case))
+        satCoalesce.ENABLED = False
+        for args, cube in zip(case, merged):
+            if not _sameCube(cube, load(args)):
+                mismatches.append('coalesce: {}'.format(args))
+    satCoalesce.ENABLED = True
+    return mismatches
+
+
+def checkArchive(cases=ARCHIVE_CASES):
+    """
+    compare the queries of the local archive with the same requests loaded from the server, cell for cell
+    :param cases: satArchive.query arguments, see ARCHIVE_CASES
+    :return: list of mismatches, as text
+    """
+    import satArchive
+    import satLoad
+
+    mismatches = []
+    for args in cases:
+        if not _sameCube(satArchive.query(*args), satLoad.loadCube(*args)):
+            mismatches.append('archive: {}'.format(args))
+    return mismatches
+
+
+## consistency checks run by -check, see COALESCE_CASES and ARCHIVE_CASES
+CHECKS = {'coalesce': checkCoalesce, 'archive': checkArchive}
+
+
+def _runCheck(name, server, queue, log):
+    ## run a consistency check in a new process, with a cold cache
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['SSTTOOLS_CACHE'] = os.path.join(tmp, 'cache')
+        os.environ['SSTTOOLS_ARCHIVE'] = os.path.join(tmp, 'archive')
+        os.environ['SSTTOOLS_MIRRORS'] = 'off'
+        os.chdir(tmp)
+        _redirect(log)
+        import satHTTP
+
+        satHTTP.STAND_INS.update({host: server for host in HOSTS})
+        try:
+            mismatches = CHECKS[name]()
+        except Exception as e:
+            mismatches = ['{}: failed: {!r}'.format(name, e)]
+    queue.put(mismatches)
+
+
+def _wait(process, queue, timeout):
+    ## result sent by a job or check process, and the error if it crashed, failed or did not end in timeout seconds
+    deadline = time.time() + timeout
+    result = error = None
+    while time.time() < deadline:
+        alive = process.is_alive()
+        try:
+            result = queue.get(timeout=1)
+            break
+        except Empty:
+            if not alive:
+                break
+    else:
+        process.terminate()
+        error = 'no result after {} s'.format(timeout)
+    process.join()
+    if error is None and process.exitcode:
+        error = 'exit code {}'.format(process.exitcode)
+    elif error is None and result is None:
+        error = 'no result'
+    return result, error
+
+
+def runChecks(mock, names=None):
+    """
+    run the consistency checks against a mock server, each one in a new process
+    :param mock: running MockERDDAP
+    :param names: names of the checks, see CHECKS. Default all
+    :return: list of mismatches, as text
+    """
+    context = multiprocessing.get_context('spawn')
+    mismatches = []
+    for name in names or list(CHECKS):
+        queue = context.Queue()
+        log = _newLog(name)
+        process = context.Process(target=_runCheck, args=(name, mock.url, queue, log))
+        process.start()
+        result, error = _wait(process, queue, JOB_TIMEOUT)
+        mismatches += ['{}: failed: {}'.format(name, _withLog(error, log))] if error else result
+        os.remove(log)
+    return mismatches
+
+
+def runScenario(scenario, mock):
+    """
+    run the jobs of a scenario against a mock server, each one in a new process
+    :param scenario: point, small-grid or large-grid
+    :param mock: running MockERDDAP
+    :return: dictionary {job name: metrics}
+    """
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for job in SCENARIOS[scenario]:
+        queue = context.Queue()
+        before = mock.counters()
+        log = _newLog(job[0])
+        process = context.Process(target=_runJob, args=(job, mock.url, queue, log))
+        process.start()
+        result, error = _wait(process, queue, JOB_TIMEOUT)
+        if error:
+            result = dict(result or {'seconds': 0, 'parse': 0, 'peak_mb': 0, 'output_bytes': 0}, error=error)
+        if result['error']:
+            result['error'] = _withLog(result['error'], log)
+        os.remove(log)
+        requests, nbytes, rows = [b - a for a, b in zip(before, mock.counters())]
+        result.update({'requests': requests, 'bytes': nbytes, 'rows': rows,
+                       'rows_per_s': rows / result['seconds'] if result['seconds'] else 0,
+                       'mb_per_s': nbytes / 1048576 / result['seconds'] if result['seconds'] else 0})
+        results[job[0]] = result
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    compare the results of a run with a baseline
+    :param results: {scenario: {job: metrics}}
+    :param baseline: results of a previous run
+    :param tolerance: fraction of increase allowed
+    :return: list of regressions, as text
+    """
+    regressions = []
+    for scenario, jobs in results.items():
+        for job, metrics in jobs.items():
+            base = baseline.get(scenario, {}).get(job)
+            if base is None:
+                continue
+            if metrics['error'] and not base.get('error'):
+                regressions.append('{}/{}: failed: {}'.format(scenario, job, metrics['error']))
+            for metric in ('seconds', 'peak_mb', 'bytes', 'requests'):
+                if base.get(metric) and metrics[metric] > base[metric] * (1 + tolerance):
+                    regressions.append('{}/{}: {} {:.4g} > {:.4g}'.format(scenario, job, metric, metrics[metric],
+                                                                          base[metric]))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the SSTtools against a local mock ERDDAP server, with '
+                                                 'synthetic or recorded responses. Every job runs in a new process '
+                                                 'with a cold cache')
+    parser.add_argument('-scenario', dest='scenarios', nargs='+', choices=list(SCENARIOS),
+                        help='scenarios: {}. Default all'.format(', '.join(SCENARIOS)), required=False)
+    parser.add_argument('-latency', dest='latency', help='seconds before each response starts. Default 0.05',
+                        type=float, default=0.05, required=False)
+    parser.add_argument('-bandwidth', dest='bandwidth', help='MB per second of each response. Default no limit',
+                        type=float, required=False)
+    parser.add_argument('-responses', dest='responses', help='directory with recorded responses, named like the '
+                        'dataset ID and format (jplMURSST41.csv). Default synthetic responses', required=False)
+    parser.add_argument('-baseline', dest='baseline', help='json file with the results of a previous run. The '
+                        'benchmark fails if any job is slower, uses more memory or downloads more', required=False)
+    parser.add_argument('-tolerance', dest='tolerance', help='fraction of increase allowed over the baseline. '
+                        'Default {}'.format(TOLERANCE), type=float, default=TOLERANCE, required=False)
+    parser.add_argument('-save', dest='save', help='json file to save the results', required=False)
+    parser.add_argument('-check', dest='check', help='run the consistency checks ({}) instead of the benchmark: the '
+                        'optimized paths must give the same cells as the plain requests'.format(', '.join(CHECKS)),
+                        action='store_true', required=False)
+    args = parser.parse_args()
+
+    mock = MockERDDAP(args.latency, args.bandwidth * 1048576 if args.bandwidth else None, args.responses)
+    if args.check:
+        mismatches = runChecks(mock)
+        mock.stop()
+        for mismatch in mismatches:
+            print('MISMATCH: ' + mismatch)
+        print('{} mismatches'.format(len(mismatches)))
+        sys.exit(1 if mismatches else 0)
+    results = {}
+    print('{:<12} {:<16} {:>8} {:>8} {:>6} {:>10} {:>9} {:>10} {:>8} {:>9}'.format(
+        'scenario', 'job', 'seconds', 'parse', 'reqs', 'rows', 'MB', 'rows/s', 'MB/s', 'peak MB'))
+    for scenario in args.scenarios or list(SCENARIOS):
+        results[scenario] = runScenario(scenario, mock)
+        for job, m in results[scenario].items():
+            print('{:<12} {:<16} {:>8.2f} {:>8.2f} {:>6} {:>10} {:>9.2f} {:>10.0f} {:>8.2f} {:>9.1f}{}'.format(
+                scenario, job, m['seconds'], m['parse'], m['requests'], m['rows'], m['bytes'] / 1048576,
+                m['rows_per_s'], m['mb_per_s'], m['peak_mb'], '  FAILED: ' + m['error'] if m['error'] else ''),
+                flush=True)
+    mock.stop()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+    if any(m['error'] for jobs in results.values() for m in jobs.values()):
+        sys.exit(1)
@@ -0,0 +1,325 @@
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import atexit
+import datetime
+import threading
+import urllib.parse
+import urllib.error
+
+import satLock
+import satMetrics
+from satLazy import lazyImport
+
+## urllib and http are loaded with the first request
+satHTTP = lazyImport('satHTTP')
+
+## cache location and budget. Can be changed with the environment variables
+## SSTTOOLS_CACHE (directory, or "off" to disable the cache) and SSTTOOLS_CACHE_SIZE (MB)
+CACHE_DIR = os.environ.get('SSTTOOLS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'SSTtools'))
+CACHE_SIZE = int(float(os.environ.get('SSTTOOLS_CACHE_SIZE', 2048)) * 1024 * 1024)
+
+## requests ending more than RECENT_DAYS ago are considered final and never expire.
+## Recent days can still be reprocessed by the provider, so they are revalidated after REVALIDATE seconds
+RECENT_DAYS = 30
+REVALIDATE = 6 * 3600
+
+_lock = threading.Lock()
+_keyLocks = {}
+
+## bytes downloaded from the servers in this session, by response format (csv, nc, ...)
+TRANSFERRED = {}
+
+
+def countBytes(url, nbytes):
+    """
+    add the bytes of a response to the session totals by response format
+    :param url: request url, its extension gives the format
+    :param nbytes: number of bytes received
+    """
+    fmt = os.path.splitext(urllib.parse.urlsplit(url).path)[1].lstrip('.') or 'other'
+    with _lock:
+        TRANSFERRED[fmt] = TRANSFERRED.get(fmt, 0) + nbytes
+    satMetrics.add('bytes', nbytes)
+
+
+def isEnabled():
+    """
+    check if the cache is enabled
+    :return: True if enabled
+    """
+    return CACHE_DIR.lower() not in ('off', 'none', '0', '')
+
+
+def normalizeURL(url):
+    """
+    normalize an ERDDAP request, so the same query written in different ways maps to the same cache entry
+    :param url: ERDDAP request url
+    :return: normalized url
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    query = urllib.parse.unquote(parts.query).replace(' ', '')
+    path = urllib.parse.unquote(parts.path)
+    return parts.scheme.lower() + '://' + parts.netloc.lower() + path + '?' + query
+
+
+def cacheKey(url):
+    """
+    key of the cache entry of a request
+    :param url: ERDDAP request url
+    :return: hex digest of the normalized url
+    """
+    return hashlib.sha256(normalizeURL(url).encode('utf-8')).hexdigest()
+
+
+def queryEndDate(url):
+    """
+    get the latest date requested in the time constraint of an ERDDAP query
+    :param url: ERDDAP request url
+    :return: datetime.date or None if there is no time constraint or it is relative (like last)
+    """
+    query = urllib.parse.unquote(urllib.parse.urlsplit(url).query)
+    dates = re.findall(r'\((\d{4}-\d{2}-\d{2})[^)]*\)', query)
+    if not dates or 'last' in query:
+        return None
+    return max(datetime.date.fromisoformat(d) for d in dates)
+
+
+def isFinal(url, recent_days=RECENT_DAYS):
+    """
+    check if the requested period is old enough to never change
+    :param url: ERDDAP request url
+    :param recent_days: number of days before today that are still revalidated
+    :return: True if the response never expires
+    """
+    date_end = queryEndDate(url)
+    if date_end is None:
+        return False
+    return date_end < datetime.date.today() - datetime.timedelta(days=recent_days)
+
+
+def _paths(key):
+    return os.path.join(CACHE_DIR, key + '.data'), os.path.join(CACHE_DIR, key + '.json')
+
+
+def _readMeta(metaFile):
+    try:
+        with open(metaFile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _writeMeta(metaFile, meta):
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, metaFile)
+
+
+def _deliver(dataFile, fout):
+    ## the last access is kept in the time of the meta file: the time of the data file is the time it was downloaded,
+    ## used to know if the files derived from it are up to date
+    os.utime(dataFile[:-len('.data')] + '.json')
+    if fout:
+        with satMetrics.stage('write'):
+            shutil.copyfile(dataFile, fout)
+        return fout
+    return dataFile
+
+
+def _keyLock(key):
+    with _lock:
+        return _keyLocks.setdefault(key, threading.Lock())
+
+
+def _fileLock(key, blocking=True):
+    ## lock of an entry shared by the processes using the cache, like the jobs of satSchedule or the runs of cron.
+    ## The keys share 256 lock files, kept in CACHE_DIR/locks
+    return satLock.fileLock(os.path.join(CACHE_DIR, 'locks', key[:2]), blocking)
+
+
+def download(url, fout):
+    """
+    download an url into a file without using the cache
+    :param url: url
+    :param fout: output file name
+    :return: output file name
+    """
+    headers, nbytes = satHTTP.download(url, fout)
+    countBytes(url, nbytes)
+    return fout
+
+
+def fetch(url, fout=None):
+    """
+    get the response of an ERDDAP request from the local cache, downloading it only when needed.
+    Responses for past periods never expire, recent ones are revalidated with the server
+    :param url: ERDDAP request url
+    :param fout: if given, the response is copied to this file
+    :return: name of the file with the response. With the cache disabled and no fout, the url itself
+    """
+    if not isEnabled():
+        if fout:
+            return download(url, fout)
+        return url
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    key = cacheKey(url)
+    with _keyLock(key), _fileLock(key):
+        return _fetch(url, key, fout)
+
+
+def _fetch(url, key, fout):
+    dataFile, metaFile = _paths(key)
+    meta = _readMeta(metaFile)
+    if meta is not None and os.path.exists(dataFile):
+        if meta['final'] or time.time() - meta['fetched'] < REVALIDATE:
+            satMetrics.add('cache_hits')
+            return _deliver(dataFile, fout)
+    else:
+        meta = None
+
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    ## a broken download of a past period is kept and continued on the next run, as the response never changes.
+    ## The entry is locked, so only one process at a time writes to the part file
+    partFile = dataFile + '.part'
+    final = isFinal(url)
+    try:
+        responseHeaders, nbytes = satHTTP.download(url, partFile, headers, resume=final and meta is None)
+    except urllib.error.HTTPError as e:
+        _dropPart(partFile, final)
+        if e.code == 304 and meta is not None:
+            meta['fetched'] = time.time()
+            meta['final'] = final
+            _writeMeta(metaFile, meta)
+            satMetrics.add('cache_revalidated')
+            return _deliver(dataFile, fout)
+        raise
+    except urllib.error.URLError:
+        _dropPart(partFile, final)
+        if meta is not None:
+            print('WARNING: server not available, using cached response of {}'.format(url))
+            satMetrics.add('cache_hits')
+            return _deliver(dataFile, fout)
+        raise
+    except BaseException:
+        _dropPart(partFile, final)
+        raise
+    os.replace(partFile, dataFile)
+
+    satMetrics.add('cache_misses')
+    countBytes(url, nbytes)
+    meta = {'url': normalizeURL(url),
+            'fetched': time.time(),
+            'final': final,
+            'size': os.path.getsize(dataFile),
+            'etag': responseHeaders.get('ETag'),
+            'last_modified': responseHeaders.get('Last-Modified')}
+    _writeMeta(metaFile, meta)
+    evict(keep=key)
+    return _deliver(dataFile, fout)
+
+
+def _dropPart(partFile, keep):
+    if not keep and os.path.exists(partFile):
+        os.remove(partFile)
+
+
+def fetchFile(url):
+    """
+    like fetch, but always returns a local file. With the cache disabled the response is downloaded
+    to a temporary file removed at exit
+    :param url: ERDDAP request url
+    :return: name of the file with the response
+    """
+    if isEnabled():
+        return fetch(url)
+    fd, fname = tempfile.mkstemp(suffix=os.path.splitext(urllib.parse.urlsplit(url).path)[1])
+    os.close(fd)
+    atexit.register(lambda: os.path.exists(fname) and os.remove(fname))
+    return download(url, fname)
+
+
+def entries():
+    """
+    list the cache entries, least recently used first. The size includes the meta file, the files derived from
+    the response, like the csv decoded from a netCDF response, and the downloads not finished yet
+    :return: list of (last access time, size, key)
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    found = {}
+    for name in os.listdir(CACHE_DIR):
+        if '.data' not in name and not name.endswith('.json'):
+            continue
+        try:
+            st = os.stat(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            continue
+        key = name.split('.')[0]
+        mtime, size = found.get(key, (0, 0))
+        found[key] = (max(mtime, st.st_mtime), size + st.st_size)
+    return sorted((mtime, size, key) for key, (mtime, size) in found.items())
+
+
+def evict(max_bytes=None, keep=None):
+    """
+    remove the least recently used entries until the cache fits in its byte budget
+    :param max_bytes: byte budget. Default CACHE_SIZE
+    :param keep: key of an entry that must not be removed, like the one just downloaded
+    :return: number of bytes freed
+    """
+    if max_bytes is None:
+        max_bytes = CACHE_SIZE
+    freed = 0
+    with _lock:
+        cached = entries()
+        total = sum(size for _, size, _ in cached)
+        for _, size, key in cached:
+            if total <= max_bytes:
+                break
+            if key == keep or (key in _keyLocks and _keyLocks[key].locked()):
+                ## never remove a response that is being downloaded
+                continue
+            with _fileLock(key, blocking=False) as locked:
+                if not locked:
+                    ## downloaded or read by another process
+                    continue
+                dataFile, metaFile = _paths(key)
+                derived = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR)
+                           if name.startswith(key + '.data.')]
+                for fileName in [dataFile, metaFile] + derived:
+                    try:
+                        os.remove(fileName)
+                    except FileNotFoundError:
+                        pass
+            total -= size
+            freed += size
+    return freed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the local cache of ERDDAP responses. Location: {}'.format(CACHE_DIR))
+    parser.add_argument('-size', dest='size', help='print the number of entries and the size of the cache', action='store_true',
+                        required=False)
+    parser.add_argument('-clear', dest='clear', help='remove all the cache entries', action='store_true', required=False)
+    args = parser.parse_args()
+
+    if args.clear:
+        print('{} bytes removed'.format(evict(0)))
+    if args.size or not args.clear:
+        cached = entries()
+        print('{} entries, {:.1f} MB of {:.1f} MB'.format(len(cached), sum(c[1] for c in cached) / 1048576,
+                                                          CACHE_SIZE / 1048576))
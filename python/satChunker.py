@@ -0,0 +1,263 @@
+import os
+import math
+import datetime
+import contextlib
+import urllib.parse
+import concurrent.futures
+
+import satCache
+import satMetrics
+import satProducts
+import satStream
+import satTransfer
+
+## approximate grid of each dataset: (time step in days, grid spacing in degrees), from the product registry
+GRID_SPACING = satProducts.gridSpacing()
+
+## target number of values (time x lat x lon) of a single ERDDAP request
+MAX_CELLS = 1000000
+
+## names of the dimension columns in the ERDDAP csv responses
+DIMENSIONS = ['time', 'altitude', 'zlev', 'depth', 'latitude', 'longitude']
+
+
+def datasetID(url):
+    """
+    get the dataset id from an ERDDAP griddap url
+    :param url: ERDDAP request url
+    :return: dataset id
+    """
+    path = urllib.parse.urlsplit(url).path
+    return os.path.splitext(path.rstrip('/').split('/')[-1])[0]
+
+
+def gridSpacing(url):
+    """
+    get the time step and the grid spacing of the dataset of an ERDDAP request
+    :param url: ERDDAP request url
+    :return: (time step in days, spacing in degrees). Defaults to a daily 0.01 degree grid if the dataset is unknown
+    """
+    return GRID_SPACING.get(datasetID(url), (1, 0.01))
+
+
+def toDate(value):
+    """
+    convert an ERDDAP time constraint to a date. Relative values like last or now are taken as today
+    :param value: date in yyyy-mm-dd, optionally with the time part
+    :return: datetime.date
+    """
+    try:
+        return datetime.date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return datetime.date.today()
+
+
+def gridSize(lat_min, lat_max, lon_min, lon_max, date_start, date_end, time_step=1, spacing=0.01):
+    """
+    number of time steps and grid cells of a request
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd
+    :param time_step: time step of the dataset in days
+    :param spacing: grid spacing of the dataset in degrees
+    :return: (time steps, latitudes, longitudes)
+    """
+    n_lat = int(round(abs(float(lat_max) - float(lat_min)) / spacing)) + 1
+    n_lon = int(round(abs(float(lon_max) - float(lon_min)) / spacing)) + 1
+    n_time = max(0, (toDate(date_end) - toDate(date_start)).days) // time_step + 1
+    return n_time, n_lat, n_lon
+
+
+def chooseStrides(n_time, n_lat, n_lon, spacing=0.01, target_cells=None, resolution=None):
+    """
+    choose the ERDDAP strides of a decimated request. With a target resolution the grid is decimated in space only.
+    With a target number of values the decimation is shared between time and space, without going below
+    one time step or one grid cell
+    :param n_time: number of time steps of the full request
+    :param n_lat: number of latitudes of the full request
+    :param n_lon: number of longitudes of the full request
+    :param spacing: grid spacing of the dataset in degrees
+    :param target_cells: maximum number of values of the decimated grid
+    :param resolution: target grid spacing in degrees
+    :return: (time stride, space stride)
+    """
+    time_stride, stride = 1, 1
+    if resolution:
+        stride = max(1, int(round(float(resolution) / spacing)))
+    if target_cells:
+        def size(t, s):
+            return math.ceil(n_time / t) * math.ceil(n_lat / s) * math.ceil(n_lon / s)
+
+        factor = size(time_stride, stride) / float(target_cells)
+        if factor > 1 and n_time > 1:
+            time_stride = min(n_time, max(1, int(math.ceil(factor ** (1 / 3)))))
+        while size(time_stride, stride) > target_cells and stride < max(n_lat, n_lon):
+            stride += 1
+        while size(time_stride, stride) > target_cells and time_stride < n_time:
+            time_stride += 1
+    return time_stride, stride
+
+
+def _splitAxis(start, end, spacing, cells):
+    """
+    split a coordinate range in consecutive pieces of a given number of grid cells.
+    The direction of the range (ascending or descending) is kept
+    """
+    n = int(round(abs(end - start) / spacing)) + 1
+    if n <= cells:
+        return [(start, end)]
+    step = spacing if end >= start else -spacing
+    pieces = []
+    for i in range(0, n, cells):
+        last = min(i + cells, n) - 1
+        pieces.append((round(start + i * step, 6), round(start + last * step, 6) if last < n - 1 else end))
+    return pieces
+
+
+def planTiles(lat_min, lat_max, lon_min, lon_max, date_start, date_end, time_step=1, spacing=0.01, max_cells=MAX_CELLS):
+    """
+    split a grid request in time and space tiles of at most max_cells values.
+    Time is split first. Space is split only when a single time step is larger than max_cells.
+    The tiles do not overlap: each one ends one grid cell (or one day) before the next one starts
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd
+    :param time_step: time step of the dataset in days
+    :param spacing: grid spacing of the dataset in degrees
+    :param max_cells: maximum number of values of a tile. 0 or None disables the splitting
+    :return: list of dictionaries with lat_min, lat_max, lon_min, lon_max, date_start, date_end
+    """
+    whole = dict(lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max,
+                 date_start=date_start, date_end=date_end)
+    lat_min, lat_max, lon_min, lon_max = float(lat_min), float(lat_max), float(lon_min), float(lon_max)
+    day_start = toDate(date_start)
+    day_end = toDate(date_end)
+
+    n_time, n_lat, n_lon = gridSize(lat_min, lat_max, lon_min, lon_max, date_start, date_end, time_step, spacing)
+    if not max_cells or n_lat * n_lon * n_time <= max_cells:
+        return [whole]
+
+    cells_step = n_lat * n_lon
+    if cells_step <= max_cells:
+        lat_pieces = [(whole['lat_min'], whole['lat_max'])]
+        lon_pieces = [(whole['lon_min'], whole['lon_max'])]
+        steps = max_cells // cells_step
+    else:
+        side = max(1, int(math.sqrt(max_cells)))
+        lat_pieces = _splitAxis(lat_min, lat_max, spacing, side)
+        lon_pieces = _splitAxis(lon_min, lon_max, spacing, max(1, max_cells // min(side, n_lat)))
+        steps = 1
+
+    days = steps * time_step
+    time_pieces = []
+    day = day_start
+    while day <= day_end:
+        last = min(day + datetime.timedelta(days=days - 1), day_end)
+        time_pieces.append((day.isoformat(), last.isoformat()))
+        day = last + datetime.timedelta(days=1)
+    if len(time_pieces) == 1:
+        time_pieces = [(date_start, date_end)]
+
+    tiles = []
+    for ds, de in time_pieces:
+        for la0, la1 in lat_pieces:
+            for lo0, lo1 in lon_pieces:
+                tiles.append(dict(lat_min=la0, lat_max=la1, lon_min=lo0, lon_max=lo1, date_start=ds, date_end=de))
+    return tiles
+
+
+def fetchTiles(urls, workers=4, lock=None, transfer=None):
+    """
+    retrieve the tiles of a request in parallel
+    :param urls: list of ERDDAP request urls, one per tile
+    :param workers: number of tiles retrieved at the same time
+    :param lock: optional semaphore limiting the number of simultaneous requests to the host
+    :param transfer: None to keep the format of the urls, or csv or nc to get csv files, decoding the netCDF responses
+    :return: list of files with the responses, in the same order as the urls
+    """
+    record = satMetrics.current()
+
+    def fetchOne(url):
+        fetch = satCache.fetchFile if transfer is None else satTransfer.fetchCSV
+        args = (url,) if transfer is None else (url, transfer)
+        with satMetrics.attach(record), lock or contextlib.nullcontext():
+            return fetch(*args)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(fetchOne, urls))
+
+
+def _written(chunk, boxes, dims):
+    ## rows of a chunk inside the boxes (time, latitude and longitude ranges) of the tiles already written
+    extent = {dim: (chunk[dim].min(), chunk[dim].max()) for dim in dims}
+    mask = None
+    for box in boxes:
+        if any(box[dim][0] > extent[dim][1] or box[dim][1] < extent[dim][0] for dim in dims):
+            continue
+        inside = True
+        for dim in dims:
+            inside = inside & (chunk[dim] >= box[dim][0]) & (chunk[dim] <= box[dim][1])
+        mask = inside if mask is None else mask | inside
+    return mask
+
+
+def stitchCSV(files, fout):
+    """
+    join the ERDDAP csv responses of the tiles of a request in a single file. The tiles are copied one after the
+    other in chunks, in the order they were planned (time first, then position), so the memory used does not grow
+    with the size of the request. The rows at the tile boundaries already written by a previous tile are removed
+    :param files: list of csv files (or urls) with the tiles, in the order of planTiles
+    :param fout: output file, with the units row as in the ERDDAP responses
+    :return: (number of rows written, data frame with the first rows), like satStream.writeCSV
+    """
+    names, units, chunks = satStream.readCSV(files[0])
+    dims = [c for c in DIMENSIONS if c in names]
+    boxes = []
+
+    def rows():
+        for i, f in enumerate(files):
+            box = {}
+            for chunk in chunks if i == 0 else satStream.readCSV(f)[2]:
+                if dims and len(chunk):
+                    for dim in dims:
+                        low, high = chunk[dim].min(), chunk[dim].max()
+                        box[dim] = (min(low, box[dim][0]), max(high, box[dim][1])) if dim in box else (low, high)
+                    written = _written(chunk, boxes, dims)
+                    if written is not None:
+                        chunk = chunk[~written]
+                yield chunk
+            if box:
+                boxes.append(box)
+
+    return satStream.writeCSV(names, units, rows(), fout)
+
+
+def stitchNC(files, fout):
+    """
+    join the ERDDAP netCDF responses of the tiles of a request in a single file. Needs xarray
+    :param files: list of netCDF files with the tiles
+    :param fout: output file name
+    :return: output file name
+    """
+    import xarray as xr
+
+    parts = []
+    with satMetrics.stage('parse'):
+        for f in files:
+            ds = xr.open_dataset(f)
+            for dim in ds.dims:
+                if dim in ds.indexes:
+                    ds = ds.isel({dim: ~ds.indexes[dim].duplicated()})
+            parts.append(ds)
+        merged = xr.combine_by_coords(parts, combine_attrs='drop_conflicts')
+    with satMetrics.stage('write'):
+        merged.to_netcdf(fout)
+    for ds in parts:
+        ds.close()
+    return fout
@@ -0,0 +1,353 @@
+import os
+import re
+import time
+import threading
+import contextlib
+import urllib.parse
+
+import satCache
+import satChunker
+import satCube
+import satMeta
+import satMetrics
+import satStream
+import satTransfer
+import satWriters
+
+## requests of the same dataset sent at the same time by different threads, like the workers of getParams or
+## the extractors called from a pool, are merged in a single query when it is smaller than the separate queries.
+## SSTTOOLS_COALESCE=off sends every request as it is
+ENABLED = os.environ.get('SSTTOOLS_COALESCE', 'on').lower() not in ('off', 'no', 'false', '0')
+
+## seconds the first request waits for the others before the queries are planned. It only waits while a pool of
+## workers sends requests at the same time (see parallel), a request alone is sent at once
+WINDOW = float(os.environ.get('SSTTOOLS_COALESCE_WINDOW', 0.05))
+
+_CONSTRAINT = re.compile(r'\[\(([^)]*)\):(\d+):\(([^)]*)\)\]')
+_VARIABLE = re.compile(r'^(\w+)((?:\[[^\]]*\])+)$')
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}')
+
+_lock = threading.Lock()
+_pending = []
+_parallel = 0
+
+
+def parseQuery(url):
+    """
+    split an ERDDAP griddap request in its dataset, variables and constraints. Only the requests with the same
+    constraints for all their variables, time first and latitude and longitude last, can be merged
+    :param url: ERDDAP griddap request url
+    :return: dictionary with the base url, variables, time, lat and lon ranges (low, high), the constraints of
+             the other dimensions and the strides, or None if the request can not be merged
+    """
+    parts = urllib.parse.urlsplit(url)
+    variables = []
+    constraints = set()
+    for item in urllib.parse.unquote(parts.query).split(','):
+        match = _VARIABLE.match(item.strip())
+        if match is None:
+            return None
+        variables.append(match.group(1))
+        constraints.add(match.group(2))
+    if len(constraints) != 1:
+        return None
+    dims = _CONSTRAINT.findall(constraints.pop())
+    if len(dims) < 3 or not _DATE.match(dims[0][0]) or not _DATE.match(dims[0][2]):
+        return None
+    try:
+        lat = (float(dims[-2][0]), float(dims[-2][2]))
+        lon = (float(dims[-1][0]), float(dims[-1][2]))
+    except ValueError:
+        return None
+    if lat[0] > lat[1] or lon[0] > lon[1] or dims[0][0] > dims[0][2]:
+        return None
+    return {'base': urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, '', '')),
+            'variables': variables, 'time': (dims[0][0], dims[0][2]), 'lat': lat, 'lon': lon,
+            'extra': ''.join('[({}):{}:({})]'.format(*d) for d in dims[1:-2]),
+            'strides': tuple(int(d[1]) for d in dims)}
+
+
+def queryURL(query):
+    """
+    build the url of a request
+    :param query: dictionary, as returned by parseQuery
+    :return: ERDDAP griddap request url
+    """
+    s = query['strides']
+    dims = '[({}):{}:({})]{}[({}):{}:({})][({}):{}:({})]'.format(query['time'][0], s[0], query['time'][1],
+                                                                  query['extra'], query['lat'][0], s[-2],
+                                                                  query['lat'][1], query['lon'][0], s[-1],
+                                                                  query['lon'][1])
+    return query['base'] + '?' + ','.join(var + dims for var in query['variables'])
+
+
+def _union(a, b):
+    query = dict(a)
+    query['variables'] = a['variables'] + [var for var in b['variables'] if var not in a['variables']]
+    query['lat'] = (min(a['lat'][0], b['lat'][0]), max(a['lat'][1], b['lat'][1]))
+    query['lon'] = (min(a['lon'][0], b['lon'][0]), max(a['lon'][1], b['lon'][1]))
+    return query
+
+
+def cost(query, dims=None):
+    """
+    approximate size of the response of a request
+    :param query: dictionary, as returned by parseQuery
+    :param dims: dataset dimensions, as returned by satMeta.getMeta
+    :return: (bytes, number of values)
+    """
+    fmt = 'nc' if query['base'].endswith('.nc') else 'csv'
+    time_step, spacing = satMeta.datasetSpacing(dims, satChunker.gridSpacing(query['base']))
+    request = {'lat_min': query['lat'][0], 'lat_max': query['lat'][1], 'lon_min': query['lon'][0],
+               'lon_max': query['lon'][1], 'date_start': query['time'][0], 'date_end': query['time'][1],
+               'time_stride': query['strides'][0], 'stride': query['strides'][-1]}
+    size = satMeta.estimate(None, request, len(query['variables']), time_step, spacing)
+    return size[fmt], size['cells']
+
+
+def _grids(dims):
+    ## (origin, spacing) of the latitude and longitude of a dataset, or None if they are not in the metadata
+    grids = {axis: satMeta.gridAxis(dims, axis) for axis in ('latitude', 'longitude')}
+    return None if None in grids.values() else grids
+
+
+def _indexes(values, grid):
+    ## grid indexes of the coordinates of a response, see satMeta.closestIndex
+    import numpy as np
+
+    origin, spacing = grid
+    return np.round(np.round((np.asarray(values, dtype=float) - origin) / spacing, satMeta.GRID_DECIMALS))
+
+
+def _cells(query, grids):
+    ## ranges of grid indexes ERDDAP gives for the latitude and longitude of a request
+    return {axis: tuple(satMeta.closestIndex(value, *grids[axis]) for value in query[key])
+            for axis, key in (('latitude', 'lat'), ('longitude', 'lon'))}
+
+
+def canMerge(query, dims):
+    """
+    check if the part of a request in a merged query can be told exactly: the grid of the dataset is known and no
+    end of its ranges is half way between two grid values, where the server may choose either
+    :param query: request, as returned by parseQuery
+    :param dims: dataset dimensions, as returned by satMeta.getMeta
+    :return: True if the request can be merged
+    """
+    grids = _grids(dims)
+    return grids is not None and not any(satMeta.isHalfway(value, *grids[axis])
+                                         for axis, key in (('latitude', 'lat'), ('longitude', 'lon'))
+                                         for value in query[key])
+
+
+def _samePhase(a, b, grids):
+    ## the strided axes of two requests take the same grid values where they overlap
+    cells_a, cells_b = _cells(a, grids), _cells(b, grids)
+    return all((cells_a[axis][0] - cells_b[axis][0]) % stride == 0
+               for axis, stride in (('latitude', a['strides'][-2]), ('longitude', a['strides'][-1])))
+
+
+class Shared:
+    """
+    query sent for several requests. The response is retrieved once, by the first request that needs it,
+    and each request takes its own part
+    """
+    def __init__(self, query, dims):
+        self.query = query
+        self.dims = dims
+        self.members = []
+        self._lock = threading.Lock()
+        self._fname = None
+        self._cube = None
+
+    @property
+    def url(self):
+        return queryURL(self.query)
+
+    def fetch(self):
+        """
+        :return: local file with the response of the merged query
+        """
+        with self._lock:
+            if self._fname is None:
+                self._fname = satCache.fetchFile(self.url)
+            else:
+                satMetrics.add('coalesced')
+            return self._fname
+
+    def table(self, query, transfer='csv'):
+        """
+        part of the response of one request, as a table. The merged query has the time range of all its requests,
+        the grid values are those with the grid indexes ERDDAP gives for the latitude and longitude of the request
+        :param query: request, as returned by parseQuery
+        :param transfer: csv or nc
+        :return: (column names, units, iterator of pandas data frames), like satTransfer.fetchTable
+        """
+        fname = self.fetch()
+        names, units, chunks = satTransfer.readNC(fname) if transfer == 'nc' else satStream.readCSV(fname)
+        keep = [i for i, name in enumerate(names) if name not in self.query['variables'] or name in query['variables']]
+        columns = [names[i] for i in keep]
+        grids = _grids(self.dims)
+        cells = _cells(query, grids)
+
+        def select():
+            for chunk in chunks:
+                mask = True
+                for axis in ('latitude', 'longitude'):
+                    index = _indexes(chunk[axis], grids[axis])
+                    mask = mask & (index >= cells[axis][0]) & (index <= cells[axis][1])
+                yield chunk.loc[mask, columns].reset_index(drop=True)
+
+        return columns, [units[i] for i in keep if i < len(units)], select()
+
+    def cube(self, query, decode):
+        """
+        part of the response of one request, as a cube. The response is decoded once for all the requests
+        :param query: request, as returned by parseQuery
+        :param decode: function decoding a response file into a cube, like satLoad.ncCube
+        :return: cube
+        """
+        import numpy as np
+
+        fname = self.fetch()
+        with self._lock:
+            if self._cube is None:
+                self._cube = decode(fname)
+            cube = self._cube
+        grids = _grids(self.dims)
+        bounds = {}
+        for axis, (low, high) in _cells(query, grids).items():
+            index = _indexes(cube[axis], grids[axis])
+            inside = cube[axis][(index >= low) & (index <= high)]
+            bounds[axis] = (inside[0], inside[-1]) if len(inside) else (np.inf, -np.inf)
+        part = satCube.sliceCube(cube, bounds)
+        part['variables'] = {name: values for name, values in part['variables'].items()
+                             if name in query['variables']}
+        return part
+
+
+def plan(queries, max_cells=satChunker.MAX_CELLS):
+    """
+    group the requests of the same dataset, time range, dimensions and strides in merged queries. A request joins
+    the query that saves the most bytes, if any. A merged query is never larger than max_cells or than its largest
+    request, so the tiles of a large request are not joined again. The strided requests join only the queries on
+    the same grid values, and the requests that can not be cut exactly from a merged query (see canMerge) are sent
+    alone
+    :param queries: list of requests, as returned by parseQuery
+    :return: list of Shared, with the index of their requests in members
+    """
+    groups = []
+    metas = {}
+    for i in sorted(range(len(queries)), key=lambda i: (queries[i]['lat'][0], queries[i]['lon'][0])):
+        query = queries[i]
+        key = (query['base'], query['extra'], query['strides'], query['time'])
+        if query['base'] not in metas:
+            metas[query['base']] = satMeta.getMeta(query['base'])
+        dims = metas[query['base']]
+        best = None
+        for group in groups if canMerge(query, dims) else []:
+            if (group.query['base'], group.query['extra'], group.query['strides'], group.query['time']) != key or \
+                    not canMerge(group.query, dims) or not _samePhase(group.query, query, _grids(dims)):
+                continue
+            merged = _union(group.query, query)
+            (a, a_cells), (b, b_cells), (c, c_cells) = [cost(q, group.dims) for q in (group.query, query, merged)]
+            saving = a + b - c
+            if c_cells > max(max_cells, a_cells, b_cells):
+                continue
+            if saving > 0 and (best is None or saving > best[0]):
+                best = (saving, group, merged)
+        if best is None:
+            best = (0, Shared(query, dims), query)
+            groups.append(best[1])
+        best[1].query = best[2]
+        best[1].members.append(i)
+    return groups
+
+
+@contextlib.contextmanager
+def parallel(workers):
+    """
+    mark the run of a pool of worker threads that send requests at the same time, so their requests wait for each
+    other to be merged
+    :param workers: number of worker threads. Nothing is marked for a single worker
+    """
+    global _parallel
+    if workers <= 1:
+        yield
+        return
+    with _lock:
+        _parallel += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _parallel -= 1
+
+
+def share(url):
+    """
+    wait for the other requests sent at the same time and plan the merged queries
+    :param url: ERDDAP griddap request url
+    :return: (Shared, query of the request), or None if the request is sent alone
+    """
+    query = parseQuery(url) if ENABLED else None
+    if query is None:
+        return None
+    entry = {'query': query, 'ready': threading.Event(), 'shared': None}
+    with _lock:
+        _pending.append(entry)
+        first = len(_pending) == 1
+        wait = _parallel > 0
+    if first:
+        if wait:
+            time.sleep(WINDOW)
+        with _lock:
+            batch = _pending[:]
+            del _pending[:]
+        try:
+            groups = plan([item['query'] for item in batch])
+            for group in groups:
+                for i in group.members:
+                    batch[i]['shared'] = group
+        finally:
+            for item in batch:
+                item['ready'].set()
+    entry['ready'].wait()
+    shared = entry['shared']
+    if shared is None or (len(shared.members) == 1 and shared.query == query):
+        return None
+    return shared, query
+
+
+def fetchTable(url, transfer='csv'):
+    """
+    retrieve an ERDDAP griddap request as a table, sharing the query with the requests of the same dataset
+    sent at the same time when that is smaller. Same as satTransfer.fetchTable
+    :param url: ERDDAP request url (any format)
+    :param transfer: csv or nc
+    :return: (column names, units, iterator of pandas data frames)
+    """
+    shared = share(satTransfer.toFormat(url, transfer))
+    if shared is None:
+        return satTransfer.fetchTable(url, transfer)
+    return shared[0].table(shared[1], transfer)
+
+
+def fetchFile(url, fout, fmt='csv'):
+    """
+    retrieve an ERDDAP griddap request into a file, sharing the query with the requests of the same dataset sent at
+    the same time when that is smaller. A csv or nc request sent alone is copied as the server sent it
+    :param url: ERDDAP request url (any format)
+    :param fout: output file name
+    :param fmt: csv, parquet, arrow or nc
+    :return: output file name
+    """
+    transfer = 'nc' if fmt == 'nc' else 'csv'
+    shared = share(satTransfer.toFormat(url, transfer))
+    if shared is None:
+        if fmt == transfer:
+            return satCache.fetch(satTransfer.toFormat(url, transfer), fout)
+        names, units, chunks = satTransfer.fetchTable(url, transfer)
+    else:
+        names, units, chunks = shared[0].table(shared[1], transfer)
+    satWriters.writeChunks(names, units, chunks, fout, fmt)
+    return fout
@@ -0,0 +1,225 @@
+import os
+import json
+
+import satStream
+import satWriters
+
+## coordinates of the cubes, in the order of the array axes
+AXES = ['time', 'latitude', 'longitude']
+
+
+def tableToCube(df, units=None):
+    """
+    convert an ERDDAP table (one row per time, latitude and longitude) to a cube of arrays.
+    The missing grid cells are filled with NaN
+    :param df: pandas data frame with time, latitude, longitude and variable columns
+    :param units: dictionary {column: units}
+    :return: cube, a dictionary with the time (datetime64), latitude and longitude coordinates, the variables
+             as float32 arrays (time, latitude, longitude) and their units
+    """
+    import numpy as np
+    import pandas as pd
+
+    times = pd.to_datetime(df['time'], utc=True).dt.tz_localize(None).to_numpy()
+    time, ti = np.unique(times, return_inverse=True)
+    latitude, yi = np.unique(pd.to_numeric(df['latitude']).to_numpy(), return_inverse=True)
+    longitude, xi = np.unique(pd.to_numeric(df['longitude']).to_numpy(), return_inverse=True)
+    variables = {}
+    for name in df.columns:
+        if name in satWriters.DIMENSIONS:
+            continue
+        values = np.full((len(time), len(latitude), len(longitude)), np.nan, dtype='float32')
+        values[ti, yi, xi] = pd.to_numeric(df[name], errors='coerce').to_numpy(dtype='float32')
+        variables[name] = values
+    return {'time': time, 'latitude': latitude, 'longitude': longitude, 'variables': variables,
+            'units': dict(units or {})}
+
+
+def readCube(fname):
+    """
+    read a file written by the SSTtools (csv with the units row, parquet, arrow or netCDF) as a cube
+    :param fname: file name. The format is taken from the extension
+    :return: cube, as returned by tableToCube
+    """
+    import numpy as np
+    import pandas as pd
+
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.nc':
+        import xarray as xr
+
+        with xr.open_dataset(fname) as ds:
+            variables = {}
+            units = {}
+            for name in ds.data_vars:
+                if list(ds[name].dims)[-3:] != AXES:
+                    continue
+                values = ds[name].values
+                variables[name] = values.reshape(values.shape[-3:]).astype('float32')
+                units[name] = ds[name].attrs.get('units', '')
+            return {'time': ds['time'].values.astype('datetime64[ns]'), 'latitude': ds['latitude'].values,
+                    'longitude': ds['longitude'].values, 'variables': variables, 'units': units}
+    if ext in ('.parquet', '.arrow'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if ext == '.parquet':
+            table = pq.read_table(fname)
+        else:
+            with pa.memory_map(fname) as source:
+                table = pa.ipc.open_file(source).read_all()
+        metadata = table.schema.metadata or {}
+        units = json.loads(metadata.get(b'units', b'{}'))
+        return tableToCube(table.to_pandas(), units)
+    names, units, chunks = satStream.readCSV(fname)
+    frames = list(chunks)
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=names)
+    return tableToCube(df, dict(zip(names, units)))
+
+
+def cubeChunks(coords, variables, chunksize=satStream.CHUNKSIZE):
+    """
+    convert a cube back to a table, in chunks of whole time steps
+    :param coords: list of (name, values) of the coordinates, in the order of the array axes
+    :param variables: dictionary {name: array} with the shape of the coordinates
+    :param chunksize: approximate number of rows of each chunk
+    :return: iterator of pandas data frames
+    """
+    import numpy as np
+    import pandas as pd
+
+    sizes = [len(values) for name, values in coords]
+    step = int(np.prod(sizes[1:]))
+    steps = max(1, chunksize // max(1, step))
+    for start in range(0, sizes[0], steps):
+        stop = min(start + steps, sizes[0])
+        shape = [stop - start] + sizes[1:]
+        data = {}
+        for i, (name, values) in enumerate(coords):
+            values = values[start:stop] if i == 0 else values
+            data[name] = np.tile(np.repeat(values, int(np.prod(shape[i + 1:]))), int(np.prod(shape[:i])))
+        for name, values in variables.items():
+            data[name] = values[start:stop].ravel()
+        yield pd.DataFrame(data)
+
+
+def writeCube(cube, fout, fmt=None, time_name='time'):
+    """
+    write a cube as a table in any of the output formats
+    :param cube: cube, as returned by readCube
+    :param fout: output file name
+    :param fmt: csv, parquet, arrow or nc. Default: taken from the extension of fout
+    :param time_name: name of the first coordinate, like dayofyear for a climatology
+    :return: (number of rows written, list of files written)
+    """
+    if fmt is None:
+        ext = os.path.splitext(fout)[1].lower()
+        fmt = {v: k for k, v in satWriters.FORMATS.items()}.get(ext, 'csv')
+    coords = [(time_name, cube[time_name]), ('latitude', cube['latitude']), ('longitude', cube['longitude'])]
+    names = [name for name, values in coords] + list(cube['variables'])
+    units = {'time': 'UTC', 'latitude': 'degrees_north', 'longitude': 'degrees_east'}
+    units.update(cube.get('units', {}))
+    return satWriters.writeChunks(names, [units.get(name, '') for name in names],
+                                  cubeChunks(coords, cube['variables']), fout, fmt)
+
+
+def sliceCube(cube, bounds):
+    """
+    part of a cube inside the given range of each axis. The arrays are sliced, so the parts of memory-mapped
+    arrays are still read from disk only when used
+    :param cube: cube, as returned by readCube
+    :param bounds: dictionary {axis: (low, high)}, inclusive. The axes missing are not cut
+    :return: cube
+    """
+    import numpy as np
+
+    index = []
+    result = {'units': cube.get('units', {})}
+    for axis in AXES:
+        low, high = bounds.get(axis, (None, None))
+        a = 0 if low is None else np.searchsorted(cube[axis], low, 'left')
+        b = len(cube[axis]) if high is None else np.searchsorted(cube[axis], high, 'right')
+        index.append(slice(a, b))
+        result[axis] = cube[axis][a:b]
+    result['variables'] = {name: values[tuple(index)] for name, values in cube['variables'].items()}
+    return result
+
+
+def _tableChunks(fname, chunksize=satStream.CHUNKSIZE):
+    ## chunks of rows of a csv, parquet or arrow file
+    ext = os.path.splitext(fname)[1].lower()
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(fname).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif ext == '.arrow':
+        import pyarrow as pa
+
+        with pa.memory_map(fname) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+    else:
+        names, units, chunks = satStream.readCSV(fname, chunksize)
+        for chunk in chunks:
+            yield chunk
+
+
+def iterSteps(fname, variable, lat_slice=None, chunksize=satStream.CHUNKSIZE):
+    """
+    read one variable of a file time step by time step, so a multi-year cube is never held in memory.
+    The rows of the tables must be ordered by time, like the ERDDAP responses
+    :param fname: csv, parquet, arrow or netCDF file
+    :param variable: name of the variable, like analysed_sst
+    :param lat_slice: optional slice of latitude indexes to read (netCDF only), to split a region in bands
+    :param chunksize: approximate number of values read at a time
+    :return: iterator of (time as datetime64, latitude, longitude, 2D float32 array)
+    """
+    import numpy as np
+    import pandas as pd
+
+    if os.path.splitext(fname)[1].lower() == '.nc':
+        import xarray as xr
+
+        with xr.open_dataset(fname) as ds:
+            da = ds[variable]
+            if lat_slice is not None:
+                da = da.isel(latitude=lat_slice)
+            da = da.squeeze([d for d in da.dims if d not in AXES and da.sizes[d] == 1])
+            latitude, longitude = da['latitude'].values, da['longitude'].values
+            steps = max(1, chunksize // max(1, len(latitude) * len(longitude)))
+            for start in range(0, da.sizes['time'], steps):
+                block = da.isel(time=slice(start, start + steps))
+                values = block.values.astype('float32')
+                for i, time in enumerate(block['time'].values):
+                    yield time.astype('datetime64[ns]'), latitude, longitude, values[i]
+        return
+
+    grid = {}
+
+    def build(rows):
+        if not grid:
+            grid['latitude'] = np.unique(pd.to_numeric(rows['latitude']).to_numpy())
+            grid['longitude'] = np.unique(pd.to_numeric(rows['longitude']).to_numpy())
+        values = np.full((len(grid['latitude']), len(grid['longitude'])), np.nan, dtype='float32')
+        yi = np.searchsorted(grid['latitude'], pd.to_numeric(rows['latitude']).to_numpy())
+        xi = np.searchsorted(grid['longitude'], pd.to_numeric(rows['longitude']).to_numpy())
+        values[yi, xi] = pd.to_numeric(rows[variable], errors='coerce').to_numpy(dtype='float32')
+        time = pd.to_datetime(rows['time'].iloc[0], utc=True).tz_localize(None).to_datetime64()
+        return time.astype('datetime64[ns]'), grid['latitude'], grid['longitude'], values
+
+    pending = None
+    for chunk in _tableChunks(fname, chunksize):
+        times = chunk['time'].astype(str).to_numpy()
+        bounds = [0] + list(np.flatnonzero(times[1:] != times[:-1]) + 1) + [len(chunk)]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            part = chunk.iloc[a:b]
+            if pending is not None and str(pending['time'].iloc[0]) == times[a]:
+                pending = pd.concat([pending, part])
+                continue
+            if pending is not None:
+                yield build(pending)
+            pending = part
+    if pending is not None:
+        yield build(pending)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import tempfile
+import concurrent.futures
+
+import satCube
+import satStream
+import satWriters
+
+## accumulation window of the Degree Heating Weeks, in days (12 weeks)
+WINDOW = 84
+
+## only the HotSpots of at least 1 degree C are accumulated, as in the Coral Reef Watch products
+HOTSPOT_MIN = 1.0
+
+## output variables and their units
+UNITS = {'hotspot': 'degree_C', 'dhw': 'degree_C_weeks'}
+
+
+def readMMM(source, latitude, longitude):
+    """
+    maximum monthly mean climatology on the grid of a SST cube. The climatology is taken to the grid with
+    the nearest neighbour, so a 5 km climatology like the one of Coral Reef Watch can be used with the 1 km MUR SST
+    :param source: a number, for a single MMM value, or a file with a (latitude, longitude) grid:
+                   netCDF with a variable named like *mmm* (or its first variable), or a csv, parquet or arrow table
+                   with latitude, longitude and the MMM in a column named like *mmm* (or the first other column)
+    :param latitude: latitudes of the cube
+    :param longitude: longitudes of the cube
+    :return: float32 array (latitude, longitude)
+    """
+    import numpy as np
+
+    try:
+        return np.full((len(latitude), len(longitude)), float(source), dtype='float32')
+    except ValueError:
+        pass
+    if os.path.splitext(source)[1].lower() == '.nc':
+        import xarray as xr
+
+        with xr.open_dataset(source) as ds:
+            names = [name for name in ds.data_vars if 'mmm' in name.lower()] or list(ds.data_vars)
+            da = ds[names[0]].squeeze()
+            da = da.transpose('latitude', 'longitude')
+            lat, lon, values = da['latitude'].values, da['longitude'].values, da.values.astype('float32')
+    else:
+        import pandas as pd
+
+        ext = os.path.splitext(source)[1].lower()
+        if ext == '.parquet':
+            df = pd.read_parquet(source)
+        elif ext == '.arrow':
+            df = pd.read_feather(source)
+        else:
+            ## the units row of the csv written by the SSTtools is not a number
+            df = pd.read_csv(source, dtype=str)
+        for col in ('latitude', 'longitude'):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        df = df.dropna(subset=['latitude', 'longitude'])
+        names = [c for c in df.columns if c not in satWriters.DIMENSIONS]
+        name = ([c for c in names if 'mmm' in c.lower()] or names)[0]
+        grid = df.assign(**{name: pd.to_numeric(df[name], errors='coerce')}).pivot_table(
+            index='latitude', columns='longitude', values=name, aggfunc='first', dropna=False)
+        lat, lon, values = grid.index.to_numpy(), grid.columns.to_numpy(), grid.to_numpy(dtype='float32')
+
+    def nearest(axis, targets):
+        order = np.argsort(axis)
+        axis = axis[order]
+        i = np.clip(np.searchsorted(axis, targets), 1, len(axis) - 1)
+        i -= (targets - axis[i - 1]) < (axis[i] - targets)
+        return order[i]
+
+    return values[np.ix_(nearest(lat, np.asarray(latitude)), nearest(lon, np.asarray(longitude)))]
+
+
+class DHWWindow:
+    """
+    rolling 12 week accumulation of the HotSpots of a grid, updated one day at a time.
+    Only the last WINDOW days of HotSpots are kept, in a ring buffer, with a running sum
+    """
+    def __init__(self, mmm, days=WINDOW):
+        import numpy as np
+
+        self.mmm = mmm
+        self.buffer = np.zeros((days,) + mmm.shape, dtype='float32')
+        self.total = np.zeros(mmm.shape, dtype='float64')
+        self.position = 0
+        self.day = None
+
+    def _push(self, values):
+        self.total += values
+        self.total -= self.buffer[self.position]
+        self.buffer[self.position] = values
+        self.position = (self.position + 1) % len(self.buffer)
+
+    def add(self, time, sst):
+        """
+        add the SST of a day. The days missing since the previous one count as days without HotSpots
+        :param time: day, as datetime64
+        :param sst: float32 array (latitude, longitude) in degree C, NaN over land
+        :return: (hotspot, dhw) float32 arrays, NaN where the SST is missing
+        """
+        import numpy as np
+
+        day = np.datetime64(time, 'D')
+        if self.day is not None:
+            for i in range(min(int((day - self.day).astype('int64')) - 1, len(self.buffer))):
+                self._push(0)
+        self.day = day
+        hotspot = np.maximum(sst - self.mmm, 0)
+        self._push(np.where(hotspot >= HOTSPOT_MIN, hotspot, 0))
+        ## the running sum is recomputed once per window to drop the rounding errors
+        if self.position == 0:
+            self.total = self.buffer.sum(axis=0, dtype='float64')
+        dhw = (self.total / 7).astype('float32')
+        dhw[np.isnan(sst)] = np.nan
+        return hotspot, dhw
+
+
+def _steps(fin, mmm, variable, date_start, lat_slice=None):
+    ## DHW of each time step of a file, from date_start on
+    import numpy as np
+
+    window = None
+    first = None if date_start is None else np.datetime64(date_start, 'D')
+    for time, latitude, longitude, sst in satCube.iterSteps(fin, variable, lat_slice):
+        if window is None:
+            window = DHWWindow(readMMM(mmm, latitude, longitude) if np.ndim(mmm) == 0 else mmm)
+        hotspot, dhw = window.add(time, sst)
+        if first is None or np.datetime64(time, 'D') >= first:
+            yield time, latitude, longitude, hotspot, dhw
+
+
+def _band(fin, mmm, variable, date_start, start, stop, fout, shape):
+    ## compute one latitude band of the region into the shared memory-mapped output
+    import numpy as np
+
+    out = np.memmap(fout, dtype='float32', mode='r+', shape=shape)
+    for i, (time, latitude, longitude, hotspot, dhw) in enumerate(_steps(fin, mmm[start:stop], variable, date_start,
+                                                                         slice(start, stop))):
+        out[0, i, start:stop] = hotspot
+        out[1, i, start:stop] = dhw
+    out.flush()
+    return stop - start
+
+
+def computeDHW(fin, mmm, fout, variable='analysed_sst', date_start=None, workers=1):
+    """
+    compute the Coral Reef Watch HotSpot and Degree Heating Weeks from a daily SST cube, like the MUR SST
+    downloaded with getSatProd or MURSST_flexiharvester.
+    HotSpot = max(SST - MMM, 0). DHW = sum of the HotSpots >= 1 of the last 12 weeks / 7.
+    The cube is read one time step at a time and the output is written in blocks of time steps, also netCDF
+    (see satWriters), so only 12 weeks of the grid are held in memory.
+    The DHW of the first 12 weeks of the cube are incomplete: download the SST from 12 weeks before the first
+    date wanted and give it as date_start.
+    With more than one worker the region is split in latitude bands computed in parallel processes, which needs
+    a netCDF input. The results are kept in a temporary memory-mapped file until they are written
+    :param fin: daily SST file: csv, parquet, arrow or nc
+    :param mmm: maximum monthly mean climatology: a number or a file, see readMMM
+    :param fout: output file. Its extension gives the format
+    :param variable: name of the SST variable
+    :param date_start: first date written, in yyyy-mm-dd. Default: the first date of the cube
+    :param workers: number of processes
+    :return: (number of rows written, list of files written)
+    """
+    import numpy as np
+
+    names = ['time', 'latitude', 'longitude', 'hotspot', 'dhw']
+    units = ['UTC', 'degrees_north', 'degrees_east', UNITS['hotspot'], UNITS['dhw']]
+    ext = os.path.splitext(fout)[1].lower()
+    fmt = {v: k for k, v in satWriters.FORMATS.items()}.get(ext, 'csv')
+
+    if workers > 1 and os.path.splitext(fin)[1].lower() != '.nc':
+        print('WARNING: only a netCDF input can be split between processes, using one')
+        workers = 1
+
+    if workers <= 1:
+        def chunks():
+            ## the time steps are written in blocks of about CHUNKSIZE values
+            block = []
+            for step in _steps(fin, mmm, variable, date_start):
+                block.append(step)
+                if len(block) * step[3].size >= satStream.CHUNKSIZE:
+                    yield from blockChunks(block)
+                    block = []
+            if block:
+                yield from blockChunks(block)
+
+        def blockChunks(block):
+            coords = [('time', np.array([step[0] for step in block])), ('latitude', block[0][1]),
+                      ('longitude', block[0][2])]
+            return satCube.cubeChunks(coords, {'hotspot': np.stack([step[3] for step in block]),
+                                               'dhw': np.stack([step[4] for step in block])})
+        return satWriters.writeChunks(names, units, chunks(), fout, fmt)
+
+    import xarray as xr
+
+    with xr.open_dataset(fin) as ds:
+        time = ds['time'].values.astype('datetime64[ns]')
+        latitude, longitude = ds['latitude'].values, ds['longitude'].values
+    if date_start is not None:
+        time = time[time.astype('datetime64[D]') >= np.datetime64(date_start, 'D')]
+    grid = readMMM(mmm, latitude, longitude)
+    shape = (2, len(time), len(latitude), len(longitude))
+    bounds = np.linspace(0, len(latitude), min(workers, len(latitude)) + 1).astype(int)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'dhw.dat')
+        out = np.memmap(fname, dtype='float32', mode='w+', shape=shape)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            jobs = [executor.submit(_band, fin, grid, variable, date_start, a, b, fname, shape)
+                    for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+            for job in jobs:
+                job.result()
+        coords = [('time', time), ('latitude', latitude), ('longitude', longitude)]
+        result = satWriters.writeChunks(names, units, satCube.cubeChunks(coords, {'hotspot': out[0], 'dhw': out[1]}),
+                                        fout, fmt)
+        del out
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the HotSpot and Degree Heating Weeks from a daily SST cube '
+                                                 'already downloaded, like the 1 km MUR SST, and a maximum monthly '
+                                                 'mean climatology')
+    parser.add_argument('-fin', dest='fin', help='daily SST file: csv, parquet, arrow or nc, as written by getSatProd',
+                        required=True)
+    parser.add_argument('-mmm', dest='mmm', help='maximum monthly mean climatology: a value in degree C, or a file '
+                        'with a latitude/longitude grid (nc, csv, parquet or arrow)', required=True)
+    parser.add_argument('-var', dest='variable', help='SST variable. Default analysed_sst', default='analysed_sst',
+                        required=False)
+    parser.add_argument('-ds', dest='date_start', help='first date written, in yyyy-mm-dd. The 12 weeks before it are '
+                        'used to start the accumulation. Default: first date of the file', required=False)
+    parser.add_argument('-workers', dest='workers', help='parallel processes, each one for a latitude band. '
+                        'Needs a netCDF input. Default 1', type=int, default=1, required=False)
+    parser.add_argument('-fout', dest='fout', help='output file. The extension gives the format: csv, parquet, arrow '
+                        'or nc. Default input file name with _dhw', required=False)
+    args = parser.parse_args()
+
+    if args.fout is None:
+        name, ext = os.path.splitext(args.fin)
+        args.fout = name + '_dhw' + ext
+
+    rows, files = computeDHW(args.fin, args.mmm, args.fout, args.variable, args.date_start, args.workers)
+    print('{} records written to {}'.format(rows, ', '.join(files)))
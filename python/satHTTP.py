@@ -0,0 +1,348 @@
+import io
+import os
+import time
+import random
+import shutil
+import socket
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import satMetrics
+import satMirror
+
+## attempts of a request, and base and maximum delay in seconds of the exponential backoff between attempts
+RETRIES = 5
+BACKOFF = 2.0
+MAX_BACKOFF = 120.0
+
+## seconds without receiving data before a connection is considered broken
+TIMEOUT = 300
+
+## transient errors that are retried. ERDDAP answers 503 when it is busy or restarting
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+## idle connections kept open for each host
+POOL_SIZE = 4
+
+REDIRECTS = 5
+USER_AGENT = 'SSTtools'
+
+## servers answered by a stand-in, like the mock ERDDAP server of satBench: {'https://host': 'http://127.0.0.1:8080'}
+STAND_INS = {}
+
+_pool = {}
+_poolLock = threading.Lock()
+
+## network errors. They are all retried
+_ERRORS = (http.client.HTTPException, OSError)
+
+
+def backoff(attempt, retry_after=None):
+    """
+    delay before the next attempt of a request: exponential backoff with random jitter,
+    so the workers that failed together do not retry together
+    :param attempt: number of the failed attempt, starting at 0
+    :param retry_after: value of the Retry-After header of the response, if any
+    :return: seconds to wait
+    """
+    delay = min(MAX_BACKOFF, BACKOFF * 2 ** attempt)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after and str(retry_after).strip().isdigit():
+        delay = max(delay, min(MAX_BACKOFF, float(retry_after)))
+    return delay
+
+
+def _connect(scheme, netloc):
+    host = urllib.parse.urlsplit(scheme + '://' + netloc).hostname
+    proxy = urllib.request.getproxies().get(scheme)
+    if proxy and not urllib.request.proxy_bypass(host):
+        proxy = urllib.parse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy.hostname, proxy.port or 8080, timeout=TIMEOUT)
+            conn.set_tunnel(netloc)
+            return conn, False
+        return http.client.HTTPConnection(proxy.hostname, proxy.port or 8080, timeout=TIMEOUT), True
+    if scheme == 'https':
+        return http.client.HTTPSConnection(netloc, timeout=TIMEOUT), False
+    return http.client.HTTPConnection(netloc, timeout=TIMEOUT), False
+
+
+def _openConnection(conn):
+    ## open a new connection, timing the name resolution and the connection (with the TLS handshake)
+    if satMetrics.isEnabled():
+        with satMetrics.stage('dns'):
+            try:
+                socket.getaddrinfo(conn.host, conn.port, type=socket.SOCK_STREAM)
+            except OSError:
+                pass
+    with satMetrics.stage('connect'):
+        conn.connect()
+
+
+def _acquire(scheme, netloc):
+    with _poolLock:
+        idle = _pool.get((scheme, netloc))
+        if idle:
+            return idle.pop() + (True,)
+    return _connect(scheme, netloc) + (False,)
+
+
+def _release(scheme, netloc, conn, absolute):
+    with _poolLock:
+        idle = _pool.setdefault((scheme, netloc), [])
+        if len(idle) < POOL_SIZE:
+            idle.append((conn, absolute))
+            return
+    conn.close()
+
+
+def _send(url, headers, timeout=None):
+    """
+    send a single GET request on a pooled connection. A kept-alive connection closed by the server
+    is replaced by a new one without waiting
+    :param timeout: seconds without receiving data before the connection is considered broken. Default TIMEOUT
+    :return: (connection, whether it sends absolute urls, response)
+    """
+    parts = urllib.parse.urlsplit(url)
+    target = parts.path or '/'
+    if parts.query:
+        target += '?' + parts.query
+    headers = dict(headers)
+    headers.setdefault('User-Agent', USER_AGENT)
+    headers.setdefault('Accept-Encoding', 'identity')
+    while True:
+        conn, absolute, reused = _acquire(parts.scheme, parts.netloc)
+        conn.timeout = timeout or TIMEOUT
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        try:
+            if not reused and satMetrics.current() is not None:
+                _openConnection(conn)
+            with satMetrics.stage('first_byte'):
+                conn.request('GET', url if absolute else target, headers=headers)
+                response = conn.getresponse()
+            satMetrics.add('requests')
+            return conn, absolute, response
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+        except BaseException:
+            conn.close()
+            raise
+
+
+def _finish(url, conn, absolute, response):
+    ## read the rest of a response that is not used, so the connection can be used again
+    parts = urllib.parse.urlsplit(url)
+    try:
+        body = response.read()
+    except _ERRORS:
+        conn.close()
+        return b''
+    if response.will_close:
+        conn.close()
+    else:
+        _release(parts.scheme, parts.netloc, conn, absolute)
+    return body
+
+
+def _attempt(url, headers, timeout=None):
+    """
+    send a request once, following redirects
+    :return: (final url, connection, whether it sends absolute urls, response with a 2xx status), or the error
+    """
+    parts = urllib.parse.urlsplit(url)
+    server = parts.scheme + '://' + parts.netloc
+    if server in STAND_INS:
+        url = STAND_INS[server] + url[len(server):]
+    for redirects in range(REDIRECTS + 1):
+        try:
+            conn, absolute, response = _send(url, headers, timeout)
+        except _ERRORS as e:
+            return urllib.error.URLError(e)
+        if response.status in (301, 302, 303, 307, 308) and redirects < REDIRECTS:
+            location = response.getheader('Location')
+            _finish(url, conn, absolute, response)
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if response.status < 300:
+            return url, conn, absolute, response
+        body = _finish(url, conn, absolute, response)
+        return urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+
+def _open(url, headers, retries=None, failover=True, timeout=None):
+    """
+    send a request, following redirects and retrying the transient errors.
+    The request goes to the fastest healthy mirror of its dataset (see satMirror). When a mirror fails, or does not
+    have the dataset (404), the next one is tried at once, and the backoff only starts when all of them failed
+    :param failover: if False, the request is only sent to the given url, and the health of its mirror is not recorded
+    :param timeout: seconds without receiving data before the connection is considered broken. Default TIMEOUT
+    :return: (final url, connection, whether it sends absolute urls, response with a 2xx status)
+    """
+    attempt = 0
+    while True:
+        urls = satMirror.candidates(url) if failover else [url]
+        errors = []
+        for i, mirror in enumerate(urls):
+            started = time.time()
+            result = _attempt(mirror, headers, timeout)
+            if not isinstance(result, Exception):
+                if failover:
+                    satMirror.record(mirror, time.time() - started)
+                return result
+            code = getattr(result, 'code', None)
+            if code is not None and code not in RETRY_STATUS and (code != 404 or len(urls) == 1):
+                raise result
+            if code != 404 and failover:
+                satMirror.record(mirror, None)
+            errors.append((mirror, result))
+            if i < len(urls) - 1:
+                satMetrics.add('failovers')
+                print('WARNING: {} ({}), trying {}'.format(mirror, code or result.reason,
+                                                           urllib.parse.urlsplit(urls[i + 1]).netloc), flush=True)
+        ## report the error of the original server
+        error = dict(errors).get(url, errors[0][1])
+        if all(getattr(e, 'code', None) == 404 for m, e in errors):
+            raise error
+        if attempt >= (RETRIES if retries is None else retries) - 1:
+            raise error
+        retry_after = next((e.headers.get('Retry-After') for m, e in errors
+                            if getattr(e, 'headers', None) and e.headers.get('Retry-After')), None)
+        delay = backoff(attempt, retry_after)
+        print('WARNING: {} ({}), retrying in {:.0f} s'.format(url, getattr(error, 'code', None) or error.reason,
+                                                              delay), flush=True)
+        time.sleep(delay)
+        satMetrics.add('retries')
+        attempt += 1
+
+
+def _rangeStart(headers, name):
+    value = headers.get(name) or ''
+    if value.startswith('bytes') and '-' in value:
+        start = value.split('=' if name == 'Range' else ' ')[-1].split('-')[0].strip()
+        if start.isdigit():
+            return int(start)
+    return None
+
+
+class Response(io.RawIOBase):
+    """
+    binary stream with the body of a GET request, sent on a pooled keep-alive connection.
+    Transient errors are retried with backoff, and if the connection breaks in the middle of the body
+    the transfer continues where it stopped with an HTTP Range request.
+    Raises urllib.error.HTTPError and urllib.error.URLError like urllib.request.urlopen
+    """
+    def __init__(self, url, headers=None, retries=None, failover=True, timeout=None):
+        super().__init__()
+        self.requested = dict(headers or {})
+        self._timeout = timeout
+        self.url, self._conn, self._absolute, self._response = _open(url, self.requested, retries, failover, timeout)
+        self.status = self._response.status
+        self.headers = self._response.headers
+        self.validator = self.headers.get('ETag') or self.headers.get('Last-Modified')
+        self.start = (_rangeStart(self.headers, 'Content-Range') or 0) if self.status == 206 else 0
+        length = self.headers.get('Content-Length')
+        self.length = int(length) if length and length.isdigit() else None
+        self.offset = 0
+        self.resumed = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            try:
+                with satMetrics.stage('transfer'):
+                    n = self._response.readinto(buffer)
+            except _ERRORS as e:
+                error = e
+            else:
+                if n or self.length is None or self.offset >= self.length:
+                    self.offset += n
+                    return n
+                error = http.client.IncompleteRead(b'', self.length - self.offset)
+            self._resume(error)
+
+    def _resume(self, error):
+        self._conn.close()
+        if self.resumed >= RETRIES:
+            raise urllib.error.URLError(error)
+        time.sleep(backoff(self.resumed))
+        self.resumed += 1
+        satMetrics.add('retries')
+        position = self.start + self.offset
+        headers = dict(self.requested)
+        headers['Range'] = 'bytes={}-'.format(position)
+        if self.validator:
+            headers['If-Range'] = self.validator
+        url, self._conn, self._absolute, self._response = _open(self.url, headers, failover=False,
+                                                                   timeout=self._timeout)
+        if self._response.status == 206 and _rangeStart(self._response.headers, 'Content-Range') == position:
+            return
+        headers = self._response.headers
+        if self.validator and self.validator != (headers.get('ETag') or headers.get('Last-Modified')):
+            raise urllib.error.URLError('{} changed on the server during the transfer'.format(self.url))
+        ## the server ignored the range: skip what was already received
+        skip = position
+        while skip > 0:
+            data = self._response.read(min(skip, 1 << 20))
+            if not data:
+                raise urllib.error.URLError(error)
+            skip -= len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            parts = urllib.parse.urlsplit(self.url)
+            _release(parts.scheme, parts.netloc, self._conn, self._absolute)
+        else:
+            self._conn.close()
+        super().close()
+
+
+def urlopen(url, headers=None, retries=None, failover=True, timeout=None):
+    """
+    open an url through the shared transport
+    :param url: url
+    :param headers: optional dictionary of request headers
+    :param retries: attempts of the request. Default RETRIES
+    :param failover: if False, the request is only sent to the given url, not to the mirrors of its dataset
+    :param timeout: seconds without receiving data before the connection is considered broken. Default TIMEOUT
+    :return: Response, a binary stream with status and headers
+    """
+    return Response(url, headers, retries, failover, timeout)
+
+
+def download(url, fout, headers=None, resume=False):
+    """
+    download an url into a file through the shared transport. A broken transfer continues where it stopped
+    :param url: url
+    :param fout: output file name
+    :param headers: optional dictionary of request headers
+    :param resume: if True and fout exists, it is taken as the beginning of the response and only the rest is requested
+    :return: (response headers, number of bytes received)
+    """
+    headers = dict(headers or {})
+    offset = os.path.getsize(fout) if resume and os.path.exists(fout) else 0
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+    try:
+        response = Response(url, headers)
+    except urllib.error.HTTPError as e:
+        if e.code != 416 or not offset:
+            raise
+        ## the partial file does not match the response any more
+        offset = 0
+        headers.pop('Range')
+        response = Response(url, headers)
+    if response.status != 206:
+        offset = 0
+    with response, open(fout, 'ab' if offset else 'wb') as f:
+        shutil.copyfileobj(response, f, 1 << 20)
+    return response.headers, os.path.getsize(fout) - offset
@@ -0,0 +1,39 @@
+import sys
+import importlib
+
+
+class LazyModule:
+    """
+    module imported on the first access to one of its attributes. The import of the network and parsing modules
+    (urllib, http, ssl, pandas through them) is left out of the startup, so the argument checks, the list of products
+    and the dry runs of the command line tools return without loading them
+    """
+    def __init__(self, name):
+        """
+        :param name: module name, like satHTTP
+        """
+        object.__setattr__(self, '_name', name)
+
+    def _module(self):
+        ## the import lock makes the first import safe from several threads
+        module = sys.modules.get(self._name)
+        if module is None:
+            module = importlib.import_module(self._name)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._module(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._module(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module {}>'.format(self._name)
+
+
+def lazyImport(name):
+    """
+    :param name: module name
+    :return: the module if already imported, a LazyModule otherwise
+    """
+    return sys.modules.get(name) or LazyModule(name)
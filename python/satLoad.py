@@ -0,0 +1,287 @@
+import os
+import contextlib
+import threading
+import urllib.parse
+import concurrent.futures
+
+import satCache
+import satCoalesce
+import satChunker
+import satCube
+import satMetrics
+import satStream
+import satTransfer
+import satWriters
+from satLazy import lazyImport
+
+## urllib and http are loaded with the first request
+satHTTP = lazyImport('satHTTP')
+
+_ncLock = threading.Lock()
+
+
+def _transfer(url):
+    ## response format of a request, from the extension of its path
+    ext = os.path.splitext(urllib.parse.urlsplit(url).path)[1].lstrip('.').lower()
+    return ext if ext in satTransfer.TRANSFER_FORMATS else 'csv'
+
+
+def response(url, cache=True):
+    """
+    get the response of an ERDDAP request to be decoded in memory, without writing any file of its own.
+    With the cache enabled it is the cache file. With the cache disabled a csv response is streamed from
+    the connection and a netCDF response is read in a memory buffer
+    :param url: ERDDAP request url
+    :param cache: if False the cache is not used, for the responses kept somewhere else like the satArchive chunks
+    :return: file name, url or bytes
+    """
+    if cache and satCache.isEnabled():
+        return satCache.fetch(url)
+    if _transfer(url) == 'csv':
+        return url
+    with satHTTP.urlopen(url) as stream:
+        data = stream.read()
+    satCache.countBytes(url, len(data))
+    return data
+
+
+def _openNC(source):
+    import xarray as xr
+
+    if isinstance(source, bytes):
+        import netCDF4
+
+        return xr.open_dataset(xr.backends.NetCDF4DataStore(netCDF4.Dataset('response.nc', memory=source)))
+    return xr.open_dataset(source)
+
+
+def _ascending(cube):
+    ## the axes in increasing order, like the cubes of satCube. Reversing an axis is a view, not a copy
+    for i, axis in enumerate(satCube.AXES):
+        values = cube[axis]
+        if len(values) > 1 and values[0] > values[-1]:
+            index = (slice(None),) * i + (slice(None, None, -1),)
+            cube[axis] = values[::-1]
+            cube['variables'] = {name: array[index] for name, array in cube['variables'].items()}
+    return cube
+
+
+def ncCube(source):
+    """
+    decode an ERDDAP griddap netCDF response into a cube. The arrays are taken as they are stored in the response,
+    the coordinates are not expanded to a table. Dimensions of size 1, like the altitude of the chlorophyll, are dropped.
+    Needs xarray and netCDF4 for the memory buffers
+    :param source: file name or bytes of the response
+    :return: cube, a dictionary with the time, latitude and longitude coordinates, the variables as float32 arrays
+             (time, latitude, longitude) and their units, like satCube.tableToCube
+    """
+    ## the HDF5 library is not thread safe, the tiles are decoded one at a time
+    with satMetrics.stage('parse'), _ncLock, _openNC(source) as ds:
+        variables = {}
+        units = {}
+        for name in ds.data_vars:
+            da = ds[name]
+            extra = [d for d in da.dims if d not in satCube.AXES]
+            if any(axis not in da.dims for axis in satCube.AXES) or any(da.sizes[d] > 1 for d in extra):
+                continue
+            values = da.squeeze(extra).transpose(*satCube.AXES).values
+            variables[name] = values.astype('float32', copy=False)
+            units[name] = str(da.attrs.get('units', ''))
+        cube = {'time': ds['time'].values.astype('datetime64[ns]'), 'latitude': ds['latitude'].values,
+                'longitude': ds['longitude'].values, 'variables': variables, 'units': units}
+    return _ascending(cube)
+
+
+def _gridAxes(frames):
+    ## latitude and longitude of the grid, from the rows of the first time step
+    import numpy as np
+    import pandas as pd
+
+    df = pd.concat(frames, ignore_index=True)
+    first = df[df['time'] == df['time'].iloc[0]]
+    return (np.unique(pd.to_numeric(first['latitude']).to_numpy()),
+            np.unique(pd.to_numeric(first['longitude']).to_numpy()))
+
+
+def _axisIndex(axis, values):
+    ## positions of the values on an axis, they must be on it
+    import numpy as np
+
+    index = np.minimum(np.searchsorted(axis, values), len(axis) - 1)
+    if len(values) and not np.array_equal(axis[index], values):
+        raise ValueError('the rows of the response are not on the grid of its first time step')
+    return index
+
+
+def csvCube(source):
+    """
+    decode an ERDDAP griddap csv response into a cube, parsing it in chunks. The rows of every chunk are placed in
+    the float32 arrays of their time step, so the whole table is never held in memory. The grid is taken from the
+    rows of the first time step, like ERDDAP every time step has the same latitudes and longitudes
+    :param source: file name or url of the response
+    :return: cube, like ncCube
+    """
+    import numpy as np
+    import pandas as pd
+
+    names, units, chunks = satStream.readCSV(source)
+    variables = [name for name in names if name not in satWriters.DIMENSIONS]
+    steps = {}
+    grid = None
+    pending = []
+
+    def fill(df):
+        times = pd.to_datetime(df['time'], utc=True).dt.tz_localize(None).to_numpy().astype('datetime64[ns]')
+        yi = _axisIndex(grid[0], pd.to_numeric(df['latitude']).to_numpy())
+        xi = _axisIndex(grid[1], pd.to_numeric(df['longitude']).to_numpy())
+        values = {name: pd.to_numeric(df[name], errors='coerce').to_numpy(dtype='float32') for name in variables}
+        for t in np.unique(times):
+            rows = times == t
+            if t not in steps:
+                steps[t] = {name: np.full((len(grid[0]), len(grid[1])), np.nan, dtype='float32')
+                            for name in variables}
+            for name in variables:
+                steps[t][name][yi[rows], xi[rows]] = values[name][rows]
+
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        with satMetrics.stage('parse'):
+            if grid is None:
+                ## the chunks are kept until the first time step is complete
+                pending.append(chunk)
+                if (chunk['time'] == pending[0]['time'].iloc[0]).all():
+                    continue
+                grid = _gridAxes(pending)
+                chunk = pd.concat(pending, ignore_index=True)
+                pending = []
+            fill(chunk)
+    with satMetrics.stage('parse'):
+        if grid is None and pending:
+            grid = _gridAxes(pending)
+            fill(pd.concat(pending, ignore_index=True))
+        if grid is None:
+            grid = (np.array([], dtype='float64'), np.array([], dtype='float64'))
+        time = np.array(sorted(steps), dtype='datetime64[ns]')
+        ## the arrays of the time steps are moved one at a time, each freed once copied
+        cube = {name: np.empty((len(time), len(grid[0]), len(grid[1])), dtype='float32') for name in variables}
+        for i, t in enumerate(time):
+            step = steps.pop(t)
+            for name in variables:
+                cube[name][i] = step.pop(name)
+    return {'time': time, 'latitude': grid[0], 'longitude': grid[1], 'variables': cube,
+            'units': {name: unit for name, unit in zip(names, units) if name not in satWriters.DIMENSIONS}}
+
+
+def mergeCubes(cubes):
+    """
+    join the cubes of the tiles of a request. The grid cells repeated at the tile boundaries are taken once
+    :param cubes: list of cubes with the same variables
+    :return: cube
+    """
+    import numpy as np
+
+    if len(cubes) == 1:
+        return cubes[0]
+    axes = {axis: np.unique(np.concatenate([cube[axis] for cube in cubes])) for axis in satCube.AXES}
+    shape = tuple(len(axes[axis]) for axis in satCube.AXES)
+    variables = {name: np.full(shape, np.nan, dtype='float32') for name in cubes[0]['variables']}
+    for cube in cubes:
+        index = np.ix_(*[np.searchsorted(axes[axis], cube[axis]) for axis in satCube.AXES])
+        for name, values in cube['variables'].items():
+            variables[name][index] = values
+    result = dict(axes)
+    result.update({'variables': variables, 'units': cubes[0]['units']})
+    return result
+
+
+def loadURLs(urls, workers=4, lock=None):
+    """
+    retrieve ERDDAP griddap requests and decode them in memory as a single cube.
+    The format of each response (csv or nc) is taken from its url
+    :param urls: ERDDAP request url, or list of urls of the tiles of a large request
+    :param workers: number of tiles retrieved at the same time
+    :param lock: optional semaphore limiting the number of simultaneous requests to the host
+    :return: cube, like ncCube
+    """
+    if isinstance(urls, str):
+        urls = [urls]
+    record = satMetrics.current()
+
+    def loadOne(url):
+        decode = ncCube if _transfer(url) == 'nc' else csvCube
+        with satMetrics.attach(record), lock or contextlib.nullcontext():
+            ## the requests of other threads to the same dataset may be answered by a single query, see satCoalesce
+            shared = satCoalesce.share(url)
+            if shared is not None:
+                return shared[0].cube(shared[1], decode)
+            return decode(response(url))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, len(urls)))) as pool:
+        return mergeCubes(list(pool.map(loadOne, urls)))
+
+
+def cubeFrame(cube):
+    """
+    convert a cube to a table with one row per time, latitude and longitude, and the time as datetime64.
+    The units are kept in the attrs of the data frame
+    :param cube: cube, like ncCube
+    :return: pandas data frame
+    """
+    import pandas as pd
+
+    coords = [(axis, cube[axis]) for axis in satCube.AXES]
+    size = len(cube['time']) * len(cube['latitude']) * len(cube['longitude'])
+    frames = list(satCube.cubeChunks(coords, cube['variables'], chunksize=max(1, size)))
+    df = frames[0] if frames else pd.DataFrame(columns=satCube.AXES + list(cube['variables']))
+    df.attrs['units'] = dict(cube.get('units', {}))
+    return df
+
+
+def loadCube(par, lat_min, lat_max, lon_min, lon_max, date_start, date_end=None, fout=None, transfer='nc', workers=4,
+             max_cells=satChunker.MAX_CELLS, target_cells=None, resolution=None):
+    """
+    get a getSatProd parameter as a cube of labelled numpy arrays, decoded from the responses in memory.
+    Large requests are split in tiles retrieved in parallel and joined in the same cube
+    :param par: getSatProd parameter code name, like sst or dhw
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd. Default: start date
+    :param fout: optional output file, also written. The extension gives the format: csv, parquet, arrow or nc
+    :param transfer: format of the ERDDAP responses: nc (decoded without building a table) or csv
+    :param workers: number of tiles retrieved at the same time
+    :param max_cells: larger requests are split in tiles of at most max_cells values. 0 disables the splitting
+    :param target_cells: if given, the grid is decimated on the server to at most this number of values per variable
+    :param resolution: if given, the grid is decimated on the server to this spacing in degrees
+    :return: cube, a dictionary with the time, latitude and longitude coordinates, the variables as float32 arrays
+             (time, latitude, longitude) and their units. None if the request is outside the coverage of the dataset
+    """
+    import getSatProd
+
+    with satMetrics.request(par):
+        plan = getSatProd.planParam(par, lat_min, lat_max, lon_min, lon_max, date_start, date_end or date_start,
+                                    max_cells, target_cells, resolution)
+        if plan is None:
+            satMetrics.fail('outside the coverage of the dataset')
+            return None
+        urls = [satTransfer.toFormat(url, transfer) for url in plan[0]]
+        cube = loadURLs(urls, workers)
+        if fout:
+            satCube.writeCube(cube, fout)
+    return cube
+
+
+def loadFrame(par, lat_min, lat_max, lon_min, lon_max, date_start, date_end=None, fout=None, transfer='nc', workers=4,
+              max_cells=satChunker.MAX_CELLS, target_cells=None, resolution=None):
+    """
+    get a getSatProd parameter as a pandas data frame, decoded from the responses in memory.
+    The parameters are the same as loadCube
+    :return: data frame with time (datetime64), latitude, longitude and the variables, and their units in
+             df.attrs['units']. None if the request is outside the coverage of the dataset
+    """
+    cube = loadCube(par, lat_min, lat_max, lon_min, lon_max, date_start, date_end, fout, transfer, workers, max_cells,
+                    target_cells, resolution)
+    return None if cube is None else cubeFrame(cube)
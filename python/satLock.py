@@ -0,0 +1,30 @@
+import os
+import contextlib
+
+
+@contextlib.contextmanager
+def fileLock(fname, blocking=True):
+    """
+    exclusive lock shared by the threads and the processes, on the hidden file .fname.lock next to fname. Without
+    fcntl (Windows) nothing is locked
+    :param fname: name of the file protected by the lock
+    :param blocking: if False, do not wait when the lock is held by others
+    :return: True if the lock was taken, False if it is held by others and blocking is False
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    folder = os.path.dirname(os.path.abspath(fname))
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, '.' + os.path.basename(fname) + '.lock'), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
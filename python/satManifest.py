@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import contextlib
+import concurrent.futures
+
+import satCoalesce
+import satLock
+import satMetrics
+import satStream
+import satTransfer
+
+## states of the work units and outputs of a run
+STATES = ['planned', 'running', 'done', 'failed']
+
+
+def _options(run):
+    ## options of a run that must match to resume it, as saved in the manifest
+    return json.loads(json.dumps({key: value for key, value in (run or {}).items() if key != 'params'}))
+
+
+def runKey(run):
+    """
+    short key of the options of a run. The products are not included, see sameRun
+    :param run: dictionary with the options of the run
+    :return: 8 hex digits
+    """
+    return hashlib.sha256(json.dumps(_options(run), sort_keys=True).encode('utf-8')).hexdigest()[:8]
+
+
+def manifestName(outpath, locality, run=None):
+    """
+    manifest of the runs of a locality with the same options: outpath/locality.key.manifest.json, so the runs with
+    other dates or options do not replace it
+    :param outpath: output path of the run
+    :param locality: name of the locality
+    :param run: dictionary with the options of the run, see runKey. Without options: outpath/locality.manifest.json
+    :return: file name
+    """
+    if run is None:
+        return os.path.join(outpath, locality + '.manifest.json')
+    return os.path.join(outpath, '{}.{}.manifest.json'.format(locality, runKey(run)))
+
+
+def checksum(fname):
+    """
+    :param fname: file name
+    :return: sha256 of the file, in hex
+    """
+    digest = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _valid(fname, sha256):
+    return bool(sha256) and os.path.exists(fname) and checksum(fname) == sha256
+
+
+def sameRun(a, b):
+    """
+    check if two runs have the same options, as saved in the manifest. The products are not compared, as each one
+    has its own units and output
+    :param a: dictionary with the options of a run
+    :param b: dictionary with the options of the other run
+    :return: True if the same
+    """
+    return a is not None and _options(a) == _options(b)
+
+
+class Manifest:
+    """
+    record of the work of a run: the work units (one request of a product for a region and time chunk, the tiles of
+    a large request) and the output of each product, with their state and checksums. It is saved after every change,
+    so after an interrupted run or a failed product the run can be resumed with the units missing or failed only.
+    The runs at the same time with the same options share the manifest: it is saved under a file lock, and every run
+    only changes the products it planned
+    """
+    def __init__(self, fname, run, resume=False):
+        """
+        :param fname: manifest file, see manifestName
+        :param run: dictionary with the options of the run
+        :param resume: if True, the units and outputs done by a previous run with the same options are kept. The
+                       products may differ, a previous run with other options is not resumed
+        """
+        self.fname = fname
+        self.folder = os.path.dirname(os.path.abspath(fname))
+        self.parts = os.path.join(self.folder, '.' + os.path.basename(fname).replace('.manifest.json', '') + '.parts')
+        self._lock = threading.Lock()
+        self._planned = set()
+        previous = None
+        if resume:
+            try:
+                with open(fname) as f:
+                    previous = json.load(f)
+            except (OSError, ValueError):
+                print('WARNING: no manifest to resume in {}'.format(fname))
+        if previous is not None and not sameRun(previous.get('run'), run):
+            print('WARNING: the run in {} has other options, it is not resumed'.format(fname))
+            previous = None
+        self.data = {'run': run, 'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                     'units': {}, 'outputs': {}}
+        if previous is not None:
+            self.data['units'] = previous.get('units', {})
+            self.data['outputs'] = previous.get('outputs', {})
+        self.save()
+
+    def save(self):
+        with self._lock, satLock.fileLock(self.fname):
+            ## the products of the other runs are taken as saved by them
+            try:
+                with open(self.fname) as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                saved = None
+            if saved is not None and sameRun(saved.get('run'), self.data['run']):
+                for section in ('units', 'outputs'):
+                    ours = {key: value for key, value in self.data[section].items()
+                            if self._product(section, key, value) in self._planned}
+                    self.data[section] = {key: value for key, value in saved.get(section, {}).items()
+                                          if self._product(section, key, value) not in self._planned}
+                    self.data[section].update(ours)
+            text = json.dumps(self.data, indent=1)
+            with satStream.atomicOutput(self.fname) as tmp, open(tmp, 'w') as f:
+                f.write(text)
+
+    @staticmethod
+    def _product(section, key, value):
+        return value.get('param') if section == 'units' else key
+
+    def _set(self, section, key, **fields):
+        with self._lock:
+            self.data[section].setdefault(key, {}).update(fields, updated=time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                                                      time.gmtime()))
+        self.save()
+
+    def isDone(self, par, outpath):
+        """
+        check if the output of a product was written by a previous run and has not changed since
+        :param par: parameter code name
+        :param outpath: output path of the run
+        :return: the output file name (or list of files) if done, None otherwise
+        """
+        output = self.data['outputs'].get(par)
+        if not output or output.get('state') != 'done':
+            return None
+        files = output['files']
+        if all(_valid(os.path.join(outpath, f), output['sha256'].get(f)) for f in files):
+            return files[0] if len(files) == 1 else files
+        return None
+
+    def plan(self, par, urls):
+        """
+        register the work units of a product. The units of a previous run with the same request are kept
+        :param par: parameter code name
+        :param urls: list of the urls of the requests of the product
+        """
+        with self._lock:
+            self._planned.add(par)
+            units = self.data['units']
+            for i, url in enumerate(urls):
+                key = '{}/{}'.format(par, i)
+                if units.get(key, {}).get('url') == url:
+                    continue
+                query = satCoalesce.parseQuery(url) or {}
+                units[key] = {'param': par, 'url': url, 'region': list(query.get('lat', ())) +
+                              list(query.get('lon', ())), 'time': list(query.get('time', ())), 'state': 'planned'}
+            for key in [key for key, unit in units.items() if unit['param'] == par and
+                        int(key.split('/')[1]) >= len(urls)]:
+                del units[key]
+            self.data['outputs'][par] = {'state': 'planned', 'files': [], 'sha256': {}}
+        self.save()
+
+    def fetchUnits(self, par, urls, workers=1, lock=None, transfer='csv'):
+        """
+        retrieve the units of a product as csv part files, kept until the output of the product is written.
+        The units done by a previous run with a valid part file are not retrieved again
+        :param par: parameter code name
+        :param urls: list of the urls of the units, as given to plan
+        :param workers: number of units retrieved at the same time
+        :param lock: optional semaphore limiting the number of simultaneous requests to the host
+        :param transfer: format of the ERDDAP responses: csv or nc
+        :return: list of part files, in the order of the urls
+        """
+        record = satMetrics.current()
+        folder = os.path.join(self.parts, par)
+        os.makedirs(folder, exist_ok=True)
+
+        def fetchOne(i, url):
+            key = '{}/{}'.format(par, i)
+            part = os.path.join(folder, '{:05d}.csv'.format(i))
+            unit = self.data['units'][key]
+            if unit['state'] == 'done' and _valid(part, unit.get('sha256')):
+                return part
+            self._set('units', key, state='running', error=None)
+            try:
+                with satMetrics.attach(record), lock or contextlib.nullcontext():
+                    fname = satTransfer.fetchCSV(url, transfer)
+                with satStream.atomicOutput(part) as tmp:
+                    shutil.copyfile(fname, tmp)
+            except Exception as e:
+                self._set('units', key, state='failed', error=str(e))
+                raise
+            self._set('units', key, state='done', sha256=checksum(part), bytes=os.path.getsize(part))
+            return part
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [pool.submit(fetchOne, i, url) for i, url in enumerate(urls)]
+            concurrent.futures.wait(futures)
+        failed = [f.exception() for f in futures if f.exception() is not None]
+        if failed:
+            raise RuntimeError('{} of {} units failed: {}'.format(len(failed), len(urls), failed[0]))
+        return [f.result() for f in futures]
+
+    def unitState(self, par, state, error=None):
+        """
+        set the state of the units of a product retrieved in a single request
+        :param par: parameter code name
+        :param state: running, done or failed
+        :param error: error message, for failed
+        """
+        self._set('units', '{}/0'.format(par), state=state, error=error)
+
+    def finish(self, par, outpath, files, rows=None):
+        """
+        record the output of a product with its checksums and remove its part files
+        :param par: parameter code name
+        :param outpath: output path of the run
+        :param files: output file name, or list of file names, relative to outpath
+        :param rows: number of rows written
+        """
+        files = [files] if isinstance(files, str) else list(files)
+        self._set('outputs', par, state='done', files=files, rows=rows, error=None,
+                  sha256={f: checksum(os.path.join(outpath, f)) for f in files})
+        shutil.rmtree(os.path.join(self.parts, par), ignore_errors=True)
+        if os.path.isdir(self.parts) and not os.listdir(self.parts):
+            os.rmdir(self.parts)
+
+    def fail(self, par, error):
+        """
+        record a failed product
+        :param par: parameter code name
+        :param error: exception or message
+        """
+        self._set('outputs', par, state='failed', error=str(error))
+
+    def summary(self):
+        """
+        :return: number of units in each state
+        """
+        counts = dict.fromkeys(STATES, 0)
+        for unit in self.data['units'].values():
+            counts[unit['state']] += 1
+        return counts
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import datetime
+import tempfile
+import argparse
+import threading
+import urllib.parse
+
+import satCache
+import satChunker
+from satLazy import lazyImport
+
+## urllib and http are loaded with the first request
+satHTTP = lazyImport('satHTTP')
+
+## the metadata of a dataset is read again from the server after META_REFRESH seconds, as the time coverage grows
+META_REFRESH = 24 * 3600
+
+## approximate size of a value in the ERDDAP responses, in bytes. The csv repeats the coordinates in every row
+CSV_ROW_BYTES = 50
+CSV_VALUE_BYTES = 10
+NC_VALUE_BYTES = 4
+
+## a constraint is taken to the closest value of the grid. The position on the grid is rounded to GRID_DECIMALS
+## first, so the rounding errors of the spacing do not decide the constraints half way between two grid values,
+## which go to the even one like round
+GRID_DECIMALS = 6
+
+_memory = {}
+_lock = threading.Lock()
+
+
+def infoURL(url):
+    """
+    url of the ERDDAP info page of the dataset of a griddap request
+    :param url: ERDDAP griddap request url (or url template)
+    :return: url of the info page, in json
+    """
+    parts = urllib.parse.urlsplit(url)
+    root = parts.path.split('/griddap/')[0]
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, root + '/info/' + satChunker.datasetID(url) +
+                                    '/index.json', '', ''))
+
+
+def _number(value):
+    return float(str(value).strip())
+
+
+def parseInfo(info):
+    """
+    extract the dimensions of a dataset from its ERDDAP info page
+    :param info: parsed json of the info page
+    :return: dictionary {dimension: {n, min, max, spacing}}. The time is in seconds since 1970-01-01 and its
+             spacing in days
+    """
+    table = info['table']
+    rows = [dict(zip(table['columnNames'], row)) for row in table['rows']]
+    dims = {}
+    for row in rows:
+        if row['Row Type'] == 'dimension':
+            values = dict(item.strip().split('=', 1) for item in row['Value'].split(',') if '=' in item)
+            dims[row['Variable Name']] = {'n': int(values.get('nValues', 1))}
+    for row in rows:
+        if row['Variable Name'] in dims and row['Attribute Name'] == 'actual_range':
+            low, high = sorted(_number(v) for v in row['Value'].split(','))
+            dims[row['Variable Name']].update({'min': low, 'max': high})
+    for name, dim in dims.items():
+        if 'min' not in dim:
+            continue
+        spacing = (dim['max'] - dim['min']) / (dim['n'] - 1) if dim['n'] > 1 else 0
+        dim['spacing'] = spacing / 86400 if name == 'time' else spacing
+    return dims
+
+
+def _metaFile(url):
+    host = urllib.parse.urlsplit(url).netloc.replace(':', '_')
+    return os.path.join(satCache.CACHE_DIR, 'info', host + '_' + satChunker.datasetID(url) + '.json')
+
+
+def getMeta(url, refresh=META_REFRESH):
+    """
+    get the dimensions, spacing and time coverage of the dataset of a request. The metadata is kept in the
+    cache directory and read again from the ERDDAP info page after refresh seconds. If the server is not
+    available an older copy is used
+    :param url: ERDDAP griddap request url (or url template)
+    :param refresh: seconds before the metadata is read again
+    :return: dictionary {dimension: {n, min, max, spacing}}, as returned by parseInfo, or None if not available
+    """
+    key = infoURL(url)
+    with _lock:
+        meta = _memory.get(key)
+    fname = _metaFile(url) if satCache.isEnabled() else None
+    if meta is None and fname and os.path.exists(fname):
+        try:
+            with open(fname) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = None
+    if meta is not None and time.time() - meta['fetched'] < refresh:
+        return meta['dimensions']
+
+    try:
+        with satHTTP.urlopen(key, retries=2) as response:
+            dims = parseInfo(json.loads(response.read().decode('utf-8')))
+    except Exception as e:
+        if meta is not None:
+            return meta['dimensions']
+        print('WARNING: no metadata for {} ({})'.format(satChunker.datasetID(url), e))
+        return None
+
+    meta = {'url': key, 'fetched': time.time(), 'dimensions': dims}
+    with _lock:
+        _memory[key] = meta
+    if fname:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, fname)
+    return dims
+
+
+def toDateString(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date().isoformat()
+
+
+def _clipAxis(start, end, low, high, tolerance=0):
+    ## keep the direction of the range
+    a, b = sorted((start, end))
+    if b < low - tolerance or a > high + tolerance:
+        return None
+    a, b = min(max(a, low), high), min(max(b, low), high)
+    return (a, b) if start <= end else (b, a)
+
+
+def clipRequest(dims, lat_min, lat_max, lon_min, lon_max, date_start, date_end):
+    """
+    clip a request to the coverage of the dataset. Relative end dates, like last, are kept.
+    Coordinates given as None are not checked
+    :param dims: dataset dimensions, as returned by getMeta
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd
+    :return: dictionary with the clipped lat_min, lat_max, lon_min, lon_max, date_start, date_end,
+             or None if the request is outside the coverage
+    """
+    request = dict(lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max,
+                   date_start=date_start, date_end=date_end)
+    for name, low, high in (('latitude', 'lat_min', 'lat_max'), ('longitude', 'lon_min', 'lon_max')):
+        dim = dims.get(name)
+        if not dim or 'min' not in dim or request[low] is None:
+            continue
+        start, end = float(request[low]), float(request[high])
+        ## the grid cells extend half a spacing beyond the coordinates
+        clipped = _clipAxis(start, end, dim['min'], dim['max'], dim['spacing'] / 2)
+        if clipped is None:
+            return None
+        if clipped != (start, end):
+            request[low], request[high] = [round(v, 6) for v in clipped]
+
+    dim = dims.get('time')
+    if dim and 'min' in dim:
+        first, last = toDateString(dim['min']), toDateString(dim['max'])
+        relative = not str(date_end)[:4].isdigit()
+        if str(date_start)[:10] > last or (not relative and str(date_end)[:10] < first):
+            return None
+        if str(date_start)[:10] < first:
+            request['date_start'] = first
+        if not relative and str(date_end)[:10] > last:
+            request['date_end'] = last
+    return request
+
+
+def estimate(dims, request, nvars=1, time_step=1, spacing=0.01):
+    """
+    estimate the size of a request before sending it
+    :param dims: dataset dimensions, as returned by getMeta. If None the time step and spacing are used
+    :param request: dictionary with lat_min, lat_max, lon_min, lon_max, date_start, date_end and optionally
+                    the time_stride and stride of a decimated request
+    :param nvars: number of variables requested
+    :param time_step: time step in days, if there is no metadata
+    :param spacing: grid spacing in degrees, if there is no metadata
+    :return: dictionary with the number of values (cells) and the approximate csv and nc bytes
+    """
+    if dims:
+        time_step, spacing = datasetSpacing(dims, (time_step, spacing))
+    n_time, n_lat, n_lon = satChunker.gridSize(request['lat_min'], request['lat_max'], request['lon_min'],
+                                               request['lon_max'], request['date_start'], request['date_end'],
+                                               time_step * request.get('time_stride', 1),
+                                               spacing * request.get('stride', 1))
+    cells = n_time * n_lat * n_lon
+    return {'cells': cells * nvars,
+            'csv': cells * (CSV_ROW_BYTES + CSV_VALUE_BYTES * nvars),
+            'nc': cells * NC_VALUE_BYTES * nvars}
+
+
+def datasetSpacing(dims, default=(1, 0.01)):
+    """
+    time step and grid spacing of a dataset, from its metadata
+    :param dims: dataset dimensions, as returned by getMeta
+    :param default: (time step in days, spacing in degrees) used for what is missing in the metadata
+    :return: (time step in days, spacing in degrees)
+    """
+    time_step, spacing = default
+    if dims and dims.get('time', {}).get('spacing'):
+        time_step = max(1, int(round(dims['time']['spacing'])))
+    if dims and dims.get('latitude', {}).get('spacing'):
+        spacing = dims['latitude']['spacing']
+    return time_step, spacing
+
+
+def gridAxis(dims, axis):
+    """
+    grid of a latitude or longitude axis of a dataset
+    :param dims: dataset dimensions, as returned by getMeta
+    :param axis: latitude or longitude
+    :return: (origin, spacing) in degrees, or None if it is not in the metadata
+    """
+    dim = (dims or {}).get(axis, {})
+    if 'min' not in dim or not dim.get('spacing'):
+        return None
+    return dim['min'], dim['spacing']
+
+
+def gridPosition(value, origin, spacing):
+    """
+    position of a coordinate on a grid, in grid cells from the origin
+    :param value: coordinate
+    :param origin: first value of the grid
+    :param spacing: grid spacing
+    :return: float, rounded to GRID_DECIMALS
+    """
+    return round((float(value) - origin) / spacing, GRID_DECIMALS)
+
+
+def closestIndex(value, origin, spacing):
+    """
+    index of the grid value closest to a coordinate, the cell ERDDAP gives for a constraint. The archive, the
+    coalesced requests, the site snapping and the mock server of satBench all use this rule
+    :param value: coordinate
+    :param origin: first value of the grid
+    :param spacing: grid spacing
+    :return: index, not clipped to the size of the grid
+    """
+    return int(round(gridPosition(value, origin, spacing)))
+
+
+def isHalfway(value, origin, spacing):
+    """
+    check if a coordinate is half way between two grid values. A server may give either of them
+    :param value: coordinate
+    :param origin: first value of the grid
+    :param spacing: grid spacing
+    :return: True if half way
+    """
+    position = gridPosition(value, origin, spacing)
+    return position - int(position // 1) == 0.5
+
+
+def preflight(url, lat_min, lat_max, lon_min, lon_max, date_start, date_end, max_cells=satChunker.MAX_CELLS,
+              nvars=None, target_cells=None, resolution=None):
+    """
+    check a request against the dataset metadata before sending it: clip it to the coverage, choose the strides
+    of a decimated request, estimate its size and warn when it is larger than max_cells and will not be split
+    :param url: ERDDAP griddap request url (or url template)
+    :param lat_min: latitude min
+    :param lat_max: latitude max
+    :param lon_min: longitude min
+    :param lon_max: longitude max
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd
+    :param max_cells: maximum number of values of a request. 0 or None if the request will not be split
+    :param nvars: number of variables requested. Default: counted in the url
+    :param target_cells: if given, the grid is decimated to at most this number of values per variable
+    :param resolution: if given, the grid is decimated to this spacing in degrees
+    :return: (clipped request with its time_stride and stride or None if outside the coverage,
+              (time step, spacing) of the dataset, size estimate)
+    """
+    dims = getMeta(url)
+    request = dict(lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max,
+                   date_start=date_start, date_end=date_end)
+    grid = datasetSpacing(dims, satChunker.gridSpacing(url))
+    if dims:
+        clipped = clipRequest(dims, **request)
+        if clipped is None:
+            print('WARNING: request outside the coverage of {}'.format(satChunker.datasetID(url)))
+            return None, grid, None
+        if clipped != request:
+            print('WARNING: request clipped to the coverage of {}: {}'.format(
+                satChunker.datasetID(url), ', '.join('{}={}'.format(k, v) for k, v in clipped.items()
+                                                     if v != request[k])))
+        request = clipped
+    n_time, n_lat, n_lon = satChunker.gridSize(time_step=grid[0], spacing=grid[1], **request)
+    request['time_stride'], request['stride'] = satChunker.chooseStrides(n_time, n_lat, n_lon, grid[1], target_cells,
+                                                                         resolution)
+    if nvars is None:
+        nvars = max(1, len(re.findall(r'(?:^|,)\w+\[', urllib.parse.unquote(urllib.parse.urlsplit(url).query))))
+    size = estimate(dims, request, nvars, *grid)
+    if not max_cells and size['cells'] > satChunker.MAX_CELLS:
+        print('WARNING: large request for {}: {} values, about {:.0f} MB'.format(
+            satChunker.datasetID(url), size['cells'], size['csv'] / 1048576))
+    return request, grid, size
+
+
+if __name__ == '__main__':
+    from getSatProd import SOURCES
+
+    parser = argparse.ArgumentParser(description='Show the coverage of the getSatProd datasets, read from the ERDDAP '
+                                                 'info pages, and the estimated size of a request')
+    parser.add_argument('-param', dest='param', help='code name of the parameters, like sst. Default all',
+                        nargs='+', required=False)
+    parser.add_argument('-lat', dest='lat', help='latitude min and max of the request', nargs=2, type=float,
+                        required=False)
+    parser.add_argument('-lon', dest='lon', help='longitude min and max of the request', nargs=2, type=float,
+                        required=False)
+    parser.add_argument('-ds', dest='date_start', help='start date of the request in yyyy-mm-dd', required=False)
+    parser.add_argument('-de', dest='date_end', help='end date of the request in yyyy-mm-dd', required=False)
+    parser.add_argument('-refresh', dest='refresh', help='read the metadata again from the servers', action='store_true',
+                        required=False)
+    args = parser.parse_args()
+
+    for par in args.param or list(SOURCES):
+        dims = getMeta(SOURCES[par], 0 if args.refresh else META_REFRESH)
+        if dims is None:
+            continue
+        time_step, spacing = datasetSpacing(dims, satChunker.gridSpacing(SOURCES[par]))
+        line = '{}: {}'.format(par, satChunker.datasetID(SOURCES[par]))
+        if 'min' in dims.get('time', {}):
+            line += ', {} to {} every {} days'.format(toDateString(dims['time']['min']),
+                                                      toDateString(dims['time']['max']), time_step)
+        line += ', {:.4f} degrees'.format(spacing)
+        if args.lat and args.lon and args.date_start:
+            request, grid, size = preflight(SOURCES[par], args.lat[0], args.lat[1], args.lon[0], args.lon[1],
+                                            args.date_start, args.date_end or args.date_start, 0)
+            if size:
+                line += ', request: {} values, about {:.1f} MB csv, {:.1f} MB nc'.format(
+                    size['cells'], size['csv'] / 1048576, size['nc'] / 1048576)
+        print(line)
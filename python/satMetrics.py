@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import functools
+import threading
+import contextlib
+
+import satLock
+
+## where the metrics are written. Set with the environment variables:
+## SSTTOOLS_METRICS: file where a json line is appended for every request of a product
+## SSTTOOLS_METRICS_PROM: Prometheus textfile (for the node exporter textfile collector) with the totals of all the
+##                        runs writing to it, rewritten after every request. The totals are kept in the same file
+##                        name with .json, and the processes running at the same time add to them under a file lock
+## SSTTOOLS_PROFILE: directory where a cProfile of the parse stage of every request is saved
+METRICS_FILE = os.environ.get('SSTTOOLS_METRICS', '')
+PROM_FILE = os.environ.get('SSTTOOLS_METRICS_PROM', '')
+PROFILE_DIR = os.environ.get('SSTTOOLS_PROFILE', '')
+
+## timed stages, in seconds. dns, connect, first_byte and transfer are summed over the HTTP requests of a record.
+## connect includes the TLS handshake
+STAGES = ['dns', 'connect', 'first_byte', 'transfer', 'parse', 'write']
+
+## counters of every record
+COUNTERS = ['requests', 'retries', 'failovers', 'cache_hits', 'cache_misses', 'cache_revalidated', 'coalesced', 'bytes',
+            'rows', 'cells']
+
+## profiling hook: function called with the record that returns a context manager wrapped around every parse.
+## Default: cProfile when SSTTOOLS_PROFILE is set
+PROFILE_HOOK = None
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class Record:
+    """
+    metrics of the request of a product: timings of each stage, bytes, rows, retries and cache use.
+    The HTTP requests, parsing and writing done while it is the current record of a thread add to it
+    """
+    def __init__(self, product, tool=None):
+        self.product = product
+        self.tool = tool or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+        self.started = time.time()
+        self.values = dict.fromkeys(STAGES, 0.0)
+        self.values.update(dict.fromkeys(COUNTERS, 0))
+        self.status = 'ok'
+        self.error = None
+        self.seconds = None
+        self.profile = None
+        self._lock = threading.Lock()
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.values[name] += value
+
+    def asDict(self):
+        result = {'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+                  'tool': self.tool, 'product': self.product, 'status': self.status, 'error': self.error,
+                  'seconds': round(self.seconds or 0, 4)}
+        result.update({name: round(value, 4) if name in STAGES else value for name, value in self.values.items()})
+        return result
+
+
+def isEnabled():
+    """
+    check if the metrics are written anywhere
+    :return: True if enabled
+    """
+    return bool(METRICS_FILE or PROM_FILE or PROFILE_DIR or PROFILE_HOOK)
+
+
+def current():
+    """
+    :return: the current record of this thread, or None
+    """
+    return getattr(_local, 'record', None)
+
+
+@contextlib.contextmanager
+def attach(record):
+    """
+    make a record the current one of this thread, like in the workers that download the tiles of a request
+    :param record: Record or None
+    """
+    previous = current()
+    _local.record = record
+    try:
+        yield record
+    finally:
+        _local.record = previous
+
+
+@contextlib.contextmanager
+def request(product, tool=None):
+    """
+    measure the request of a product, from the download to the output file. The record is written when it ends
+    :param product: product name, like sst or MURSST
+    :param tool: name of the tool. Default: name of the script
+    :return: the Record
+    """
+    record = Record(product, tool)
+    started = time.perf_counter()
+    try:
+        with attach(record):
+            yield record
+    except BaseException as e:
+        fail(e, record)
+        raise
+    finally:
+        record.seconds = time.perf_counter() - started
+        emit(record)
+
+
+def instrument(product):
+    """
+    decorator that measures every call of a function as the request of a product, like the harvesters
+    :param product: product name
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with request(product):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(name, value=1):
+    """
+    add to a counter or stage of the current record, if any
+    :param name: counter or stage name
+    :param value: value to add
+    """
+    record = current()
+    if record is not None:
+        record.add(name, value)
+
+
+def fail(error, record=None):
+    """
+    mark a record as failed
+    :param error: exception or message
+    :param record: Default the current record
+    """
+    record = record or current()
+    if record is not None:
+        record.status = 'failed'
+        record.error = str(error)
+
+
+@contextlib.contextmanager
+def _cProfile(record):
+    import cProfile
+
+    if record.profile is None:
+        record.profile = cProfile.Profile()
+    try:
+        record.profile.enable()
+    except ValueError:
+        ## another profiler is active in this thread
+        yield
+        return
+    try:
+        yield
+    finally:
+        record.profile.disable()
+
+
+@contextlib.contextmanager
+def stage(name):
+    """
+    time a stage of the current record. The parse stage is wrapped by the profiling hook
+    :param name: stage name: dns, connect, first_byte, transfer, parse or write
+    """
+    record = current()
+    if record is None:
+        yield
+        return
+    hook = PROFILE_HOOK or (_cProfile if PROFILE_DIR else None)
+    started = time.perf_counter()
+    try:
+        if name == 'parse' and hook is not None:
+            with hook(record):
+                yield
+        else:
+            yield
+    finally:
+        record.add(name, time.perf_counter() - started)
+
+
+def timed(name, iterator):
+    """
+    time the production of the items of an iterator as a stage of the current record, like the chunks of a parser
+    :param name: stage name
+    :param iterator: iterator
+    :return: iterator with the same items
+    """
+    iterator = iter(iterator)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def countRows(names, rows):
+    """
+    add the rows written and their values (rows by variables) to the current record
+    :param names: column names
+    :param rows: number of rows
+    """
+    import satWriters
+
+    add('rows', rows)
+    add('cells', rows * len([name for name in names if name not in satWriters.DIMENSIONS]))
+
+
+def _writeAtomic(fname, text):
+    folder = os.path.dirname(os.path.abspath(fname))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, fname)
+
+
+def _addRecord(totals, record):
+    ## add a record to the totals of its tool and product
+    entry = totals.setdefault((record.tool, record.product), {'values': {}, 'status': {}, 'seconds': 0, 'success': 0})
+    for name, value in record.values.items():
+        entry['values'][name] = entry['values'].get(name, 0) + value
+    entry['status'][record.status] = entry['status'].get(record.status, 0) + 1
+    entry['seconds'] = record.seconds or 0
+    if record.status == 'ok':
+        entry['success'] = time.time()
+
+
+def _readTotals(fname):
+    try:
+        with open(fname) as f:
+            return {(item['tool'], item['product']): item['totals'] for item in json.load(f)}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def _writeTotals(fname, totals):
+    _writeAtomic(fname, json.dumps([{'tool': t, 'product': p, 'totals': entry}
+                                    for (t, p), entry in sorted(totals.items())]))
+
+
+def _prometheus(totals):
+    ## text of the Prometheus textfile with the totals {(tool, product): totals}
+    def labels(tool, product, **extra):
+        items = [('tool', tool), ('product', product)] + sorted(extra.items())
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + '}'
+
+    lines = []
+
+    def metric(name, kind, text, samples):
+        lines.append('# HELP ssttools_{} {}'.format(name, text))
+        lines.append('# TYPE ssttools_{} {}'.format(name, kind))
+        lines.extend('ssttools_{}{} {}'.format(name, label, value) for label, value in samples)
+
+    keys = sorted(totals)
+    metric('runs_total', 'counter', 'requests of a product, by status',
+           [(labels(t, p, status=s), n) for t, p in keys for s, n in sorted(totals[t, p]['status'].items())])
+    for name in COUNTERS:
+        metric(name + '_total', 'counter', name.replace('_', ' '),
+               [(labels(t, p), totals[t, p]['values'].get(name, 0)) for t, p in keys])
+    metric('stage_seconds_total', 'counter', 'seconds spent in each stage',
+           [(labels(t, p, stage=s), round(totals[t, p]['values'].get(s, 0), 6)) for t, p in keys for s in STAGES])
+    metric('last_run_seconds', 'gauge', 'duration of the last request of a product',
+           [(labels(t, p), round(totals[t, p]['seconds'], 6)) for t, p in keys])
+    metric('last_success_timestamp_seconds', 'gauge', 'end of the last successful request of a product',
+           [(labels(t, p), round(totals[t, p]['success'], 3)) for t, p in keys if totals[t, p]['success']])
+    return '\n'.join(lines) + '\n'
+
+
+def emit(record):
+    """
+    write a record as a json line and update the Prometheus textfile and the profile
+    :param record: Record
+    """
+    with _lock:
+        if METRICS_FILE:
+            with open(METRICS_FILE, 'a') as f:
+                f.write(json.dumps(record.asDict()) + '\n')
+        if PROM_FILE:
+            ## the other processes writing the same textfile add their records to the same totals
+            with satLock.fileLock(PROM_FILE):
+                totals = _readTotals(PROM_FILE + '.json')
+                _addRecord(totals, record)
+                _writeTotals(PROM_FILE + '.json', totals)
+                _writeAtomic(PROM_FILE, _prometheus(totals))
+    if PROFILE_DIR and record.profile is not None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        record.profile.dump_stats(os.path.join(PROFILE_DIR, '{}_{}_{}.prof'.format(
+            record.tool, record.product, time.strftime('%Y%m%dT%H%M%S', time.gmtime(record.started)))))
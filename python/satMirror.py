@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import concurrent.futures
+
+import satProducts
+
+## groups of equivalent ERDDAP servers or datasets. The requests to any member of a group can be answered by the
+## others. A member is a whole server (https://host/erddap) or a single dataset (https://host/erddap/griddap/ID),
+## for the datasets published with different IDs (the mirrors of the products, see satProducts). More groups can be
+## given in a json file (a list of lists of urls) with the environment variable SSTTOOLS_MIRRORS, or "off" to send the
+## requests only to their own server
+MIRRORS = satProducts.mirrorGroups() + [
+    ['https://coastwatch.pfeg.noaa.gov/erddap', 'https://upwell.pfeg.noaa.gov/erddap'],
+]
+MIRRORS_FILE = os.environ.get('SSTTOOLS_MIRRORS', '')
+
+## the mirrors without a recent measure of their latency are probed (with the small info page of the dataset)
+## every PROBE_INTERVAL seconds, waiting at most PROBE_TIMEOUT seconds
+PROBE_INTERVAL = 900
+PROBE_TIMEOUT = 10
+
+## a failed mirror is tried last for DOWN_TIME seconds, doubled after every consecutive failure up to MAX_DOWN_TIME
+DOWN_TIME = 60
+MAX_DOWN_TIME = 3600
+
+## weight of the last request in the running mean of the latency of a mirror
+LATENCY_WEIGHT = 0.3
+
+_lock = threading.Lock()
+_stats = {}
+_loaded = False
+
+_URL = re.compile(r'^(?P<root>.*?/erddap)/(?P<kind>griddap|info)/(?P<dataset>[^/.?]+)(?P<rest>.*)$')
+
+
+def isEnabled():
+    """
+    check if the failover to the mirrors is enabled
+    :return: True if enabled
+    """
+    return MIRRORS_FILE.lower() not in ('off', 'none', '0')
+
+
+def register(group):
+    """
+    add a group of equivalent servers or datasets, searched before the built-in ones
+    :param group: list of urls, like ['https://host1/erddap', 'http://127.0.0.1:8080/erddap']
+    """
+    with _lock:
+        MIRRORS.insert(0, [member.rstrip('/') for member in group])
+
+
+def _groups():
+    global _loaded
+    if MIRRORS_FILE and isEnabled() and not _loaded:
+        _loaded = True
+        with open(MIRRORS_FILE) as f:
+            for group in reversed(json.load(f)):
+                register(group)
+    return MIRRORS if isEnabled() else []
+
+
+def _split(member):
+    ## (root, dataset) of a group member. dataset is None for a whole server
+    match = _URL.match(member)
+    if match:
+        return match.group('root'), match.group('dataset')
+    return member, None
+
+
+def mirrors(url):
+    """
+    urls of the same request on all the mirrors of its dataset, the original first
+    :param url: ERDDAP griddap request or info page url
+    :return: list of urls
+    """
+    match = _URL.match(url)
+    if match is None:
+        return [url]
+    root, kind, dataset, rest = match.group('root', 'kind', 'dataset', 'rest')
+    result = [url]
+    for group in _groups():
+        members = [_split(member) for member in group]
+        if (root, dataset) in members:
+            others = [(r, d) for r, d in members if (r, d) != (root, dataset)]
+        elif (root, None) in members:
+            others = [(r, dataset) for r, d in members if d is None and r != root]
+        else:
+            continue
+        for r, d in others:
+            mirror = '{}/{}/{}{}'.format(r, kind, d, rest)
+            if mirror not in result:
+                result.append(mirror)
+    return result
+
+
+def _key(url):
+    ## mirror of an url: server and dataset
+    match = _URL.match(url)
+    return (match.group('root'), match.group('dataset')) if match else (url, None)
+
+
+def record(url, seconds=None):
+    """
+    record the result of a request to a mirror
+    :param url: request url
+    :param seconds: time until the response started, or None if the request failed
+    """
+    now = time.time()
+    with _lock:
+        stats = _stats.setdefault(_key(url), {'latency': None, 'failures': 0, 'down': 0, 'probed': 0})
+        if seconds is None:
+            stats['failures'] += 1
+            stats['down'] = now + min(MAX_DOWN_TIME, DOWN_TIME * 2 ** (stats['failures'] - 1))
+            return
+        if stats['latency'] is None:
+            stats['latency'] = seconds
+        else:
+            stats['latency'] += LATENCY_WEIGHT * (seconds - stats['latency'])
+        stats['failures'] = 0
+        stats['down'] = 0
+
+
+def _probeURL(url):
+    root, dataset = _key(url)
+    return '{}/info/{}/index.json'.format(root, dataset)
+
+
+def probe(urls):
+    """
+    measure the latency of the mirrors with the small info page of their dataset, in parallel
+    :param urls: request urls, one for each mirror
+    """
+    ## satHTTP sends its requests through this module
+    import satHTTP
+
+    def one(url):
+        started = time.time()
+        try:
+            ## a single attempt on the pooled connections, to this mirror only (and its stand-in, see satHTTP)
+            with satHTTP.urlopen(_probeURL(url), retries=1, failover=False, timeout=PROBE_TIMEOUT) as response:
+                response.read()
+        except Exception:
+            record(url, None)
+        else:
+            record(url, time.time() - started)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(urls))) as executor:
+        list(executor.map(one, urls))
+
+
+def candidates(url):
+    """
+    mirrors of a request, in the order they should be tried: the healthy ones first, the fastest first.
+    The mirrors without a measured latency are probed first, at most every PROBE_INTERVAL seconds.
+    Until they are measured the original server is preferred
+    :param url: ERDDAP griddap request or info page url
+    :return: list of urls
+    """
+    urls = mirrors(url)
+    if len(urls) == 1:
+        return urls
+    now = time.time()
+    unknown = []
+    with _lock:
+        for mirror in urls:
+            stats = _stats.setdefault(_key(mirror), {'latency': None, 'failures': 0, 'down': 0, 'probed': 0})
+            if stats['latency'] is None and now - stats['probed'] > PROBE_INTERVAL:
+                stats['probed'] = now
+                unknown.append(mirror)
+    if unknown:
+        probe(unknown)
+
+    def rank(item):
+        i, mirror = item
+        stats = _stats[_key(mirror)]
+        latency = stats['latency']
+        return (stats['down'] > now, latency is None, latency or 0, i)
+
+    with _lock:
+        return [mirror for i, mirror in sorted(enumerate(urls), key=rank)]
+
+
+def status():
+    """
+    health and latency of the mirrors used or probed in this session
+    :return: list of (mirror url, latency in seconds or None, consecutive failures, seconds it is still tried last)
+    """
+    now = time.time()
+    with _lock:
+        return [(root if dataset is None else '{}/griddap/{}'.format(root, dataset), stats['latency'],
+                 stats['failures'], max(0, stats['down'] - now)) for (root, dataset), stats in sorted(_stats.items())]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Probe the mirrors of the getSatProd datasets and show their '
+                                                 'latency and health')
+    parser.add_argument('-param', dest='param', nargs='+', help='getSatProd parameters. Default: all', required=False)
+    args = parser.parse_args()
+
+    import getSatProd
+
+    for param in args.param or sorted(getSatProd.SOURCES):
+        urls = mirrors(getSatProd.SOURCES[param].split('?')[0])
+        probe(urls)
+    for mirror, latency, failures, down in status():
+        print('{:<75} {}'.format(mirror, 'DOWN' if failures else '{:.2f} s'.format(latency)))
@@ -0,0 +1,165 @@
+import os
+import json
+
+## ERDDAP servers of the products
+COASTWATCH = 'https://coastwatch.pfeg.noaa.gov/erddap'
+PACIOOS = 'https://pae-paha.pacioos.hawaii.edu/erddap'
+AOML = 'https://cwcgom.aoml.noaa.gov/erddap'
+
+## registry of the products, by parameter code name:
+## - server: root url of the ERDDAP server
+## - dataset: griddap dataset id
+## - variables: variables requested
+## - extra: constraints of the dimensions between time and latitude, like the altitude axis of the VIIRS chlorophyll
+## - cadence: days between two time steps (30 for the monthly products)
+## - spacing: grid spacing in decimal degrees
+## - mirrors: the same dataset on other servers or with other ids, see satMirror
+## More products can be given (or these replaced) in a json file {code: {server, dataset, variables, ...}} with the
+## environment variable SSTTOOLS_PRODUCTS
+PRODUCTS = {
+    'sst':    {'server': COASTWATCH, 'dataset': 'jplMURSST41', 'variables': ['analysed_sst', 'analysis_error'],
+               'cadence': 1, 'spacing': 0.01, 'description': 'MURSST cloudless sea surface temperature'},
+    'ssta':   {'server': COASTWATCH, 'dataset': 'jplMURSST41anom1day', 'variables': ['sstAnom'],
+               'cadence': 1, 'spacing': 0.01, 'description': 'MURSST sea surface temperature anomaly'},
+    'poc1d':  {'server': COASTWATCH, 'dataset': 'erdMPOC1day', 'variables': ['poc'],
+               'cadence': 1, 'spacing': 1 / 24, 'description': 'MODIS particulate organic carbon, 1 day'},
+    'poc8d':  {'server': COASTWATCH, 'dataset': 'erdMPOC8day', 'variables': ['poc'],
+               'cadence': 8, 'spacing': 1 / 24, 'description': 'MODIS particulate organic carbon, 8 day'},
+    'poc1m':  {'server': COASTWATCH, 'dataset': 'erdMPOCmday', 'variables': ['poc'],
+               'cadence': 30, 'spacing': 1 / 24, 'description': 'MODIS particulate organic carbon, 1 month'},
+    'pic1d':  {'server': COASTWATCH, 'dataset': 'erdMPIC1day', 'variables': ['pic'],
+               'cadence': 1, 'spacing': 1 / 24, 'description': 'MODIS particulate inorganic carbon, 1 day'},
+    'pic8d':  {'server': COASTWATCH, 'dataset': 'erdMPIC8day', 'variables': ['pic'],
+               'cadence': 8, 'spacing': 1 / 24, 'description': 'MODIS particulate inorganic carbon, 8 day'},
+    'pic1m':  {'server': COASTWATCH, 'dataset': 'erdMPICmday', 'variables': ['pic'],
+               'cadence': 30, 'spacing': 1 / 24, 'description': 'MODIS particulate inorganic carbon, 1 month'},
+    'chl1d':  {'server': COASTWATCH, 'dataset': 'nesdisVHNSQchlaDaily', 'variables': ['chlor_a'],
+               'extra': '[(0.0):1:(0.0)]', 'cadence': 1, 'spacing': 0.0375,
+               'description': 'VIIRS chlorophyll a concentration, 1 day'},
+    'chl8d':  {'server': COASTWATCH, 'dataset': 'nesdisVHNSQchlaWeekly', 'variables': ['chlor_a'],
+               'extra': '[(0.0):1:(0.0)]', 'cadence': 8, 'spacing': 0.0375,
+               'description': 'VIIRS chlorophyll a concentration, 8 day'},
+    'chl1m':  {'server': COASTWATCH, 'dataset': 'nesdisVHNSQchlaMonthly', 'variables': ['chlor_a'],
+               'extra': '[(0.0):1:(0.0)]', 'cadence': 30, 'spacing': 0.0375,
+               'description': 'VIIRS chlorophyll a concentration, 1 month'},
+    'mchl1d': {'server': COASTWATCH, 'dataset': 'erdMH1chla1day', 'variables': ['chlorophyll'],
+               'cadence': 1, 'spacing': 1 / 24, 'description': 'MODIS chlorophyll a concentration, 1 day'},
+    'mchl8d': {'server': COASTWATCH, 'dataset': 'erdMH1chla8day', 'variables': ['chlorophyll'],
+               'cadence': 8, 'spacing': 1 / 24, 'description': 'MODIS chlorophyll a concentration, 8 day'},
+    'mchl1m': {'server': COASTWATCH, 'dataset': 'erdMH1chlamday', 'variables': ['chlorophyll'],
+               'cadence': 30, 'spacing': 1 / 24, 'description': 'MODIS chlorophyll a concentration, 1 month'},
+    ## same dataset as coastwatch NOAA_DHW, used as its mirror
+    'dhw':    {'server': PACIOOS, 'dataset': 'dhw_5km',
+               'variables': ['CRW_DHW', 'CRW_HOTSPOT', 'CRW_SST', 'CRW_SSTANOMALY'],
+               'cadence': 1, 'spacing': 0.05, 'mirrors': [COASTWATCH + '/griddap/NOAA_DHW'],
+               'description': 'Coral Reef Watch degree heating week products'},
+    'par1d':  {'server': COASTWATCH, 'dataset': 'erdMH1par01day', 'variables': ['par'],
+               'cadence': 1, 'spacing': 1 / 24, 'description': 'MODIS photosynthetically available radiation, 1 day'},
+    'par8d':  {'server': COASTWATCH, 'dataset': 'erdMH1par08day', 'variables': ['par'],
+               'cadence': 8, 'spacing': 1 / 24, 'description': 'MODIS photosynthetically available radiation, 8 day'},
+    'par1m':  {'server': COASTWATCH, 'dataset': 'erdMH1par0mday', 'variables': ['par'],
+               'cadence': 30, 'spacing': 1 / 24,
+               'description': 'MODIS photosynthetically available radiation, 1 month'},
+    'pp1d':   {'server': COASTWATCH, 'dataset': 'erdMH1pp1day', 'variables': ['productivity'],
+               'extra': '[(0.0):1:(0.0)]', 'cadence': 1, 'spacing': 1 / 24,
+               'description': 'MODIS primary productivity, 1 day'},
+    'pp3d':   {'server': COASTWATCH, 'dataset': 'erdMH1pp3day', 'variables': ['productivity'],
+               'extra': '[(0.0):1:(0.0)]', 'cadence': 3, 'spacing': 1 / 24,
+               'description': 'MODIS primary productivity, 3 day'},
+    'pp8d':   {'server': COASTWATCH, 'dataset': 'erdMH1pp8day', 'variables': ['productivity'],
+               'extra': '[(0.0):1:(0.0)]', 'cadence': 8, 'spacing': 1 / 24,
+               'description': 'MODIS primary productivity, 8 day'},
+    'pp1m':   {'server': COASTWATCH, 'dataset': 'erdMH1ppmday', 'variables': ['productivity'],
+               'extra': '[(0.0):1:(0.0)]', 'cadence': 30, 'spacing': 1 / 24,
+               'description': 'MODIS primary productivity, 1 month'},
+    'ssc8d':  {'server': AOML, 'dataset': 'noaa_aoml_seascapes_8day', 'variables': ['CLASS', 'P'],
+               'cadence': 8, 'spacing': 0.05, 'description': 'Seascape classes and their probability, 8 day'},
+    'ssc1m':  {'server': AOML, 'dataset': 'noaa_aoml_4729_9ee6_ab54', 'variables': ['CLASS', 'P'],
+               'cadence': 30, 'spacing': 0.05, 'description': 'Seascape classes and their probability, 1 month'},
+    'prec1d': {'server': COASTWATCH, 'dataset': 'chirps20GlobalDailyP05', 'variables': ['precip'],
+               'cadence': 1, 'spacing': 0.05, 'description': 'CHIRPS total daily rainfall'},
+    'prec1m': {'server': COASTWATCH, 'dataset': 'chirps20GlobalMonthlyP05', 'variables': ['precip'],
+               'cadence': 30, 'spacing': 0.05, 'description': 'CHIRPS total monthly rainfall'},
+}
+PRODUCTS_FILE = os.environ.get('SSTTOOLS_PRODUCTS', '')
+
+## constraints of the time, latitude and longitude dimensions in the url templates
+TIME_RANGE = '[({date_start}):{time_stride}:({date_end})]'
+GRID_RANGE = '[({lat_min}):{stride}:({lat_max})][({lon_min}):{stride}:({lon_max})]'
+
+if PRODUCTS_FILE:
+    with open(PRODUCTS_FILE) as f:
+        PRODUCTS.update(json.load(f))
+for _product in PRODUCTS.values():
+    _product.setdefault('extra', '')
+    _product.setdefault('mirrors', [])
+    _product.setdefault('description', _product['dataset'])
+
+
+def product(par):
+    """
+    :param par: parameter code name
+    :return: registry entry of the product
+    """
+    try:
+        return PRODUCTS[par]
+    except KeyError:
+        raise ValueError("{}: unknown product. Valid products are {}".format(par, ', '.join(PRODUCTS))) from None
+
+
+def datasetURL(par):
+    """
+    :param par: parameter code name
+    :return: url of the griddap dataset of the product, without extension
+    """
+    entry = product(par)
+    return entry['server'].rstrip('/') + '/griddap/' + entry['dataset']
+
+
+def source(par, fmt='csv'):
+    """
+    url template of a request of the product, to be filled with date_start, date_end, time_stride, lat_min, lat_max,
+    lon_min, lon_max and stride
+    :param par: parameter code name
+    :param fmt: response format, csv or nc
+    :return: url template
+    """
+    entry = product(par)
+    dims = TIME_RANGE + entry['extra'] + GRID_RANGE
+    return datasetURL(par) + '.' + fmt + '?' + ','.join(var + dims for var in entry['variables'])
+
+
+def sources():
+    """
+    :return: dictionary with the csv url template of every product, see source
+    """
+    return {par: source(par) for par in PRODUCTS}
+
+
+def gridSpacing():
+    """
+    approximate grid of the datasets of the products and their mirrors
+    :return: dictionary {dataset id: (time step in days, spacing in degrees)}
+    """
+    grid = {}
+    for entry in PRODUCTS.values():
+        for url in [entry['dataset']] + entry['mirrors']:
+            grid[url.rstrip('/').split('/')[-1]] = (entry['cadence'], entry['spacing'])
+    return grid
+
+
+def mirrorGroups():
+    """
+    :return: list of the groups of equivalent datasets of the products, see satMirror
+    """
+    return [[datasetURL(par)] + entry['mirrors'] for par, entry in PRODUCTS.items() if entry['mirrors']]
+
+
+def describe(par):
+    """
+    :param par: parameter code name
+    :return: one line description of the product
+    """
+    entry = product(par)
+    return '{}: {} ({}, every {} days, {:.4f} degrees)'.format(par, entry['description'], entry['dataset'],
+                                                               entry['cadence'], entry['spacing'])
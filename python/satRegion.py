@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import hashlib
+import argparse
+import threading
+import concurrent.futures
+
+import satArchive
+import satCache
+import satCoalesce
+import satLoad
+
+## each grid cell is sampled with SUBSAMPLE x SUBSAMPLE points to compute the fraction of its area inside a polygon
+SUBSAMPLE = 5
+
+## side of the tiles, in grid cells of the dataset. Only the tiles with cells inside a polygon are requested
+TILE_CELLS = 32
+
+## statistics of every variable over the cells of a region, weighted by the area of the cells inside it.
+## coverage is the fraction of the region with valid values
+STATS = ['mean', 'min', 'max', 'coverage']
+PERCENTILES = [10, 50, 90]
+
+_lock = threading.Lock()
+_masks = {}
+
+
+def _ring(coordinates):
+    import numpy as np
+
+    ring = np.asarray(coordinates, dtype='float64')[:, :2]
+    if len(ring) and (ring[0] != ring[-1]).any():
+        ring = np.vstack([ring, ring[:1]])
+    return ring
+
+
+def _geometryRings(geometry):
+    ## rings (lon, lat) of a GeoJSON Polygon or MultiPolygon. Holes are rings too, the cells are inside by parity
+    if geometry.get('type') == 'Polygon':
+        return [_ring(ring) for ring in geometry['coordinates']]
+    if geometry.get('type') == 'MultiPolygon':
+        return [_ring(ring) for polygon in geometry['coordinates'] for ring in polygon]
+    return []
+
+
+def parseWKT(text):
+    """
+    read a WKT POLYGON or MULTIPOLYGON
+    :param text: WKT, like POLYGON ((147.1 -18.2, 147.4 -18.2, 147.4 -18.5, 147.1 -18.2))
+    :return: list of rings, arrays of (longitude, latitude)
+    """
+    kind = text.strip().split('(')[0].strip().upper()
+    if kind not in ('POLYGON', 'MULTIPOLYGON'):
+        raise ValueError("{}: only POLYGON and MULTIPOLYGON are supported".format(kind or text[:20]))
+    rings = []
+    for body in re.findall(r'\(([^()]+)\)', text):
+        rings.append(_ring([[float(v) for v in point.split()[:2]] for point in body.split(',')]))
+    return rings
+
+
+def readRegions(source):
+    """
+    read the regions of a GeoJSON file (Polygon and MultiPolygon features, named by their region, name or site
+    property), of a WKT file (one region per line, optionally name;WKT) or of a WKT text
+    :param source: file name or WKT
+    :return: list of (name, rings), the rings as arrays of (longitude, latitude)
+    """
+    regions = []
+    if not os.path.exists(source):
+        return [('region', parseWKT(source))]
+    if source.lower().endswith(('.geojson', '.json')):
+        with open(source) as f:
+            data = json.load(f)
+        features = data.get('features', [data] if data.get('type') == 'Feature' else [])
+        if data.get('type') in ('Polygon', 'MultiPolygon'):
+            features = [{'geometry': data}]
+        for i, feature in enumerate(features):
+            rings = _geometryRings(feature.get('geometry') or {})
+            if not rings:
+                continue
+            props = feature.get('properties') or {}
+            name = props.get('region', props.get('name', props.get('site', 'region{}'.format(i + 1))))
+            regions.append((str(name), rings))
+    else:
+        with open(source) as f:
+            lines = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        for i, line in enumerate(lines):
+            name, _, wkt = line.rpartition(';')
+            regions.append((name.strip() or 'region{}'.format(i + 1), parseWKT(wkt)))
+    return regions
+
+
+def insidePoints(rings, xs, ys):
+    """
+    find the points of a grid inside the polygons, by the parity of the edges crossed on each row of points.
+    The crossings of a row are found for all the edges at once
+    :param rings: list of rings, arrays of (longitude, latitude)
+    :param xs: longitudes of the grid points
+    :param ys: latitudes of the grid points
+    :return: boolean array (latitude, longitude)
+    """
+    import numpy as np
+
+    edges = np.vstack([np.hstack([ring[:-1], ring[1:]]) for ring in rings if len(ring) > 1])
+    x1, y1, x2, y2 = edges.T
+    inside = np.zeros((len(ys), len(xs)), dtype=bool)
+    for k, y in enumerate(ys):
+        crossing = (y1 > y) != (y2 > y)
+        if not crossing.any():
+            continue
+        xc = np.sort(x1[crossing] + (y - y1[crossing]) * (x2[crossing] - x1[crossing]) /
+                     (y2[crossing] - y1[crossing]))
+        inside[k] = np.searchsorted(xc, xs) % 2 == 1
+    return inside
+
+
+def _bounds(rings):
+    import numpy as np
+
+    points = np.vstack(rings)
+    return points[:, 1].min(), points[:, 1].max(), points[:, 0].min(), points[:, 0].max()
+
+
+def _span(grid, axis, low, high):
+    ## range of grid cell indexes of an axis touching [low, high]
+    origin, spacing, n = grid[axis]
+    a, b = sorted(((low - origin) / spacing, (high - origin) / spacing))
+    return max(int(round(a)), 0), min(int(round(b)), n - 1)
+
+
+def cellMask(grid, rings):
+    """
+    fraction of the area of each grid cell inside a region, for the cells of its bounding box.
+    The masks are kept in memory and in the cache directory, they are computed once for each grid and region
+    :param grid: grid of the dataset, as returned by satArchive.productGrid
+    :param rings: rings of the region
+    :return: ((first latitude index, first longitude index), float32 array (latitude, longitude)), or None if the
+             region is outside the grid
+    """
+    import numpy as np
+
+    lat_min, lat_max, lon_min, lon_max = _bounds(rings)
+    ya, yb = _span(grid, 'latitude', lat_min, lat_max)
+    xa, xb = _span(grid, 'longitude', lon_min, lon_max)
+    if ya > yb or xa > xb:
+        return None
+    key = hashlib.sha1(json.dumps([grid['latitude'], grid['longitude'], ya, yb, xa, xb, SUBSAMPLE,
+                                   [np.round(ring, 7).tolist() for ring in rings]]).encode()).hexdigest()
+    with _lock:
+        if key in _masks:
+            return _masks[key]
+    fname = os.path.join(satCache.CACHE_DIR, 'masks', key + '.npy') if satCache.isEnabled() else None
+    if fname and os.path.exists(fname):
+        mask = np.load(fname)
+    else:
+        offsets = (np.arange(SUBSAMPLE) + 0.5) / SUBSAMPLE - 0.5
+        ys = (grid['latitude'][0] + (np.arange(ya, yb + 1)[:, None] + offsets) * grid['latitude'][1]).ravel()
+        xs = (grid['longitude'][0] + (np.arange(xa, xb + 1)[:, None] + offsets) * grid['longitude'][1]).ravel()
+        inside = insidePoints(rings, xs, ys)
+        mask = inside.reshape(yb - ya + 1, SUBSAMPLE, xb - xa + 1, SUBSAMPLE).mean(axis=(1, 3)).astype('float32')
+        if fname:
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            np.save(fname + '.tmp.npy', mask)
+            os.replace(fname + '.tmp.npy', fname)
+    with _lock:
+        _masks[key] = ((ya, xa), mask)
+    return _masks[key]
+
+
+def tileBoxes(grid, masks):
+    """
+    requests of the tiles with cells inside any of the regions. Each request is cut to the cells needed,
+    and the tiles shared by several regions are requested once
+    :param grid: grid of the dataset
+    :param masks: list of masks, as returned by cellMask
+    :return: dictionary {(tile latitude, tile longitude): [lat_min, lat_max, lon_min, lon_max]}
+    """
+    import numpy as np
+
+    cells = {}
+    for (ya, xa), mask in masks:
+        rows, cols = np.nonzero(mask > 0)
+        i, j = rows + ya, cols + xa
+        tiles, inverse = np.unique(np.stack([i // TILE_CELLS, j // TILE_CELLS], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for k, tile in enumerate(map(tuple, tiles.tolist())):
+            ii, jj = i[inverse == k], j[inverse == k]
+            box = cells.setdefault(tile, [ii.min(), ii.max(), jj.min(), jj.max()])
+            box[:] = [min(box[0], ii.min()), max(box[1], ii.max()), min(box[2], jj.min()), max(box[3], jj.max())]
+    boxes = {}
+    for tile, (ia, ib, ja, jb) in cells.items():
+        lats = sorted(grid['latitude'][0] + np.array([ia, ib]) * grid['latitude'][1])
+        lons = sorted(grid['longitude'][0] + np.array([ja, jb]) * grid['longitude'][1])
+        boxes[tile] = [float(lats[0]), float(lats[1]), float(lons[0]), float(lons[1])]
+    return boxes
+
+
+def _regionValues(grid, cube, origin, mask):
+    ## values of the cells of a region (time, cell) and the area of each cell inside the region
+    import numpy as np
+
+    ya, xa = origin
+    i = np.round((cube['latitude'] - grid['latitude'][0]) / grid['latitude'][1]).astype(int) - ya
+    j = np.round((cube['longitude'] - grid['longitude'][0]) / grid['longitude'][1]).astype(int) - xa
+    rows = np.nonzero((i >= 0) & (i < mask.shape[0]))[0]
+    cols = np.nonzero((j >= 0) & (j < mask.shape[1]))[0]
+    fraction = mask[np.ix_(i[rows], j[cols])]
+    area = fraction * np.cos(np.radians(cube['latitude'][rows]))[:, None]
+    keep = fraction.ravel() > 0
+    lat, lon = np.meshgrid(cube['latitude'][rows], cube['longitude'][cols], indexing='ij')
+    cells = {'latitude': lat.ravel()[keep], 'longitude': lon.ravel()[keep], 'fraction': fraction.ravel()[keep]}
+    values = {name: array[:, rows][:, :, cols].reshape(len(cube['time']), -1)[:, keep]
+              for name, array in cube['variables'].items()}
+    return cells, area.ravel()[keep].astype('float64'), values
+
+
+def zonalStats(values, area, stats=STATS, percentiles=PERCENTILES, threshold=None):
+    """
+    area weighted statistics of the cells of a region at every time step, ignoring the missing values.
+    The percentiles are taken from the cumulative area of the sorted values
+    :param values: array (time, cell)
+    :param area: area of each cell inside the region
+    :param stats: list of mean, min, max and coverage
+    :param percentiles: list of percentiles
+    :param threshold: if given, the fraction of the valid area above this value is added as above
+    :return: dictionary {statistic: array (time)}
+    """
+    import numpy as np
+
+    valid = ~np.isnan(values)
+    weights = np.where(valid, area, 0.0)
+    total = weights.sum(axis=1)
+    result = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if 'mean' in stats:
+            result['mean'] = np.where(total > 0, np.einsum('ij,ij->i', np.where(valid, values, 0.0), weights) / total,
+                                      np.nan)
+        if 'min' in stats:
+            result['min'] = np.where(valid.any(axis=1), np.where(valid, values, np.inf).min(axis=1), np.nan)
+        if 'max' in stats:
+            result['max'] = np.where(valid.any(axis=1), np.where(valid, values, -np.inf).max(axis=1), np.nan)
+        if 'coverage' in stats:
+            result['coverage'] = total / area.sum() if area.sum() > 0 else np.full(len(values), np.nan)
+        if percentiles:
+            order = np.argsort(np.where(valid, values, np.inf), axis=1)
+            ordered = np.take_along_axis(values, order, axis=1)
+            cumulative = np.cumsum(np.take_along_axis(weights, order, axis=1), axis=1) / total[:, None]
+            for p in percentiles:
+                k = np.minimum((cumulative < p / 100.0).sum(axis=1), values.shape[1] - 1)
+                result['p{:g}'.format(p)] = np.where(total > 0, ordered[np.arange(len(values)), k], np.nan)
+        if threshold is not None:
+            above = np.where(valid & (values > threshold), area, 0.0).sum(axis=1)
+            result['above'] = np.where(total > 0, above / total, np.nan)
+    return {name: values.astype('float32') for name, values in result.items()}
+
+
+def extract(par, regions, date_start, date_end=None, cells=False, stats=STATS, percentiles=PERCENTILES,
+            threshold=None, workers=4):
+    """
+    get a getSatProd parameter inside polygons. Only the tiles with cells inside the polygons are requested
+    :param par: getSatProd parameter code name
+    :param regions: list of (name, rings), as returned by readRegions, or a file or WKT for readRegions
+    :param date_start: start date in yyyy-mm-dd
+    :param date_end: end date in yyyy-mm-dd. Default: start date
+    :param cells: if True, the values of the cells inside each region, with the fraction of their area inside it.
+                  If False the zonal statistics of each region and time step
+    :param stats: statistics, see zonalStats
+    :param percentiles: area weighted percentiles
+    :param threshold: if given, the fraction of the valid area above this value, like 1 for CRW_HOTSPOT
+    :param workers: number of tiles requested at the same time
+    :return: pandas data frame with the region, time and the cells or the statistics of every variable named like
+             variable_statistic, with the units in df.attrs['units']. None if nothing was retrieved
+    """
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(regions, str):
+        regions = readRegions(regions)
+    date_end = date_end or date_start
+    grid = satArchive.productGrid(par)
+    if grid is None:
+        print("{}: no metadata of the dataset".format(par.upper()))
+        return None
+    masks = {name: cellMask(grid, rings) for name, rings in regions}
+    masks = {name: mask for name, mask in masks.items() if mask is not None and (mask[1] > 0).any()}
+    boxes = tileBoxes(grid, list(masks.values()))
+    print("{}: {} regions, {} tiles".format(par.upper(), len(masks), len(boxes)), flush=True)
+
+    def load(box):
+        return satLoad.loadCube(par, box[0], box[1], box[2], box[3], date_start, date_end, workers=1)
+
+    with satCoalesce.parallel(workers), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        tiles = dict(zip(boxes, pool.map(load, boxes.values())))
+    tiles = {tile: cube for tile, cube in tiles.items() if cube is not None}
+    if not tiles:
+        return None
+
+    frames = []
+    units = {}
+    for name, (origin, mask) in masks.items():
+        ya, xa = origin
+        rows, cols = np.nonzero(mask > 0)
+        needed = {((ya + i) // TILE_CELLS, (xa + j) // TILE_CELLS) for i, j in zip(rows, cols)}
+        needed = [tiles[tile] for tile in needed if tile in tiles]
+        if not needed:
+            continue
+        cube = satLoad.mergeCubes(needed)
+        units.update(cube['units'])
+        cell, area, values = _regionValues(grid, cube, origin, mask)
+        times = cube['time']
+        if cells:
+            n = len(cell['latitude'])
+            frame = {'region': name, 'time': np.repeat(times, n), 'latitude': np.tile(cell['latitude'], len(times)),
+                     'longitude': np.tile(cell['longitude'], len(times)),
+                     'fraction': np.tile(cell['fraction'], len(times))}
+            frame.update({var: array.ravel() for var, array in values.items()})
+        else:
+            frame = {'region': name, 'time': times}
+            for var, array in values.items():
+                for stat, result in zonalStats(array, area, stats, percentiles, threshold).items():
+                    frame[var + '_' + stat] = result
+        frames.append(pd.DataFrame(frame))
+    if not frames:
+        return None
+    df = pd.concat(frames, ignore_index=True)
+    df.attrs['units'] = units
+    return df
+
+
+def writeFrame(df, fout):
+    """
+    write the result of extract. The extension of the file gives the format: csv or parquet
+    :param df: data frame
+    :param fout: output file
+    :return: number of rows written
+    """
+    if fout.lower().endswith('.parquet'):
+        df.to_parquet(fout, index=False)
+    else:
+        df.to_csv(fout, index=False, date_format='%Y-%m-%dT%H:%M:%SZ', float_format='%.6g')
+    return len(df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract a product inside polygons (GeoJSON or WKT), requesting only '
+                                                 'the tiles that intersect them. Writes the area weighted statistics '
+                                                 'of every region and time step, or the cells inside the regions')
+    parser.add_argument('-param', dest='param', help='code name of the parameters, like sst or dhw. See getSatProd.py',
+                        nargs='+', required=True)
+    parser.add_argument('-regions', dest='regions', help='GeoJSON file with Polygon or MultiPolygon features, WKT file '
+                        'with one region per line (name;WKT) or WKT polygon', required=True)
+    parser.add_argument('-ds', dest='date_start', help='start date in yyyy-mm-dd', required=True)
+    parser.add_argument('-de', dest='date_end', help='end date in yyyy-mm-dd. If missing retrieve for start date only',
+                        required=False)
+    parser.add_argument('-cells', dest='cells', help='write the cells inside the regions instead of the statistics',
+                        action='store_true', required=False)
+    parser.add_argument('-stat', dest='stats', help='statistics: {}. Default all'.format(', '.join(STATS)),
+                        choices=STATS, nargs='+', default=STATS, required=False)
+    parser.add_argument('-percentiles', dest='percentiles', help='area weighted percentiles. Default 10 50 90',
+                        type=float, nargs='*', default=PERCENTILES, required=False)
+    parser.add_argument('-threshold', dest='threshold', help='add the fraction of the area above this value, '
+                        'like 1 for the hotspots', type=float, required=False)
+    parser.add_argument('-loc', dest='locality', help='name for the output files. Default regions', default='regions',
+                        required=False)
+    parser.add_argument('-out', dest='outpath', help='path where to write the result files', default='./',
+                        required=False)
+    parser.add_argument('-format', dest='fmt', help='output format: csv or parquet. Default csv',
+                        choices=['csv', 'parquet'], default='csv', required=False)
+    parser.add_argument('-workers', dest='workers', help='number of tiles requested at the same time. Default 4',
+                        type=int, default=4, required=False)
+    args = parser.parse_args()
+
+    from getSatProd import makeFileName
+
+    if args.date_end == None:
+        args.date_end = args.date_start
+
+    regions = readRegions(args.regions)
+    for par in args.param:
+        try:
+            df = extract(par, regions, args.date_start, args.date_end, args.cells, args.stats, args.percentiles,
+                         args.threshold, args.workers)
+            if df is None:
+                print("FAILED: {}".format(par))
+                continue
+            fout = os.path.join(args.outpath, os.path.splitext(makeFileName(args.locality, par, args.date_start,
+                                                                            args.date_end))[0] + '.' + args.fmt)
+            rows = writeFrame(df, fout)
+            print('{} records written to {}'.format(rows, fout))
+        except Exception as e:
+            print(e)
+            print("FAILED: {}".format(par))
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import json
+import time
+import datetime
+import argparse
+import tempfile
+import threading
+import urllib.parse
+import concurrent.futures
+
+import satBatch
+import satCoalesce
+import satCube
+import satLoad
+import satMeta
+import satProducts
+import satStore
+
+## once a new time step is due the dataset is checked again every RECHECK seconds, until it is published
+RECHECK = 6 * 3600
+
+## a failed job is tried again after RETRY_DELAY seconds, doubled after every failure, at most MAX_ATTEMPTS times
+RETRY_DELAY = 600
+MAX_ATTEMPTS = 5
+
+## name of the file, in the output path, that keeps the job queue and the state of the products between runs
+STATE_FILE = '.satSchedule.json'
+
+_lock = threading.Lock()
+
+
+def _source(par):
+    return satProducts.source(par)
+
+
+def readSubscriptions(fname):
+    """
+    read the subscriptions of the harvest: a json list of objects with a name, the getSatProd parameters (param),
+    the first date (from) and a region [lat_min, lat_max, lon_min, lon_max] or a sites file (CSV or GeoJSON,
+    see satBatch.readSites), like
+    [{"name": "gbr", "param": ["sst", "dhw"], "region": [-20, -10, 142, 154], "from": "2020-01-01"},
+     {"name": "reefs", "param": ["dhw"], "sites": "reefs.csv", "from": "2020-01-01"}]
+    :param fname: json file
+    :return: list of subscriptions, with the sites read as (site, latitude, longitude)
+    """
+    with open(fname) as f:
+        subscriptions = json.load(f)
+    folder = os.path.dirname(os.path.abspath(fname))
+    for sub in subscriptions:
+        if isinstance(sub['param'], str):
+            sub['param'] = [sub['param']]
+        if isinstance(sub.get('sites'), str):
+            sub['sites'] = satBatch.readSites(os.path.join(folder, sub['sites']))
+        if not sub.get('region') and not sub.get('sites'):
+            raise ValueError("{}: a subscription needs a region or sites".format(sub['name']))
+    return subscriptions
+
+
+def cadence(par):
+    """
+    days between two publications of a product
+    :param par: getSatProd parameter code name
+    :return: number of days
+    """
+    return satProducts.product(par)['cadence']
+
+
+def loadState(outpath):
+    """
+    read the job queue and the state of the products of a previous run
+    :param outpath: output path of the harvest
+    :return: dictionary with the products {par: {last, next}} and the jobs
+    """
+    try:
+        with open(os.path.join(outpath, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'products': {}, 'jobs': []}
+
+
+def saveState(outpath, state):
+    """
+    write the job queue and the state of the products, in a single step
+    :param outpath: output path of the harvest
+    :param state: dictionary, as returned by loadState
+    """
+    os.makedirs(outpath, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=outpath, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, os.path.join(outpath, STATE_FILE))
+
+
+def checkProduct(par, state, now):
+    """
+    last date published of a product. The dataset is asked only when a new time step is due by the cadence
+    of the product, so a monthly product is not polled every day
+    :param par: getSatProd parameter code name
+    :param state: state of the products, updated
+    :param now: current time, in seconds
+    :return: last date available in yyyy-mm-dd, or None if not known
+    """
+    product = state['products'].setdefault(par, {'last': None, 'next': 0})
+    if now < product['next']:
+        return product['last']
+    dims = satMeta.getMeta(_source(par), refresh=0)
+    last = satMeta.toDateString(dims['time']['max']) if dims and 'max' in dims.get('time', {}) else None
+    if last is not None and (product['last'] is None or last > product['last']):
+        product['last'] = last
+        due = datetime.datetime.fromisoformat(last).replace(tzinfo=datetime.timezone.utc).timestamp() + \
+            cadence(par) * 86400
+        product['next'] = due if due > now else now + RECHECK
+    else:
+        product['next'] = now + RECHECK
+    return product['last']
+
+
+def storeFile(outpath, name, par, site=None):
+    """
+    rolling csv file of a subscription (or one of its sites) and a product: outpath/name/name_par.csv
+    :param outpath: output path of the harvest
+    :param name: name of the subscription
+    :param par: getSatProd parameter code name
+    :param site: name of the site, for the subscriptions of sites
+    :return: file name
+    """
+    return satStore.storeName(os.path.join(outpath, name), site or name, par)
+
+
+def _firstDate(store, date_from):
+    last = satStore.lastTime(store)
+    return date_from if last is None else max(date_from, satStore.nextDate(last))
+
+
+def _area(box):
+    return max(box[1] - box[0], 0) * max(box[3] - box[2], 0)
+
+
+def _union(a, b):
+    return [min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])]
+
+
+def enqueue(state, par, kind, member, date_start, date_end):
+    """
+    add the request of a subscription to the queue. Identical requests are sent once: a site joins the pending
+    job of the same product and dates, and a region joins a pending region job when their common box is not
+    larger than the two boxes requested separately
+    :param state: state with the job queue
+    :param par: getSatProd parameter code name
+    :param kind: region or sites
+    :param member: {name, box, date_start} for a region, {name, site, lat, lon, date_start} for a site
+    :param date_start: first date needed
+    :param date_end: last date published
+    :return: the job
+    """
+    for job in state['jobs']:
+        if job['state'] != 'pending' or job['param'] != par or job['kind'] != kind or job['date_end'] != date_end:
+            continue
+        if kind == 'region':
+            union = _union(job['box'], member['box'])
+            if _area(union) > _area(job['box']) + _area(member['box']) + 1e-9:
+                continue
+            job['box'] = union
+        if member not in job['members']:
+            job['members'].append(member)
+        job['date_start'] = min(job['date_start'], date_start)
+        return job
+    job = {'id': '{}-{}-{}'.format(par, kind, len(state['jobs']) + int(time.time() * 1000) % 1000000),
+           'param': par, 'kind': kind, 'box': member.get('box'), 'members': [member], 'date_start': date_start,
+           'date_end': date_end, 'state': 'pending', 'attempts': 0, 'not_before': 0, 'error': None}
+    state['jobs'].append(job)
+    return job
+
+
+def plan(subscriptions, state, outpath, now):
+    """
+    queue the new data of every subscription whose products have published since the last run
+    :param subscriptions: list of subscriptions, see readSubscriptions
+    :param state: state with the products and the job queue, updated
+    :param outpath: output path of the harvest
+    :param now: current time, in seconds
+    :return: number of requests queued
+    """
+    queued = {(job['param'], member['name'], member.get('site')) for job in state['jobs']
+              if job['state'] == 'pending' for member in job['members']}
+    n = 0
+    for sub in subscriptions:
+        for par in sub['param']:
+            last = checkProduct(par, state, now)
+            if last is None:
+                continue
+            if sub.get('region'):
+                members = [('region', {'name': sub['name'], 'box': [float(v) for v in sub['region']]}, None)]
+            else:
+                members = [('sites', {'name': sub['name'], 'site': site, 'lat': lat, 'lon': lon}, site)
+                           for site, lat, lon in sub['sites']]
+            for kind, member, site in members:
+                if (par, sub['name'], site) in queued:
+                    continue
+                start = _firstDate(storeFile(outpath, sub['name'], par, site), sub.get('from', last))
+                if start <= last:
+                    member['date_start'] = start
+                    enqueue(state, par, kind, member, start, last)
+                    n += 1
+    return n
+
+
+def _append(store, fname, date_start):
+    ## rows of a shared request before the first date of the subscription are left out
+    folder = os.path.dirname(fname)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.csv')
+    with open(fname, newline='') as fin, os.fdopen(fd, 'w', newline='') as fout:
+        reader = csv.reader(fin)
+        writer = csv.writer(fout)
+        header = next(reader)
+        writer.writerow(header)
+        writer.writerow(next(reader))
+        timeCol = header.index('time')
+        writer.writerows(row for row in reader if row and row[timeCol][:10] >= date_start)
+    os.makedirs(os.path.dirname(store), exist_ok=True)
+    return satStore.appendCSV(store, tmp)
+
+
+def runJob(job, outpath):
+    """
+    send the request of a job and append its result to the rolling file of every subscription that asked for it
+    :param job: job of the queue
+    :param outpath: output path of the harvest
+    :return: number of rows appended
+    """
+    par = job['param']
+    rows = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        if job['kind'] == 'sites':
+            ## the same position asked by several subscriptions is retrieved once
+            positions = {}
+            for member in job['members']:
+                positions.setdefault((member['lat'], member['lon']), 'p{}'.format(len(positions)))
+            files = satBatch.getSites(par, [(pid, lat, lon) for (lat, lon), pid in positions.items()],
+                                      job['date_start'], job['date_end'], tmp, workers=1)
+            if any(fout is None for fout in files.values()):
+                raise RuntimeError('some sites failed')
+            for member in job['members']:
+                fname = os.path.join(tmp, files[positions[member['lat'], member['lon']]])
+                rows += _append(storeFile(outpath, member['name'], par, member['site']), fname,
+                                member['date_start'])
+        else:
+            box = job['box']
+            cube = satLoad.loadCube(par, box[0], box[1], box[2], box[3], job['date_start'], job['date_end'],
+                                    workers=2)
+            if cube is None:
+                raise RuntimeError('outside the coverage of the dataset')
+            for i, member in enumerate(job['members']):
+                lat_min, lat_max, lon_min, lon_max = member['box']
+                part = satCube.sliceCube(cube, {'latitude': (lat_min - 1e-6, lat_max + 1e-6),
+                                                'longitude': (lon_min - 1e-6, lon_max + 1e-6)})
+                fname = os.path.join(tmp, 'part{}.csv'.format(i))
+                satCube.writeCube(part, fname, 'csv')
+                rows += _append(storeFile(outpath, member['name'], par), fname, member['date_start'])
+    return rows
+
+
+def runPending(state, outpath, workers=4, host_limit=2):
+    """
+    run the pending jobs of the queue with a pool of workers, never more than host_limit at the same time
+    on the same ERDDAP server. The state is saved after every job, so an interrupted run continues where it stopped
+    :param state: state with the job queue
+    :param outpath: output path of the harvest
+    :param workers: number of jobs run at the same time
+    :param host_limit: maximum number of jobs run at the same time on the same server
+    :return: (number of jobs done, number of jobs failed)
+    """
+    now = time.time()
+    jobs = [job for job in state['jobs'] if job['state'] == 'pending' and job['not_before'] <= now]
+    hostLocks = {}
+    for job in jobs:
+        hostLocks.setdefault(urllib.parse.urlsplit(_source(job['param'])).netloc,
+                             threading.BoundedSemaphore(max(1, host_limit)))
+
+    def runOne(job):
+        with hostLocks[urllib.parse.urlsplit(_source(job['param'])).netloc]:
+            return runJob(job, outpath)
+
+    done = failed = 0
+    with satCoalesce.parallel(workers), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(runOne, job): job for job in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                rows = future.result()
+                job['state'] = 'done'
+                done += 1
+                print('{}: {} {} to {}, {} rows appended for {}'.format(
+                    job['id'], job['param'], job['date_start'], job['date_end'], rows,
+                    ', '.join(sorted({m['name'] for m in job['members']}))), flush=True)
+            except Exception as e:
+                job['attempts'] += 1
+                job['error'] = str(e)
+                if job['attempts'] >= MAX_ATTEMPTS:
+                    job['state'] = 'failed'
+                job['not_before'] = time.time() + RETRY_DELAY * 2 ** (job['attempts'] - 1)
+                failed += 1
+                print('{}: FAILED {}'.format(job['id'], e), flush=True)
+            with _lock:
+                saveState(outpath, state)
+    ## only the pending and failed jobs are kept in the queue
+    state['jobs'] = [job for job in state['jobs'] if job['state'] != 'done']
+    return done, failed
+
+
+def run(subscriptions, outpath, workers=4, host_limit=2, once=False):
+    """
+    harvest the subscriptions as their products publish new data. Without once it runs until interrupted,
+    sleeping until the next product is due or the next failed job can be tried again
+    :param subscriptions: list of subscriptions, see readSubscriptions
+    :param outpath: output path of the harvest
+    :param workers: number of jobs run at the same time
+    :param host_limit: maximum number of jobs run at the same time on the same ERDDAP server
+    :param once: if True, check and harvest once and return, like from cron
+    """
+    state = loadState(outpath)
+    while True:
+        now = time.time()
+        queued = plan(subscriptions, state, outpath, now)
+        saveState(outpath, state)
+        if queued:
+            print('{} requests queued in {} jobs'.format(queued, sum(job['state'] == 'pending'
+                                                                     for job in state['jobs'])), flush=True)
+        runPending(state, outpath, workers, host_limit)
+        saveState(outpath, state)
+        if once:
+            return
+        wake = [product['next'] for product in state['products'].values()]
+        wake += [job['not_before'] for job in state['jobs'] if job['state'] == 'pending']
+        time.sleep(min(max(min(wake, default=now + RECHECK) - time.time(), 60), RECHECK))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Harvest subscriptions of sites and regions as their products '
+                                                 'publish new data, appending to one rolling file per subscription '
+                                                 'and product. Identical requests are sent once')
+    parser.add_argument('-subs', dest='subs', help='json file with the subscriptions', required=True)
+    parser.add_argument('-out', dest='outpath', help='path where to write the result files and the job queue',
+                        default='./', required=False)
+    parser.add_argument('-workers', dest='workers', help='number of jobs run at the same time. Default 4',
+                        type=int, default=4, required=False)
+    parser.add_argument('-hostlimit', dest='host_limit', help='maximum jobs run at the same time on the same ERDDAP '
+                        'server. Default 2', type=int, default=2, required=False)
+    parser.add_argument('-once', dest='once', help='check and harvest once and exit, to run from cron',
+                        action='store_true', required=False)
+    parser.add_argument('-status', dest='status', help='show the products and the job queue and exit',
+                        action='store_true', required=False)
+    args = parser.parse_args()
+
+    if args.status:
+        state = loadState(args.outpath)
+        for par, product in sorted(state['products'].items()):
+            print('{:<8} last {}  next check {}'.format(par, product['last'], time.strftime(
+                '%Y-%m-%d %H:%M', time.localtime(product['next']))))
+        for job in state['jobs']:
+            print('{:<24} {:<8} {} to {}  {} members  {}'.format(job['id'], job['state'], job['date_start'],
+                                                                  job['date_end'], len(job['members']),
+                                                                  job['error'] or ''))
+    else:
+        run(readSubscriptions(args.subs), args.outpath, args.workers, args.host_limit, args.once)
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import argparse
+import warnings
+import concurrent.futures
+
+import satAggregate
+import satCube
+import satProducts
+import satWriters
+
+## statistics of every variable over the report period, one column per site. anomaly is the mean anomaly from the
+## climatology of the site and the anomaly of its last value. The classes (CLASS) have count, coverage and last only,
+## with their mode, number of different classes and transitions
+STATS = ['mean', 'min', 'max', 'count', 'coverage', 'last', 'anomaly']
+PERCENTILES = [10, 50, 90]
+
+## sites computed together. Each block is a (time, site) array of every variable, computed in a worker process
+## when there are several workers
+BLOCK_SITES = 500
+
+## file names of getSatProd and satBatch (site_param_start-end) and of the rolling files (site_param)
+_FILE_NAME = re.compile(r'^(?P<site>.+)_(?P<par>[a-z0-9]+)(_\d{8}-(\d{8}|last))?$')
+
+
+def siteName(fname):
+    """
+    name of the site of a series file: the file name without the parameter and dates added by getSatProd and satBatch
+    :param fname: file name
+    :return: site name
+    """
+    name = os.path.splitext(os.path.basename(fname))[0]
+    match = _FILE_NAME.match(name)
+    if match and match.group('par') in satProducts.PRODUCTS:
+        return match.group('site')
+    return name
+
+
+def readSeries(fname):
+    """
+    read the series of a file written by the harvesters, getSatProd or satBatch. Every grid cell with values is a site,
+    named like the file, or like the file with @latitude,longitude if it has more than one cell
+    :param fname: csv, parquet, arrow or nc file
+    :return: list of (site, latitude, longitude, times, {variable: values}, units)
+    """
+    import numpy as np
+
+    cube = satCube.readCube(fname)
+    name = siteName(fname)
+    cells = []
+    for i, lat in enumerate(cube['latitude']):
+        for j, lon in enumerate(cube['longitude']):
+            variables = {var: values[:, i, j] for var, values in cube['variables'].items()}
+            if any(np.isfinite(values).any() for values in variables.values()):
+                cells.append((lat, lon, variables))
+    series = []
+    for lat, lon, variables in cells:
+        site = name if len(cells) == 1 else '{}@{:.4f},{:.4f}'.format(name, lat, lon)
+        series.append((site, float(lat), float(lon), cube['time'], variables, cube['units']))
+    return series
+
+
+def _readFiles(fnames):
+    return [series for fname in fnames for series in readSeries(fname)]
+
+
+def timeAxis(times):
+    """
+    common time axis of the series of a variable: every time step of any site. The days missing in every site of a
+    daily product are added, so the gaps are seen as missing values and not as consecutive steps
+    :param times: list of datetime64 arrays
+    :return: sorted datetime64[ns] array
+    """
+    import numpy as np
+
+    axis = np.unique(np.concatenate(times).astype('datetime64[ns]'))
+    day = np.timedelta64(1, 'D')
+    if len(axis) > 1:
+        steps = np.diff(axis)
+        if np.median(steps) == day and not (steps % day).any():
+            axis = np.arange(axis[0], axis[-1] + day, day)
+    return axis
+
+
+def loadSites(fnames, workers=1):
+    """
+    load the series of many sites in a site x time array of every variable, each variable on its own time axis
+    :param fnames: list of series files, one or more per site. The files of a site with different variables (like
+                   its dhw and ssc8d files) are joined
+    :param workers: number of processes reading the files
+    :return: dictionary with the site names, their latitude and longitude, the series {variable: {time, values}}
+             with float32 values (time, site) and the units
+    """
+    import numpy as np
+
+    if workers > 1 and len(fnames) > 1:
+        size = -(-len(fnames) // (workers * 4))
+        chunks = [fnames[i:i + size] for i in range(0, len(fnames), size)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            series = [s for part in pool.map(_readFiles, chunks) for s in part]
+    else:
+        series = _readFiles(fnames)
+
+    sites = {}
+    latitude = []
+    longitude = []
+    parts = {}
+    units = {}
+    for site, lat, lon, times, variables, file_units in series:
+        if site not in sites:
+            sites[site] = len(sites)
+            latitude.append(lat)
+            longitude.append(lon)
+        for var, values in variables.items():
+            parts.setdefault(var, []).append((sites[site], times, values))
+            units.setdefault(var, file_units.get(var, ''))
+
+    data = {}
+    for var, items in parts.items():
+        axis = timeAxis([times for _, times, _ in items])
+        values = np.full((len(axis), len(sites)), np.nan, dtype='float32')
+        rows = np.searchsorted(axis, np.concatenate([times for _, times, _ in items]).astype('datetime64[ns]'))
+        columns = np.concatenate([np.full(len(times), site) for site, times, _ in items])
+        values[rows, columns] = np.concatenate([v for _, _, v in items])
+        data[var] = {'time': axis, 'values': values}
+    return {'site': list(sites), 'latitude': np.array(latitude), 'longitude': np.array(longitude), 'series': data,
+            'units': units}
+
+
+def anomalies(times, values, baseline=None):
+    """
+    anomalies from the climatology of each site: the mean of the same day of year, or of the same month for the
+    monthly products, ignoring the missing values
+    :param times: datetime64 array
+    :param values: array (time, site)
+    :param baseline: optional (first year, last year) of the climatology. Default all the years
+    :return: array (time, site) of anomalies. NaN where the climatology has no value
+    """
+    import numpy as np
+
+    step = np.median(np.diff(times)) if len(times) > 1 else np.timedelta64(1, 'D')
+    if step >= np.timedelta64(28, 'D'):
+        keys = times.astype('datetime64[M]').astype('int64') % 12
+    else:
+        keys = satAggregate.periodKeys(times, 'doy')
+    use = np.ones(len(times), dtype=bool)
+    if baseline:
+        years = times.astype('datetime64[Y]').astype('int64') + 1970
+        use = (years >= baseline[0]) & (years <= baseline[1])
+    if not use.any():
+        return np.full(values.shape, np.nan, dtype='float32')
+    labels, inverse = np.unique(keys[use], return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    starts = np.searchsorted(inverse[order], np.arange(len(labels)))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        climatology = satAggregate.groupReduce(values[use][order], starts, 'mean')
+    index = np.minimum(np.searchsorted(labels, keys), len(labels) - 1)
+    climatology = np.where((labels[index] == keys)[:, None], climatology[index], np.nan)
+    return (values - climatology).astype('float32')
+
+
+def _lastValid(valid):
+    ## index of the last valid time step of each site, -1 if none
+    import numpy as np
+
+    n = len(valid)
+    return np.where(valid.any(axis=0), n - 1 - np.argmax(valid[::-1], axis=0), -1)
+
+
+def _neighbours(valid):
+    ## index of the last valid step at or before, and of the next valid step at or after, every time step
+    import numpy as np
+
+    n = len(valid)
+    steps = np.arange(n)[:, None]
+    before = np.maximum.accumulate(np.where(valid, steps, -1), axis=0)
+    after = np.minimum.accumulate(np.where(valid, steps, n)[::-1], axis=0)[::-1]
+    return before, after
+
+
+def runLengths(hit, valid, max_gap=0):
+    """
+    runs of consecutive time steps above a threshold, like the days with CRW_HOTSPOT >= 1. A gap of at most max_gap
+    missing steps between two steps above the threshold does not break the run, but it is not counted in it
+    :param hit: boolean array (time, site), True where the value is above the threshold
+    :param valid: boolean array (time, site), True where the value is not missing
+    :param max_gap: longest gap of missing steps bridged
+    :return: dictionary of arrays (site): steps above the threshold, runs, longest run and the run at the last valid
+             step (0 if it is below the threshold), in time steps
+    """
+    import numpy as np
+
+    n, sites = hit.shape
+    before, after = _neighbours(valid)
+    hits = np.zeros((n + 2, sites), dtype=bool)
+    hits[1:-1] = hit
+    ## -1 and n point to the padding rows, which are never hits
+    bridged = (~valid & (after - before - 1 <= max_gap) & np.take_along_axis(hits, before + 1, axis=0) &
+               np.take_along_axis(hits, after + 1, axis=0))
+    inrun = (hit | bridged).T.ravel()
+    previous = np.zeros_like(inrun)
+    previous[1:] = inrun[:-1]
+    previous[::n] = False
+    starts = inrun & ~previous
+    ids = np.cumsum(starts) * inrun
+    lengths = np.bincount(ids, weights=hit.T.ravel(), minlength=starts.sum() + 1)[1:]
+    run_sites = np.flatnonzero(starts) // n
+    longest = np.zeros(sites)
+    np.maximum.at(longest, run_sites, lengths)
+    last = _lastValid(valid)
+    at_last = ids[np.arange(sites) * n + np.maximum(last, 0)]
+    current = np.where((last >= 0) & (at_last > 0), lengths[np.maximum(at_last - 1, 0)] if len(lengths) else 0, 0)
+    return {'steps': hit.sum(axis=0), 'runs': np.bincount(run_sites, minlength=sites), 'maxrun': longest,
+            'lastrun': current}
+
+
+def transitions(values, valid, max_gap=0):
+    """
+    changes of class between consecutive valid time steps, like the SEASCAPE CLASS. Two valid steps separated by
+    more than max_gap missing steps are not compared
+    :param values: array (time, site) of classes
+    :param valid: boolean array (time, site)
+    :param max_gap: longest gap of missing steps between two compared steps
+    :return: (site index, class before, class after) arrays of every change
+    """
+    import numpy as np
+
+    n = len(values)
+    before, _ = _neighbours(valid)
+    previous = np.full(before.shape, -1)
+    previous[1:] = before[:-1]
+    steps = np.arange(n)[:, None]
+    compared = valid & (previous >= 0) & (steps - previous - 1 <= max_gap)
+    prior = np.take_along_axis(values, np.maximum(previous, 0), axis=0)
+    change = compared & (values != prior)
+    rows, columns = np.nonzero(change)
+    return columns, prior[rows, columns], values[rows, columns]
+
+
+def _variableStats(var, times, values, window, stats, percentiles, thresholds, max_gap, baseline):
+    ## statistics of a variable for a block of sites, {column: array (site)}
+    import numpy as np
+
+    result = {}
+    inside = (times >= window[0]) & (times <= window[1])
+    period = values[inside]
+    valid = ~np.isnan(period)
+    count = valid.sum(axis=0)
+    last = _lastValid(valid)
+    sites = np.arange(period.shape[1])
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if 'count' in stats:
+            result[var + '_count'] = count
+        if 'coverage' in stats:
+            result[var + '_coverage'] = count / max(len(period), 1)
+        if 'last' in stats:
+            result[var + '_last'] = np.where(last >= 0, period[np.maximum(last, 0), sites], np.nan)
+        if var in satWriters.CLASSES:
+            classes = np.where(valid, period, 0).astype('int64')
+            size = int(classes.max()) + 1 if classes.size else 1
+            counts = np.bincount((sites * size + classes)[valid], minlength=len(sites) * size).reshape(-1, size)
+            result[var + '_mode'] = np.where(count > 0, counts.argmax(axis=1), np.nan)
+            result[var + '_classes'] = (counts > 0).sum(axis=1)
+            changed = transitions(period, valid, max_gap)[0]
+            result[var + '_transitions'] = np.bincount(changed, minlength=len(sites))
+        else:
+            if 'mean' in stats:
+                result[var + '_mean'] = np.nanmean(period, axis=0)
+            if 'min' in stats:
+                result[var + '_min'] = np.nanmin(period, axis=0)
+            if 'max' in stats:
+                result[var + '_max'] = np.nanmax(period, axis=0)
+            for p in percentiles:
+                result['{}_p{:g}'.format(var, p)] = np.nanpercentile(period, p, axis=0)
+            if 'anomaly' in stats:
+                anomaly = anomalies(times, values, baseline)[inside]
+                result[var + '_anom'] = np.nanmean(anomaly, axis=0)
+                result[var + '_anom_last'] = np.where(last >= 0, anomaly[np.maximum(last, 0), sites], np.nan)
+        for name, threshold in thresholds:
+            if name != var:
+                continue
+            runs = runLengths(valid & (period >= threshold), valid, max_gap)
+            for key, column in runs.items():
+                result['{}_ge{:g}_{}'.format(var, threshold, key)] = column
+    return result
+
+
+def _summarizeBlock(block, window, stats, percentiles, thresholds, max_gap, baseline):
+    import numpy as np
+
+    columns = {}
+    for var, series in block.items():
+        columns.update(_variableStats(var, series['time'], series['values'], window, stats, percentiles, thresholds,
+                                      max_gap, baseline))
+    return {name: np.asarray(values, dtype='float64') for name, values in columns.items()}
+
+
+def summarize(data, date_start=None, date_end=None, stats=STATS, percentiles=PERCENTILES, thresholds=(), max_gap=0,
+              baseline=None, workers=1):
+    """
+    statistics of the series of every site over a report period, computed for blocks of sites at once
+    :param data: sites as returned by loadSites
+    :param date_start: start of the report period in yyyy-mm-dd. Default the first date of the series
+    :param date_end: end of the report period in yyyy-mm-dd. Default the last date of the series
+    :param stats: list of mean, min, max, count, coverage, last and anomaly
+    :param percentiles: list of percentiles
+    :param thresholds: list of (variable, threshold), for the runs of time steps with the variable >= threshold
+    :param max_gap: longest gap of missing time steps that does not break a run or a sequence of classes
+    :param baseline: optional (first year, last year) of the climatology of the anomalies
+    :param workers: number of processes computing the blocks of sites
+    :return: pandas data frame with one row per site
+    """
+    import numpy as np
+    import pandas as pd
+
+    window = (np.datetime64(date_start or '1900-01-01', 'ns'),
+              np.datetime64(date_end or '2200-01-01', 'ns') + np.timedelta64(1, 'D') - np.timedelta64(1, 'ns'))
+    nsites = len(data['site'])
+    blocks = [{var: {'time': series['time'], 'values': series['values'][:, start:start + BLOCK_SITES]}
+               for var, series in data['series'].items()} for start in range(0, nsites, BLOCK_SITES)]
+    arguments = (window, stats, percentiles, thresholds, max_gap, baseline)
+    if workers > 1 and len(blocks) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_summarizeBlock, blocks, *[[a] * len(blocks) for a in arguments]))
+    else:
+        results = [_summarizeBlock(block, *arguments) for block in blocks]
+
+    df = pd.DataFrame({'site': data['site'], 'latitude': data['latitude'], 'longitude': data['longitude']})
+    if results:
+        columns = {name: np.concatenate([r[name] for r in results]) for name in results[0]}
+        df = pd.concat([df, pd.DataFrame(columns)], axis=1)
+    return df
+
+
+def transitionTable(data, variable='CLASS', date_start=None, date_end=None, max_gap=0):
+    """
+    number of changes between every pair of classes at every site
+    :param data: sites as returned by loadSites
+    :param variable: class variable
+    :param date_start: start of the report period in yyyy-mm-dd
+    :param date_end: end of the report period in yyyy-mm-dd
+    :param max_gap: longest gap of missing time steps between two compared steps
+    :return: pandas data frame with site, variable, from, to and count
+    """
+    import numpy as np
+    import pandas as pd
+
+    series = data['series'][variable]
+    times = series['time']
+    inside = np.ones(len(times), dtype=bool)
+    if date_start:
+        inside &= times >= np.datetime64(date_start, 'ns')
+    if date_end:
+        inside &= times < np.datetime64(date_end, 'ns') + np.timedelta64(1, 'D')
+    values = series['values'][inside]
+    sites, before, after = transitions(values, ~np.isnan(values), max_gap)
+    df = pd.DataFrame({'site': sites, 'from': before.astype('int64'), 'to': after.astype('int64')})
+    df = df.groupby(['site', 'from', 'to']).size().reset_index(name='count')
+    df['site'] = np.array(data['site'], dtype=object)[df['site'].to_numpy()]
+    df.insert(1, 'variable', variable)
+    return df
+
+
+def writeFrame(df, fout):
+    """
+    write a summary table. The extension of the file gives the format: csv or parquet
+    :param df: data frame
+    :param fout: output file
+    :return: number of rows written
+    """
+    if fout.lower().endswith('.parquet'):
+        df.to_parquet(fout, index=False)
+    else:
+        df.to_csv(fout, index=False, float_format='%.6g')
+    return len(df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the series of many sites, as written by the harvesters, '
+                                                 'getSatProd or satBatch, in one table with a row per site: '
+                                                 'statistics, percentiles, anomalies from the climatology of the site, '
+                                                 'runs above a threshold and changes of class. The missing days are '
+                                                 'kept as gaps')
+    parser.add_argument('-fin', dest='fin', help='series files (csv, parquet, arrow or nc), one or more per site. '
+                        'A directory takes all its files', nargs='+', required=True)
+    parser.add_argument('-ds', dest='date_start', help='start date of the report in yyyy-mm-dd. Default the first '
+                        'date of the series', required=False)
+    parser.add_argument('-de', dest='date_end', help='end date of the report in yyyy-mm-dd. Default the last date of '
+                        'the series', required=False)
+    parser.add_argument('-stat', dest='stats', help='statistics: {}. Default all'.format(', '.join(STATS)),
+                        choices=STATS, nargs='+', default=STATS, required=False)
+    parser.add_argument('-percentiles', dest='percentiles', help='percentiles of every variable. Default 10 50 90',
+                        type=float, nargs='*', default=PERCENTILES, required=False)
+    parser.add_argument('-threshold', dest='thresholds', help='variable and threshold of the runs, like CRW_HOTSPOT 1. '
+                        'Can be repeated', nargs=2, metavar=('VARIABLE', 'VALUE'), action='append', default=[],
+                        required=False)
+    parser.add_argument('-maxgap', dest='max_gap', help='longest gap of missing time steps that does not break a run '
+                        'or a sequence of classes. Default 0', type=int, default=0, required=False)
+    parser.add_argument('-baseline', dest='baseline', help='first and last year of the climatology of the anomalies. '
+                        'Default all the years', type=int, nargs=2, metavar=('FIRST', 'LAST'), required=False)
+    parser.add_argument('-transitions', dest='transitions', help='also write the number of changes between every pair '
+                        'of classes of every site to this file', required=False)
+    parser.add_argument('-out', dest='fout', help='output file. The extension gives the format: csv or parquet. '
+                        'Default summary.csv', default='summary.csv', required=False)
+    parser.add_argument('-workers', dest='workers', help='number of processes reading the files and computing the '
+                        'blocks of {} sites. Default 1'.format(BLOCK_SITES), type=int, default=1, required=False)
+    args = parser.parse_args()
+
+    fnames = []
+    for name in args.fin:
+        if os.path.isdir(name):
+            fnames += sorted(os.path.join(name, f) for f in os.listdir(name)
+                             if os.path.splitext(f)[1].lower() in satWriters.FORMATS.values())
+        else:
+            fnames.append(name)
+    thresholds = [(var, float(value)) for var, value in args.thresholds]
+
+    data = loadSites(fnames, args.workers)
+    print('{} sites, {} variables'.format(len(data['site']), len(data['series'])))
+    df = summarize(data, args.date_start, args.date_end, args.stats, args.percentiles, thresholds, args.max_gap,
+                   args.baseline, args.workers)
+    rows = writeFrame(df, args.fout)
+    print('{} records written to {}'.format(rows, args.fout))
+    if args.transitions:
+        import pandas as pd
+
+        tables = [transitionTable(data, var, args.date_start, args.date_end, args.max_gap)
+                  for var in satWriters.CLASSES if var in data['series']]
+        if tables:
+            rows = writeFrame(pd.concat(tables, ignore_index=True), args.transitions)
+            print('{} records written to {}'.format(rows, args.transitions))
+        else:
+            print('WARNING: no class variables for the transitions')
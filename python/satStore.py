@@ -0,0 +1,127 @@
+import os
+import csv
+import datetime
+
+import satLock
+import satStream
+
+
+def storeName(outpath, locality, par):
+    """
+    name of the rolling file that keeps the whole series of a parameter for a locality
+    :param outpath: where the file is stored
+    :param locality: name of the locality
+    :param par: parameter code name
+    :return: file name
+    """
+    return os.path.join(outpath, locality + "_" + par + ".csv")
+
+
+def _header(fname):
+    with open(fname, newline='') as f:
+        return next(csv.reader(f), None)
+
+
+def _lastLine(fname):
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        block = 4096
+        while True:
+            f.seek(max(0, size - block))
+            lines = f.read().splitlines()
+            if size <= block or len(lines) > 2:
+                break
+            block = block * 2
+    lines = [line for line in lines if line.strip()]
+    return lines[-1].decode('utf-8') if lines else None
+
+
+def _endsWithNewline(fname):
+    with open(fname, 'rb') as f:
+        if f.seek(0, os.SEEK_END) == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def lastTime(fname):
+    """
+    get the last time stored in an ERDDAP csv file, reading only the end of the file
+    :param fname: csv file with the header and units rows as written by ERDDAP
+    :return: last time as a string (like 2020-01-05T09:00:00Z), or None if the file is missing or has no data
+    """
+    if not os.path.exists(fname):
+        return None
+    header = _header(fname)
+    if not header or 'time' not in header:
+        return None
+    line = _lastLine(fname)
+    row = next(csv.reader([line]))
+    if row == header or len(row) != len(header):
+        return None
+    value = row[header.index('time')]
+    if not value[:4].isdigit():
+        ## only the units row
+        return None
+    return value
+
+
+def nextDate(last_time):
+    """
+    first date after the last stored time
+    :param last_time: time as a string, like 2020-01-05T09:00:00Z
+    :return: next date in yyyy-mm-dd
+    """
+    return (datetime.date.fromisoformat(last_time[:10]) + datetime.timedelta(days=1)).isoformat()
+
+
+def appendCSV(store, fname):
+    """
+    append the rows of an ERDDAP csv file to a rolling store. Only the rows after the last stored time are added,
+    at the end of the store, so the cost grows with the new rows and not with the history. The store is locked while
+    the rows are added, and cut back to its previous end if the append fails, so it is never left half written
+    :param store: rolling csv file. It is created if missing
+    :param fname: csv file with the new data, with the header and units rows
+    :return: number of rows appended
+    """
+    with satLock.fileLock(store), open(fname, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        units = next(reader, None)
+        timeCol = header.index('time')
+        last = lastTime(store)
+        rows = (row for row in reader if row and (last is None or row[timeCol] > last))
+
+        if not os.path.exists(store):
+            with satStream.atomicOutput(store) as tmp, open(tmp, 'w', newline='') as out:
+                writer = csv.writer(out, lineterminator='\n')
+                writer.writerow(header)
+                if units is not None:
+                    writer.writerow(units)
+                return _writeRows(writer, rows)
+
+        if _header(store) != header:
+            raise ValueError("{}: columns do not match the new data".format(store))
+        newline = not _endsWithNewline(store)
+        with open(store, 'a', newline='') as out:
+            end = out.tell()
+            try:
+                if newline:
+                    out.write('\n')
+                count = _writeRows(csv.writer(out, lineterminator='\n'), rows)
+                out.flush()
+            except BaseException:
+                out.truncate(end)
+                raise
+            if not count:
+                out.truncate(end)
+        return count
+
+
+def _writeRows(writer, rows):
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
@@ -0,0 +1,179 @@
+import io
+import os
+import csv
+import tempfile
+import contextlib
+import satCache
+import satMetrics
+from satLazy import lazyImport
+
+## urllib and http are loaded with the first request
+satHTTP = lazyImport('satHTTP')
+
+## number of rows parsed at a time
+CHUNKSIZE = 100000
+
+
+@contextlib.contextmanager
+def atomicOutput(fout):
+    """
+    write a file in a single step. The content is written to a temporary file in the same directory that replaces
+    fout only when the writing ends without errors, so an interrupted run never leaves a half written file
+    :param fout: output file name
+    :return: name of the temporary file to write
+    """
+    folder = os.path.dirname(os.path.abspath(fout))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix='.' + os.path.basename(fout) + '.', suffix='.part')
+    os.close(fd)
+    try:
+        yield tmp
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, fout)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+class _Counter(io.RawIOBase):
+    """
+    binary stream that counts the bytes read from an url response
+    """
+    def __init__(self, response, url):
+        self.response = response
+        self.url = url
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self.response.readinto(buffer)
+        satCache.countBytes(self.url, n or 0)
+        return n
+
+    def close(self):
+        self.response.close()
+        super().close()
+
+
+def openCSV(source):
+    """
+    open an ERDDAP csv response and read its two header rows (names and units)
+    :param source: file name or url
+    :return: (text stream positioned at the first data row, column names, units)
+    """
+    if '://' in str(source):
+        stream = io.TextIOWrapper(io.BufferedReader(_Counter(satHTTP.urlopen(source), source)),
+                                  encoding='utf-8', newline='')
+    else:
+        stream = open(source, newline='')
+    names = next(csv.reader([stream.readline()]))
+    units = next(csv.reader([stream.readline()]), [])
+    return stream, names, units
+
+
+class _Prepend:
+    """
+    file-like object that returns a line already read before the rest of a stream
+    """
+    def __init__(self, first, stream):
+        self.first = first
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.first:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data = self.first + self.stream.read()
+            self.first = ''
+        else:
+            data = self.first[:size]
+            self.first = self.first[size:]
+        return data
+
+
+def _isNumber(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return value.strip() == ''
+
+
+def columnTypes(names, row=None):
+    """
+    explicit types of the columns of an ERDDAP griddap response: time and text variables as str, everything else as float64
+    :param names: column names
+    :param row: first data row, used to detect text variables
+    :return: dictionary {column: dtype}
+    """
+    types = {}
+    for i, name in enumerate(names):
+        if name == 'time' or (row is not None and i < len(row) and not _isNumber(row[i])):
+            types[name] = str
+        else:
+            types[name] = 'float64'
+    return types
+
+
+def readCSV(source, chunksize=CHUNKSIZE):
+    """
+    parse an ERDDAP csv response in chunks, so the memory used does not grow with the size of the response
+    :param source: file name or url
+    :param chunksize: number of rows of each chunk
+    :return: (column names, units, iterator of pandas data frames)
+    """
+    import pandas as pd
+
+    stream, names, units = openCSV(source)
+    first = stream.readline()
+    types = columnTypes(names, next(csv.reader([first]), None))
+
+    def chunks():
+        with stream:
+            if not first.strip():
+                return
+            reader = pd.read_csv(_Prepend(first, stream), header=None, names=names, dtype=types, chunksize=chunksize)
+            for chunk in satMetrics.timed('parse', reader):
+                yield chunk
+
+    return names, units, chunks()
+
+
+def writeCSV(names, units, chunks, fout, preview=10):
+    """
+    write the chunks of an ERDDAP response as they are parsed, keeping the names and units rows
+    :param names: column names
+    :param units: units row
+    :param chunks: iterator of pandas data frames
+    :param fout: output file name
+    :param preview: number of rows kept to be shown to the user
+    :return: (number of rows written, data frame with the first rows)
+    """
+    rows = 0
+    head = None
+    with atomicOutput(fout) as tmp, open(tmp, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(names)
+        if units:
+            writer.writerow(units)
+        for chunk in chunks:
+            with satMetrics.stage('write'):
+                chunk.to_csv(f, header=False, index=False, lineterminator='\n')
+            if head is None:
+                head = chunk.head(preview)
+            rows += len(chunk)
+    satMetrics.countRows(names, rows)
+    return rows, head
+
+
+def streamCSV(source, fout, chunksize=CHUNKSIZE):
+    """
+    copy an ERDDAP csv response to a file, parsing it in chunks with explicit numeric types
+    :param source: file name or url
+    :param fout: output file name
+    :param chunksize: number of rows of each chunk
+    :return: (number of rows written, data frame with the first rows)
+    """
+    names, units, chunks = readCSV(source, chunksize)
+    return writeCSV(names, units, chunks, fout)
@@ -0,0 +1,134 @@
+import os
+import atexit
+import tempfile
+import urllib.parse
+
+import satCache
+import satMetrics
+import satStream
+
+## formats that can be requested to the ERDDAP griddap servers
+TRANSFER_FORMATS = ['csv', 'nc']
+
+
+def toFormat(url, fmt):
+    """
+    change the response format of an ERDDAP griddap request, keeping the query
+    :param url: ERDDAP request url, like .../jplMURSST41.csv?analysed_sst[...]
+    :param fmt: csv or nc
+    :return: url of the same request in the new format
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = os.path.splitext(parts.path)[0] + '.' + fmt
+    return urllib.parse.urlunsplit((parts.scheme, parts.netloc, path, parts.query, parts.fragment))
+
+
+def _expand(values, before, after):
+    """
+    repeat the values of one axis to the flattened (C order) shape of the grid
+    """
+    import numpy as np
+
+    return np.tile(np.repeat(values, after), before)
+
+
+def readNC(fname, chunksize=satStream.CHUNKSIZE):
+    """
+    decode an ERDDAP griddap netCDF response into the same table as its csv response, in chunks of time steps.
+    The coordinates are expanded with vectorized numpy operations, the time is written as in the csv (2020-01-01T09:00:00Z).
+    Needs xarray
+    :param fname: netCDF file
+    :param chunksize: approximate number of rows of each chunk
+    :return: (column names, units, iterator of pandas data frames), like satStream.readCSV
+    """
+    import numpy as np
+    import pandas as pd
+    import xarray as xr
+
+    ds = xr.open_dataset(fname)
+    variables = list(ds.data_vars)
+    dims = list(ds[variables[0]].dims)
+    names = dims + variables
+    units = ['UTC' if name == 'time' else str(ds[name].attrs.get('units', '')) for name in names]
+
+    sizes = [ds.sizes[d] for d in dims]
+    step = int(np.prod(sizes[1:])) if len(sizes) > 1 else 1
+    steps = max(1, chunksize // max(1, step))
+
+    def chunks():
+        with ds:
+            for start in range(0, sizes[0], steps):
+                with satMetrics.stage('parse'):
+                    block = ds.isel({dims[0]: slice(start, start + steps)})
+                    shape = [block.sizes[d] for d in dims]
+                    data = {}
+                    for i, dim in enumerate(dims):
+                        values = block[dim].values
+                        if np.issubdtype(values.dtype, np.datetime64):
+                            values = np.char.add(np.datetime_as_string(values.astype('datetime64[s]'), unit='s'), 'Z')
+                        data[dim] = _expand(values, int(np.prod(shape[:i])), int(np.prod(shape[i + 1:])))
+                    for var in variables:
+                        data[var] = block[var].values.ravel()
+                    chunk = pd.DataFrame(data, columns=names)
+                yield chunk
+
+    return names, units, chunks()
+
+
+def ncToCSV(fname, fout):
+    """
+    decode an ERDDAP griddap netCDF response into a csv file like the ERDDAP csv response
+    :param fname: netCDF file
+    :param fout: output csv file
+    :return: number of rows written
+    """
+    names, units, chunks = readNC(fname)
+    rows, head = satStream.writeCSV(names, units, chunks, fout)
+    return rows
+
+
+def fetchTable(url, transfer='csv'):
+    """
+    retrieve an ERDDAP griddap request in the given transfer format and parse it as a table
+    :param url: ERDDAP request url (any format)
+    :param transfer: csv or nc
+    :return: (column names, units, iterator of pandas data frames)
+    """
+    if transfer == 'nc':
+        return readNC(satCache.fetchFile(toFormat(url, 'nc')))
+    return satStream.readCSV(satCache.fetch(toFormat(url, 'csv')))
+
+
+def fetchCSV(url, transfer='csv'):
+    """
+    retrieve an ERDDAP griddap request in the given transfer format and return it as a local csv file
+    :param url: ERDDAP request url (any format)
+    :param transfer: csv or nc
+    :return: csv file name
+    """
+    if transfer != 'nc':
+        return satCache.fetchFile(toFormat(url, 'csv'))
+    ## the decoded table is kept next to the cache entry and removed with it
+    fname = satCache.fetchFile(toFormat(url, 'nc'))
+    fout = fname + '.csv'
+    if not satCache.isEnabled():
+        atexit.register(lambda: os.path.exists(fout) and os.remove(fout))
+    ## the cache entry keeps the time it was downloaded, so the table is decoded again only for a new response
+    if not os.path.exists(fout) or os.path.getmtime(fout) < os.path.getmtime(fname):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fout), suffix='.tmp')
+        os.close(fd)
+        try:
+            ncToCSV(fname, tmp)
+            os.replace(tmp, fout)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    return fout
+
+
+def transferReport():
+    """
+    bytes downloaded in this session by response format
+    :return: text like "csv: 1.2 MB, nc: 0.3 MB"
+    """
+    return ', '.join('{}: {:.1f} MB'.format(fmt, nbytes / 1048576) for fmt, nbytes in sorted(satCache.TRANSFERRED.items()))
@@ -0,0 +1,339 @@
+import os
+import json
+import threading
+import contextlib
+
+import satMetrics
+import satStream
+
+## output formats and their file extension
+FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow', 'nc': '.nc'}
+
+## time partitions of the output
+PARTITIONS = ['none', 'year', 'month']
+
+## dimension columns, kept in float64 (or as integers, like the day of year of a climatology).
+## Every other numeric variable is stored as float32
+DIMENSIONS = ['time', 'dayofyear', 'altitude', 'zlev', 'depth', 'latitude', 'longitude']
+
+## variables with classes, stored as int8
+CLASSES = ['CLASS']
+
+## dimensions written one step after the other in the netCDF output, along an unlimited dimension
+RECORD_DIMENSIONS = ['time', 'dayofyear']
+
+## the HDF5 library is not thread safe, the netCDF files are written one at a time
+_ncLock = threading.Lock()
+
+
+def downcast(df):
+    """
+    convert an ERDDAP table to compact types: time as UTC datetime, values as float32 and classes as int8
+    :param df: pandas data frame as parsed by satStream
+    :return: converted data frame
+    """
+    import pandas as pd
+
+    df = df.copy()
+    for col in df.columns:
+        if col == 'time':
+            df[col] = pd.to_datetime(df[col], utc=True)
+        elif col in CLASSES:
+            df[col] = pd.to_numeric(df[col]).astype('Int8')
+        elif col in DIMENSIONS:
+            df[col] = pd.to_numeric(df[col])
+            if not pd.api.types.is_integer_dtype(df[col]):
+                df[col] = df[col].astype('float64')
+        elif pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = df[col].astype('float32')
+    return df
+
+
+def partitionKey(times, partition):
+    """
+    period of each row for the time partition of the output
+    :param times: UTC datetime series
+    :param partition: none, year or month
+    :return: series of period labels, like 2020 or 2020-01. None if the output is not partitioned
+    """
+    if partition in (None, 'none'):
+        return None
+    if partition == 'year':
+        return times.dt.strftime('%Y')
+    if partition == 'month':
+        return times.dt.strftime('%Y-%m')
+    raise ValueError("{}: wrong partition. Valid partitions are {}".format(partition, ', '.join(PARTITIONS)))
+
+
+def partitionName(outpath, product, period, name, fmt):
+    """
+    file of a partition, in a hive style layout: outpath/product=sst/period=2020-01/name.parquet
+    :param outpath: root directory
+    :param product: parameter code name
+    :param period: period label
+    :param name: file name without extension, like the locality
+    :param fmt: output format
+    :return: file name
+    """
+    return os.path.join(outpath, 'product=' + product, 'period=' + period, name + FORMATS[fmt])
+
+
+class _NCGrid:
+    """
+    netCDF grid written one time step after the other along an unlimited time dimension, so only one time step is
+    kept in memory. The rows of a time step are kept until the next one starts, the grid of the other dimensions is
+    taken from the first time step. Needs netCDF4
+    """
+    def __init__(self, fout, units):
+        self.fout = fout
+        self.units = units
+        self.nc = None
+        self.record = None
+        self.axes = None
+        self.steps = 0
+        self.last = None
+        self.pending = []
+
+    def _create(self, df):
+        import netCDF4
+        import numpy as np
+
+        dims = [c for c in DIMENSIONS if c in df.columns and c != self.record]
+        self.axes = {dim: np.unique(df[dim].to_numpy()) for dim in dims}
+        self.nc = netCDF4.Dataset(self.fout, 'w')
+        self.nc.createDimension(self.record, None)
+        if self.record == 'time':
+            var = self.nc.createVariable('time', 'f8', ('time',))
+            var.units = 'seconds since 1970-01-01T00:00:00Z'
+            var.calendar = 'standard'
+        else:
+            self.nc.createVariable(self.record, df[self.record].dtype, (self.record,))
+        for dim, values in self.axes.items():
+            self.nc.createDimension(dim, len(values))
+            self.nc.createVariable(dim, values.dtype, (dim,))[:] = values
+        shape = tuple(len(values) for values in self.axes.values())
+        for var in df.columns:
+            if var in DIMENSIONS:
+                continue
+            if var in CLASSES:
+                self.nc.createVariable(var, 'i1', (self.record,) + tuple(dims), zlib=True, fill_value=-1,
+                                       chunksizes=(1,) + shape)
+            else:
+                self.nc.createVariable(var, 'f4', (self.record,) + tuple(dims), zlib=True, fill_value=np.nan,
+                                       chunksizes=(1,) + shape)
+        for name, var in self.nc.variables.items():
+            if self.units.get(name) and name != 'time':
+                var.units = self.units[name]
+
+    def _step(self, df):
+        ## write the rows of one time step
+        import numpy as np
+
+        value = df[self.record].iloc[0]
+        if self.last is not None and value <= self.last:
+            raise ValueError('{}: the rows are not in {} order'.format(self.fout, self.record))
+        if self.nc is None:
+            self._create(df)
+        index = []
+        for dim, values in self.axes.items():
+            column = df[dim].to_numpy()
+            i = np.minimum(np.searchsorted(values, column), len(values) - 1)
+            if not np.array_equal(values[i], column):
+                raise ValueError('{}: the time steps do not have the same {} grid'.format(self.fout, dim))
+            index.append(i)
+        shape = tuple(len(values) for values in self.axes.values())
+        for name, var in self.nc.variables.items():
+            if name in DIMENSIONS:
+                continue
+            grid = np.full(shape, -1 if name in CLASSES else np.nan, dtype='int8' if name in CLASSES else 'float32')
+            values = df[name].fillna(-1) if name in CLASSES else df[name]
+            grid[tuple(index)] = values.to_numpy(dtype=grid.dtype)
+            var[self.steps] = grid
+        self.nc.variables[self.record][self.steps] = value.timestamp() if self.record == 'time' else value
+        self.steps += 1
+        self.last = value
+
+    def write(self, df):
+        if self.record is None:
+            self.record = next(dim for dim in RECORD_DIMENSIONS if dim in df.columns)
+        keys = df[self.record]
+        ## the last time step of the chunk may go on in the next one
+        starts = (keys != keys.shift()).to_numpy().nonzero()[0].tolist() + [len(df)]
+        with _ncLock:
+            for a, b in zip(starts[:-1], starts[1:]):
+                if self.pending and df[self.record].iloc[a] != self.pending[0][self.record].iloc[0]:
+                    self._flush()
+                self.pending.append(df.iloc[a:b])
+
+    def _flush(self):
+        import pandas as pd
+
+        if self.pending:
+            self._step(pd.concat(self.pending, ignore_index=True))
+            self.pending = []
+
+    def close(self, error=None):
+        with _ncLock:
+            try:
+                if error is None:
+                    self._flush()
+            finally:
+                if self.nc is not None:
+                    self.nc.close()
+
+
+class _Sink:
+    """
+    incremental writer of one output file. The file is written to a temporary file that replaces it when closed
+    """
+    def __init__(self, fout, fmt, units):
+        self.fmt = fmt
+        self.units = units
+        self.writer = None
+        self.schema = None
+        self.parts = []
+        self.grid = None
+        self.csv = None
+        self.output = contextlib.ExitStack()
+        self.fout = self.output.enter_context(satStream.atomicOutput(fout))
+
+    def write(self, df):
+        if self.fmt == 'csv':
+            if self.csv is None:
+                self.csv = open(self.fout, 'w', newline='')
+                self.csv.write(','.join(df.columns) + '\n')
+                self.csv.write(','.join(self.units.get(c, '') for c in df.columns) + '\n')
+            df.to_csv(self.csv, header=False, index=False, lineterminator='\n',
+                      date_format='%Y-%m-%dT%H:%M:%SZ')
+        elif self.fmt in ('parquet', 'arrow'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.schema = table.schema.with_metadata({'units': json.dumps(self.units)})
+                if self.fmt == 'parquet':
+                    self.writer = pq.ParquetWriter(self.fout, self.schema, compression='zstd')
+                else:
+                    self.writer = pa.ipc.new_file(self.fout, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+        elif self.grid is not None or any(dim in df.columns for dim in RECORD_DIMENSIONS):
+            ## netCDF is appended one time step after the other
+            if self.grid is None:
+                self.grid = _NCGrid(self.fout, self.units)
+            self.grid.write(df)
+        else:
+            ## without a time dimension netCDF needs the whole grid to build the dimensions
+            self.parts.append(df)
+
+    def close(self, error=None):
+        ## the output replaces the file only if every chunk was written
+        try:
+            if self.csv is not None:
+                self.csv.close()
+            if self.writer is not None:
+                self.writer.close()
+            if self.grid is not None:
+                self.grid.close(error)
+            if self.parts and error is None:
+                writeNC(self.parts, self.fout, self.units)
+        except BaseException as e:
+            error = error or e
+            raise
+        finally:
+            if error is None:
+                self.output.close()
+            else:
+                self.output.__exit__(type(error), error, error.__traceback__)
+
+
+def writeNC(parts, fout, units):
+    """
+    write an ERDDAP table as a compressed netCDF grid. Needs xarray
+    :param parts: list of downcast data frames
+    :param fout: output file name
+    :param units: dictionary {column: units}
+    :return: output file name
+    """
+    import pandas as pd
+
+    df = pd.concat(parts, ignore_index=True)
+    if 'time' in df.columns:
+        df['time'] = df['time'].dt.tz_localize(None)
+    dims = [c for c in DIMENSIONS if c in df.columns]
+    ds = df.set_index(dims).to_xarray()
+    encoding = {}
+    for var in ds.data_vars:
+        if var in CLASSES:
+            ds[var] = ds[var].fillna(-1).astype('int8')
+            encoding[var] = {'zlib': True, '_FillValue': -1}
+        else:
+            ds[var] = ds[var].astype('float32')
+            encoding[var] = {'zlib': True}
+    for name in ds.variables:
+        if units.get(name) and name != 'time':
+            ds[name].attrs['units'] = units[name]
+    ds.to_netcdf(fout, encoding=encoding)
+    return fout
+
+
+def writeChunks(names, units, chunks, fout, fmt='parquet', partition=None, outpath=None, product=None, name=None):
+    """
+    write the chunks of an ERDDAP table in a columnar format, optionally partitioned by product and time
+    :param names: column names
+    :param units: units row
+    :param chunks: iterator of pandas data frames, as returned by satStream.readCSV
+    :param fout: output file name, used when the output is not partitioned
+    :param fmt: csv, parquet, arrow or nc
+    :param partition: none, year or month
+    :param outpath: root directory of the partitions
+    :param product: parameter code name, for the partitions
+    :param name: file name inside each partition, like the locality
+    :return: (number of rows written, list of files written)
+    """
+    if fmt not in FORMATS:
+        raise ValueError("{}: wrong format. Valid formats are {}".format(fmt, ', '.join(FORMATS)))
+    units = dict(zip(names, units))
+    sinks = {}
+    rows = 0
+    error = None
+    try:
+        for chunk in chunks:
+            with satMetrics.stage('write'):
+                chunk = downcast(chunk)
+                rows += len(chunk)
+                keys = partitionKey(chunk['time'], partition) if 'time' in chunk else None
+                if keys is None:
+                    groups = [(None, chunk)]
+                else:
+                    groups = chunk.groupby(keys, sort=False)
+                for period, part in groups:
+                    target = fout if period is None else partitionName(outpath, product, period, name, fmt)
+                    if target not in sinks:
+                        sinks[target] = _Sink(target, fmt, units)
+                    sinks[target].write(part)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        with satMetrics.stage('write'):
+            for sink in sinks.values():
+                sink.close(error)
+    satMetrics.countRows(names, rows)
+    return rows, list(sinks)
+
+
+def convertCSV(source, fout, fmt='parquet', partition=None, outpath=None, product=None, name=None):
+    """
+    convert an ERDDAP csv response to another format, in chunks
+    :param source: csv file name or url
+    :param fout: output file name, used when the output is not partitioned
+    :param fmt: csv, parquet, arrow or nc
+    :param partition: none, year or month
+    :param outpath: root directory of the partitions
+    :param product: parameter code name, for the partitions
+    :param name: file name inside each partition
+    :return: (number of rows written, list of files written)
+    """
+    names, units, chunks = satStream.readCSV(source)
+    return writeChunks(names, units, chunks, fout, fmt, partition, outpath, product, name)
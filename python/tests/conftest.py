@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+## the tools are scripts in the python directory, imported by their module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def mock(monkeypatch):
+    """
+    mock ERDDAP server of satBench standing in for the ERDDAP servers, without mirrors
+    """
+    import satBench
+    import satHTTP
+    import satMirror
+
+    server = satBench.MockERDDAP()
+    monkeypatch.setattr(satMirror, 'MIRRORS_FILE', 'off')
+    for host in satBench.HOSTS:
+        monkeypatch.setitem(satHTTP.STAND_INS, host, server.url)
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    """
+    empty cache directory
+    """
+    import satCache
+
+    folder = str(tmp_path / 'cache')
+    monkeypatch.setattr(satCache, 'CACHE_DIR', folder)
+    monkeypatch.setenv('SSTTOOLS_CACHE', folder)
+    return folder
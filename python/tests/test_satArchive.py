@@ -0,0 +1,34 @@
+import pytest
+
+import satArchive
+import satBench
+
+## chunk grid of a 0.05 degrees product: -89.975 + i * 0.05, 3600 x 7200 cells, in chunks of 32 x 32 cells
+GRID = {'latitude': [-89.975, 0.05, 3600], 'longitude': [-179.975, 0.05, 7200], 'cells': 32}
+
+
+def test_cells_snapped_like_erddap():
+    ## -18.5 and 147.1 are half way between two grid values and go to the even index
+    assert satArchive._cells(GRID, 'latitude', -18.5, -18.51) == (1429, 1430)
+    assert satArchive._cells(GRID, 'longitude', 147.1, 147.1) == (6542, 6542)
+    ## outside the grid the first and last cells are taken
+    assert satArchive._cells(GRID, 'latitude', -95.0, 95.0) == (0, 3599)
+
+
+def test_chunk_keys_at_tie():
+    ## the cell 6559 (147.975) is the last of the chunk 204, 148.0 is half way to the cell 6560 of the chunk 205
+    assert satArchive.chunkKeys(GRID, -18.6, -18.6, 147.96, 147.99, '2019-06-01', '2019-06-02') == ['2019/44_204']
+    assert satArchive.chunkKeys(GRID, -18.6, -18.6, 148.0, 148.0, '2019-06-01', '2019-06-02') == ['2019/44_205']
+    assert satArchive.chunkKeys(GRID, -18.6, -18.6, 147.95, 148.0, '2019-12-31', '2020-01-01') == \
+        ['2019/44_204', '2019/44_205', '2020/44_204', '2020/44_205']
+
+
+@pytest.mark.parametrize('args', [
+    ('dhw', -18.6, -18.6, 147.3, 147.3, '2019-06-01', '2019-06-03'),
+    ('dhw', -18.85, -18.35, 147.15, 147.25, '2019-06-01', '2019-06-03'),
+])
+def test_query_at_ties_equals_request(args, mock, cache, tmp_path, monkeypatch):
+    import satLoad
+
+    monkeypatch.setattr(satArchive, 'ARCHIVE_DIR', str(tmp_path / 'archive'))
+    assert satBench._sameCube(satArchive.query(*args, workers=1), satLoad.loadCube(*args))
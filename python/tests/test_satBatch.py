@@ -0,0 +1,40 @@
+import os
+
+import pandas as pd
+
+import satBatch
+
+## grid of a 0.05 degrees product: -89.975 + i * 0.05
+DIMS = {'latitude': {'min': -89.975, 'spacing': 0.05}, 'longitude': {'min': -179.975, 'spacing': 0.05}}
+
+
+def test_sites_snapped_like_erddap():
+    grid = satBatch.siteGrid(DIMS, 0.05)
+    ## -18.5 and 147.1 are half way between two grid values and go to the even index
+    sites = [('a', -18.5, 147.1), ('b', -18.49, 147.12), ('c', -18.46, 147.11), ('d', -18.55, 147.15)]
+    cells = satBatch.snapSites(sites, grid)
+    assert cells == {(1430, 6542): sites[:3], (1428, 6542): sites[3:]}
+
+
+def test_grid_without_metadata():
+    assert satBatch.siteGrid(None, 0.05) == {'latitude': (0.0, 0.05), 'longitude': (0.0, 0.05)}
+    assert satBatch.snapSites([('a', 0.175, 0.025)], satBatch.siteGrid(None, 0.05)) == {(4, 0): [('a', 0.175, 0.025)]}
+
+
+def test_split_takes_snapped_cell(tmp_path):
+    ## a site half way between two rows of the response takes the cell of snapSites, not the first of them
+    rows = [('2020-01-01T12:00:00Z', lat, lon, round(lat + lon, 3)) for lat in (-18.525, -18.475)
+            for lon in (147.075, 147.125)]
+    fname = str(tmp_path / 'box.csv')
+    with open(fname, 'w') as f:
+        f.write('time,latitude,longitude,CRW_SST\nUTC,degrees_north,degrees_east,degree_C\n')
+        f.writelines('{},{},{},{}\n'.format(*row) for row in rows)
+    grid = satBatch.siteGrid(DIMS, 0.05)
+    sites = [('a', -18.5, 147.1), ('b', -18.51, 147.09)]
+    fouts = satBatch.splitSites(fname, sites, '2020-01-01', '2020-01-01', 'sst', str(tmp_path), grid)
+    cells = []
+    for fout in fouts:
+        df = pd.read_csv(os.path.join(str(tmp_path), fout), skiprows=[1])
+        assert len(df) == 1
+        cells.append((df['latitude'][0], df['longitude'][0]))
+    assert cells == [(-18.475, 147.125), (-18.525, 147.075)]
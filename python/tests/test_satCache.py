@@ -0,0 +1,112 @@
+import os
+import time
+import threading
+import http.server
+import multiprocessing
+
+import satBench
+import satCache
+
+URL = ('https://coastwatch.pfeg.noaa.gov/erddap/griddap/jplMURSST41.csv?analysed_sst[(2019-01-01):1:(2019-01-03)]'
+       '[(-19.0):1:(-18.0)][(147.0):1:(148.0)]')
+
+
+def _fetch(server, fout, queue):
+    ## fetch URL in another process, with the cache of the test
+    import satHTTP
+    import satMirror
+
+    satMirror.MIRRORS_FILE = 'off'
+    satHTTP.STAND_INS.update({host: server for host in satBench.HOSTS})
+    with open(satCache.fetch(URL, fout), 'rb') as f:
+        queue.put(f.read())
+
+
+def test_processes_download_once(mock, cache, tmp_path):
+    mock.bandwidth = 2 * 1048576
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    processes = [context.Process(target=_fetch, args=(mock.url, str(tmp_path / '{}.csv'.format(i)), queue))
+                 for i in range(3)]
+    for process in processes:
+        process.start()
+    bodies = [queue.get(timeout=120) for process in processes]
+    for process in processes:
+        process.join()
+    assert mock.counters()[0] == 1
+    assert bodies[0] == bodies[1] == bodies[2]
+    assert bodies[0] == satBench.synthResponse('jplMURSST41', URL.split('?')[1], 'csv')[0]
+
+
+class _RangeServer:
+    """
+    server of a fixed body that answers the Range requests, recording their headers
+    """
+    def __init__(self, body):
+        self.ranges = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                start = 0
+                value = self.headers.get('Range')
+                server.ranges.append(value)
+                if value:
+                    start = int(value.split('=')[1].split('-')[0])
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)))
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(body) - start))
+                self.end_headers()
+                self.wfile.write(body[start:])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def test_part_file_resumed(monkeypatch, cache):
+    import satHTTP
+    import satMirror
+
+    monkeypatch.setattr(satMirror, 'MIRRORS_FILE', 'off')
+    body = bytes(range(256)) * 400
+    server = _RangeServer(body)
+    monkeypatch.setitem(satHTTP.STAND_INS, 'https://coastwatch.pfeg.noaa.gov', server.url)
+    os.makedirs(cache)
+    dataFile, metaFile = satCache._paths(satCache.cacheKey(URL))
+    with open(dataFile + '.part', 'wb') as f:
+        f.write(body[:30000])
+    try:
+        with open(satCache.fetch(URL), 'rb') as f:
+            assert f.read() == body
+    finally:
+        server.stop()
+    assert server.ranges == ['bytes=30000-']
+    assert not os.path.exists(dataFile + '.part')
+
+
+def test_part_file_waits_for_other_process(mock, cache):
+    ## the lock of the entry is held as by another process: the download waits and the part file is not touched
+    os.makedirs(cache)
+    key = satCache.cacheKey(URL)
+    dataFile, metaFile = satCache._paths(key)
+    results = []
+    with satCache._fileLock(key):
+        thread = threading.Thread(target=lambda: results.append(satCache.fetch(URL)))
+        thread.start()
+        time.sleep(0.5)
+        assert thread.is_alive()
+        assert not os.path.exists(dataFile + '.part')
+        assert mock.counters()[0] == 0
+    thread.join(60)
+    assert results == [dataFile]
+    assert mock.counters()[0] == 1
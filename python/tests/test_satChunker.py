@@ -0,0 +1,63 @@
+import functools
+
+import pytest
+
+import satBench
+import satChunker
+import satStream
+
+DATASET = 'jplMURSST41'
+
+
+def _query(lat_min, lat_max, lon_min, lon_max, date_start, date_end):
+    return 'analysed_sst[({}):1:({})][({}):1:({})][({}):1:({})]'.format(
+        date_start, date_end, lat_min, lat_max, lon_min, lon_max)
+
+
+def _response(tmp_path, name, *box):
+    fname = str(tmp_path / name)
+    with open(fname, 'wb') as f:
+        f.write(satBench.synthResponse(DATASET, _query(*box), 'csv')[0])
+    return fname
+
+
+def _lines(fname):
+    with open(fname) as f:
+        return f.read().splitlines()
+
+
+@pytest.fixture(params=[satStream.CHUNKSIZE, 7])
+def chunksize(request, monkeypatch):
+    ## small chunks put the tile boundaries in the middle of the chunks
+    monkeypatch.setattr(satStream, 'readCSV', functools.partial(satStream.readCSV, chunksize=request.param))
+    return request.param
+
+
+def test_stitched_tiles_equal_whole_request(tmp_path, chunksize):
+    box = (-18.0, -17.9, 147.0, 147.1, '2020-01-01', '2020-01-03')
+    tiles = satChunker.planTiles(*box, spacing=0.01, max_cells=100)
+    assert len(tiles) > 1
+    files = [_response(tmp_path, '{}.csv'.format(i), *[tile[k] for k in
+             ('lat_min', 'lat_max', 'lon_min', 'lon_max', 'date_start', 'date_end')])
+             for i, tile in enumerate(tiles)]
+    rows, head = satChunker.stitchCSV(files, str(tmp_path / 'stitched.csv'))
+    stitched = _lines(str(tmp_path / 'stitched.csv'))
+    whole = _lines(_response(tmp_path, 'whole.csv', *box))
+    ## the space tiles of a time step are written one after the other, not in the order of the grid
+    assert stitched[:2] == whole[:2]
+    assert sorted(stitched[2:]) == sorted(whole[2:])
+    assert rows == len(whole) - 2
+
+
+def test_boundary_rows_written_once(tmp_path, chunksize):
+    ## the tiles share their last day and their last latitude row with the next ones
+    files = [_response(tmp_path, 'a.csv', -18.0, -17.95, 147.0, 147.02, '2020-01-01', '2020-01-02'),
+             _response(tmp_path, 'b.csv', -17.95, -17.9, 147.0, 147.02, '2020-01-01', '2020-01-02'),
+             _response(tmp_path, 'c.csv', -18.0, -17.9, 147.0, 147.02, '2020-01-02', '2020-01-03')]
+    rows, head = satChunker.stitchCSV(files, str(tmp_path / 'stitched.csv'))
+    stitched = _lines(str(tmp_path / 'stitched.csv'))
+    whole = _lines(_response(tmp_path, 'whole.csv', -18.0, -17.9, 147.0, 147.02, '2020-01-01', '2020-01-03'))
+    assert len(set(stitched)) == len(stitched)
+    assert stitched[:2] == whole[:2]
+    assert sorted(stitched[2:]) == sorted(whole[2:])
+    assert rows == len(whole) - 2
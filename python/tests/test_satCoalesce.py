@@ -0,0 +1,45 @@
+import io
+
+import pandas as pd
+
+import satBench
+import satCoalesce
+
+BASE = 'https://coastwatch.pfeg.noaa.gov/erddap/griddap/NOAA_DHW.csv'
+
+## grid of NOAA_DHW in the mock server: -89.975 + i * 0.05 and -179.975 + i * 0.05
+DIMS = {'latitude': {'min': -89.975, 'spacing': 0.05}, 'longitude': {'min': -179.975, 'spacing': 0.05}}
+
+
+def _url(lat_min, lat_max, lon_min, lon_max):
+    return '{}?CRW_SST[(2019-06-01):1:(2019-06-02)][({}):1:({})][({}):1:({})]'.format(
+        BASE, lat_min, lat_max, lon_min, lon_max)
+
+
+def test_halfway_ends_not_merged():
+    assert satCoalesce.canMerge(satCoalesce.parseQuery(_url(-18.61, -18.41, 147.11, 147.31)), DIMS)
+    assert not satCoalesce.canMerge(satCoalesce.parseQuery(_url(-18.6, -18.41, 147.11, 147.31)), DIMS)
+    assert not satCoalesce.canMerge(satCoalesce.parseQuery(_url(-18.61, -18.41, 147.11, 147.3)), DIMS)
+    assert not satCoalesce.canMerge(satCoalesce.parseQuery(_url(-18.61, -18.41, 147.11, 147.31)), {})
+
+
+def test_plan_sends_halfway_requests_alone(mock, cache):
+    queries = [satCoalesce.parseQuery(url) for url in (_url(-18.6, -18.4, 147.1, 147.3),
+                                                       _url(-18.6, -18.4, 147.3, 147.5))]
+    assert [group.members for group in satCoalesce.plan(queries)] == [[0], [1]]
+
+
+def test_merged_parts_equal_requests(mock, cache):
+    urls = [_url(-18.61, -18.41, 147.11, 147.31), _url(-18.59, -18.39, 147.26, 147.49),
+            _url(-18.52, -18.52, 147.22, 147.22)]
+    queries = [satCoalesce.parseQuery(url) for url in urls]
+    groups = satCoalesce.plan(queries)
+    assert [group.members for group in groups] == [[0, 1, 2]]
+    for url, query in zip(urls, queries):
+        names, units, chunks = groups[0].table(query)
+        part = pd.concat(list(chunks), ignore_index=True)
+        body = satBench.synthResponse('NOAA_DHW', url.split('?')[1], 'csv')[0]
+        alone = pd.read_csv(io.BytesIO(body), skiprows=[1])
+        assert names == list(alone.columns)
+        pd.testing.assert_frame_equal(part.astype(str), alone.astype(str))
+    assert mock.counters()[0] == 1
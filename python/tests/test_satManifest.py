@@ -0,0 +1,81 @@
+import os
+import json
+
+import satManifest
+
+URL = ('https://coastwatch.pfeg.noaa.gov/erddap/griddap/jplMURSST41.csv?analysed_sst[(2020-01-01):1:(2020-01-31)]'
+       '[(-19.0):1:(-18.0)][(147.0):1:(148.0)]')
+
+
+def _run(params=('sst',), date_end='2020-01-31', **options):
+    run = {'params': list(params), 'region': [-19.0, -18.0, 147.0, 148.0], 'date_start': '2020-01-01',
+           'date_end': date_end, 'append': False, 'format': 'csv', 'partition': None, 'transfer': 'csv',
+           'target_cells': None, 'resolution': None}
+    run.update(options)
+    return run
+
+
+def _finish(manifest, par, outpath):
+    manifest.plan(par, [URL])
+    manifest.unitState(par, 'done')
+    fname = 'GBR_{}.csv'.format(par)
+    with open(os.path.join(outpath, fname), 'w') as f:
+        f.write(par)
+    manifest.finish(par, outpath, fname, rows=1)
+    return fname
+
+
+def test_name_depends_on_options_only(tmp_path):
+    name = satManifest.manifestName(str(tmp_path), 'GBR', _run())
+    assert satManifest.manifestName(str(tmp_path), 'GBR', _run(params=('sst', 'chl'))) == name
+    assert satManifest.manifestName(str(tmp_path), 'GBR', _run(date_end='2020-02-29')) != name
+    assert satManifest.manifestName(str(tmp_path), 'GBR', _run(format='parquet')) != name
+
+
+def test_resume_same_options(tmp_path):
+    outpath = str(tmp_path)
+    fname = satManifest.manifestName(outpath, 'GBR', _run())
+    output = _finish(satManifest.Manifest(fname, _run()), 'sst', outpath)
+    manifest = satManifest.Manifest(fname, _run(params=('sst', 'chl')), resume=True)
+    assert manifest.isDone('sst', outpath) == output
+    assert manifest.isDone('chl', outpath) is None
+    ## a changed output is done again
+    with open(os.path.join(outpath, output), 'a') as f:
+        f.write('\n')
+    assert manifest.isDone('sst', outpath) is None
+
+
+def test_other_options_not_resumed(tmp_path):
+    outpath = str(tmp_path)
+    _finish(satManifest.Manifest(satManifest.manifestName(outpath, 'GBR', _run()), _run()), 'sst', outpath)
+    fname = satManifest.manifestName(outpath, 'GBR', _run(date_end='2020-02-29'))
+    assert satManifest.Manifest(fname, _run(date_end='2020-02-29'), resume=True).isDone('sst', outpath) is None
+    ## the run of the other dates keeps its manifest
+    assert len([f for f in os.listdir(outpath) if f.endswith('.manifest.json')]) == 2
+
+
+def test_other_options_in_same_file(tmp_path, capsys):
+    outpath = str(tmp_path)
+    fname = satManifest.manifestName(outpath, 'GBR')
+    _finish(satManifest.Manifest(fname, _run()), 'sst', outpath)
+    manifest = satManifest.Manifest(fname, _run(resolution=0.05), resume=True)
+    assert 'has other options, it is not resumed' in capsys.readouterr().out
+    assert manifest.isDone('sst', outpath) is None
+    with open(fname) as f:
+        assert json.load(f)['outputs'] == {}
+
+
+def test_runs_together_keep_other_products(tmp_path):
+    outpath = str(tmp_path)
+    fname = satManifest.manifestName(outpath, 'GBR', _run())
+    first = satManifest.Manifest(fname, _run(params=('sst',)))
+    second = satManifest.Manifest(fname, _run(params=('chl',)))
+    first.plan('sst', [URL])
+    second.plan('chl', [URL])
+    _finish(first, 'sst', outpath)
+    _finish(second, 'chl', outpath)
+    with open(fname) as f:
+        saved = json.load(f)
+    assert sorted(saved['outputs']) == ['chl', 'sst']
+    assert sorted(saved['units']) == ['chl/0', 'sst/0']
+    assert all(output['state'] == 'done' for output in saved['outputs'].values())
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+import satBench
+import satCoalesce
+import satMeta
+
+## coordinates half way between two grid values, where (value - origin) / spacing is not exactly x.5 in floats
+TIES = [(0.175, 0.0, 0.05, 4), (147.025, 140.0, 0.05, 140), (147.075, 140.0, 0.05, 142),
+        (-18.975, 140.0, 0.05, -3180), (0.025, 0.0, 0.05, 0), (0.075, 0.0, 0.05, 2)]
+
+
+@pytest.mark.parametrize('value, origin, spacing, index', TIES)
+def test_ties_go_to_even_index(value, origin, spacing, index):
+    assert satMeta.isHalfway(value, origin, spacing)
+    assert satMeta.closestIndex(value, origin, spacing) == index
+
+
+def test_noisy_spacing():
+    ## the spacing computed from the coverage of a dataset is not exact
+    spacing = (89.975 - -89.975) / 3599
+    assert spacing != 0.05
+    assert satMeta.gridPosition(-18.525, -89.975, spacing) == 1429.0
+    assert satMeta.closestIndex(-18.5, -89.975, spacing) == 1430
+    assert not satMeta.isHalfway(-18.51, -89.975, spacing)
+
+
+def test_same_cells_everywhere():
+    ## the mock server and the coalesced responses take the cells of closestIndex
+    values = np.array([tie[0] for tie in TIES] + [0.17, 0.18, 147.03])
+    for origin in (0.0, 140.0):
+        index = [satMeta.closestIndex(value, origin, 0.05) for value in values]
+        assert satCoalesce._indexes(values, (origin, 0.05)).tolist() == index
+        for value, i in zip(values, index):
+            assert satBench._axis(value, value, 1, origin, 0.05).tolist() == [round(origin + i * 0.05, 6)]
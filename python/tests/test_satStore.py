@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+import satStore
+
+HEADER = 'time,latitude,longitude,sst\nUTC,degrees_north,degrees_east,C\n'
+
+
+def _rows(*days):
+    return ''.join('2020-01-{:02d}T00:00:00Z,-18.5,147.5,26.{}\n'.format(day, day) for day in days)
+
+
+def _write(fname, text):
+    with open(fname, 'w') as f:
+        f.write(text)
+    return str(fname)
+
+
+def test_append_skips_the_stored_times(tmp_path):
+    store = str(tmp_path / 'site_sst.csv')
+    assert satStore.appendCSV(store, _write(tmp_path / 'a.csv', HEADER + _rows(1, 2))) == 2
+    ## the last stored day is requested again, only the days after it are added
+    assert satStore.appendCSV(store, _write(tmp_path / 'b.csv', HEADER + _rows(2, 3, 4))) == 2
+    assert satStore.appendCSV(store, _write(tmp_path / 'c.csv', HEADER + _rows(3, 4))) == 0
+    with open(store) as f:
+        assert f.read() == HEADER + _rows(1, 2, 3, 4)
+    assert satStore.lastTime(store) == '2020-01-04T00:00:00Z'
+
+
+def test_append_after_a_missing_newline(tmp_path):
+    store = _write(tmp_path / 'site_sst.csv', HEADER + _rows(1).rstrip('\n'))
+    assert satStore.appendCSV(store, _write(tmp_path / 'a.csv', HEADER + _rows(1, 2))) == 1
+    with open(store) as f:
+        assert f.read() == HEADER + _rows(1, 2)
+
+
+def test_store_readable_like_other_outputs(tmp_path):
+    mask = os.umask(0o022)
+    try:
+        store = str(tmp_path / 'site_sst.csv')
+        satStore.appendCSV(store, _write(tmp_path / 'a.csv', HEADER + _rows(1)))
+        satStore.appendCSV(store, _write(tmp_path / 'b.csv', HEADER + _rows(2)))
+    finally:
+        os.umask(mask)
+    assert os.stat(store).st_mode & 0o777 == 0o644
+
+
+def test_failed_append_is_cut_back(tmp_path, monkeypatch):
+    store = str(tmp_path / 'site_sst.csv')
+    satStore.appendCSV(store, _write(tmp_path / 'a.csv', HEADER + _rows(1, 2)))
+    with open(store, 'rb') as f:
+        before = f.read()
+    write = satStore._writeRows
+
+    def broken(writer, rows):
+        write(writer, rows)
+        raise OSError('disk full')
+
+    monkeypatch.setattr(satStore, '_writeRows', broken)
+    with pytest.raises(OSError):
+        satStore.appendCSV(store, _write(tmp_path / 'b.csv', HEADER + _rows(3, 4)))
+    with open(store, 'rb') as f:
+        assert f.read() == before
+
+
+def test_append_with_other_columns(tmp_path):
+    store = str(tmp_path / 'site_sst.csv')
+    satStore.appendCSV(store, _write(tmp_path / 'a.csv', HEADER + _rows(1)))
+    with pytest.raises(ValueError):
+        satStore.appendCSV(store, _write(tmp_path / 'b.csv', HEADER.replace('sst', 'dhw') + _rows(2)))